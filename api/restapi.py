@@ -23,12 +23,14 @@ from protos.countries import CountryCode
 from protos import objects
 from keys import blockchainid
 from keys.keychain import KeyChain
-from dht.utils import digest
+from dht.utils import digest, verification_stats
 from market.profile import Profile
 from market.contracts import Contract, check_order_for_payment
 from market.btcprice import BtcPrice
+from net.metrics import rpc_metrics
 from net.upnp import PortMapper
 from api.utils import sanitize_html
+from db.datastore import SEARCH_RESULTS, ORDERS_PER_PAGE
 from market.migration import migratev2
 from twisted.web import static
 
@@ -157,46 +159,13 @@ class OpenBazaarAPI(APIResource):
     def get_profile(self, request):
         def parse_profile(profile, temp_handle=None):
             if profile is not None:
-                profile_json = {
-                    "profile": {
-                        "name": profile.name,
-                        "location": str(CountryCode.Name(profile.location)),
-                        "public_key": profile.guid_key.public_key.encode("hex"),
-                        "nsfw": profile.nsfw,
-                        "vendor": profile.vendor,
-                        "moderator": profile.moderator,
-                        "moderation_fee": round(profile.moderation_fee, 2),
-                        "handle": profile.handle,
-                        "about": profile.about,
-                        "short_description": profile.short_description[0:160],
-                        "website": profile.website,
-                        "email": profile.email,
-                        "primary_color": profile.primary_color,
-                        "secondary_color": profile.secondary_color,
-                        "background_color": profile.background_color,
-                        "text_color": profile.text_color,
-                        "pgp_key": profile.pgp_key.public_key,
-                        "avatar_hash": profile.avatar_hash.encode("hex"),
-                        "header_hash": profile.header_hash.encode("hex"),
-                        "social_accounts": {},
-                        "last_modified": profile.last_modified
-                    }
-                }
-                if temp_handle:
-                    profile_json["profile"]["temp_handle"] = temp_handle
                 if "guid" in request.args:
-                    profile_json["profile"]["guid"] = request.args["guid"][0]
+                    guid = request.args["guid"][0]
                 else:
-                    profile_json["profile"]["guid"] = self.keychain.guid.encode("hex")
-                for account in profile.social:
-                    profile_json["profile"]["social_accounts"][str(
-                        objects.Profile.SocialAccount.SocialType.Name(account.type)).lower()] = {
-                            "username": account.username,
-                            "proof_url": account.proof_url
-                        }
-                if (profile.handle is not "" and "(unconfirmed)" not in profile.handle and
-                        not blockchainid.validate(profile.handle, profile_json["profile"]["guid"])):
-                    profile_json["profile"]["handle"] = ""
+                    guid = self.keychain.guid.encode("hex")
+                profile_json = {"profile": self._profile_to_json(profile, guid)}
+                if temp_handle:
+                    profile_json["profile"]["temp_handle"] = temp_handle
                 request.setHeader('content-type', "application/json")
                 request.write(json.dumps(sanitize_html(profile_json), indent=4))
                 request.finish()
@@ -226,27 +195,7 @@ class OpenBazaarAPI(APIResource):
     def get_listings(self, request):
         def parse_listings(listings):
             if listings is not None:
-                response = {"listings": []}
-                for l in listings.listing:
-                    listing_json = {
-                        "title": l.title,
-                        "contract_hash": l.contract_hash.encode("hex"),
-                        "thumbnail_hash": l.thumbnail_hash.encode("hex"),
-                        "category": l.category,
-                        "price": l.price,
-                        "currency_code": l.currency_code,
-                        "nsfw": l.nsfw,
-                        "origin": str(CountryCode.Name(l.origin)),
-                        "ships_to": [],
-                        "last_modified": l.last_modified,
-                        "pinned": l.pinned,
-                        "hidden": l.hidden
-                    }
-                    if l.contract_type != 0:
-                        listing_json["contract_type"] = str(objects.Listings.ContractType.Name(l.contract_type))
-                    for country in l.ships_to:
-                        listing_json["ships_to"].append(str(CountryCode.Name(country)))
-                    response["listings"].append(listing_json)
+                response = {"listings": self._listings_to_json(listings)}
                 request.setHeader('content-type', "application/json")
                 request.write(json.dumps(sanitize_html(response), indent=4))
                 request.finish()
@@ -264,7 +213,7 @@ class OpenBazaarAPI(APIResource):
             self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
         else:
             ser = self.db.listings.get_proto()
-            if ser is not None:
+            if ser:
                 l = objects.Listings()
                 l.ParseFromString(ser)
                 parse_listings(l)
@@ -272,6 +221,116 @@ class OpenBazaarAPI(APIResource):
                 parse_listings(None)
         return server.NOT_DONE_YET
 
+    @GET('^/api/v1/get_store')
+    @authenticated
+    def get_store(self, request):
+        def parse_store(store):
+            profile, listings = store
+            if profile is not None and listings is not None:
+                response = {
+                    "profile": self._profile_to_json(profile, request.args["guid"][0]),
+                    "listings": self._listings_to_json(listings)
+                }
+                request.setHeader('content-type', "application/json")
+                request.write(json.dumps(sanitize_html(response), indent=4))
+                request.finish()
+            else:
+                request.write(json.dumps({}))
+                request.finish()
+
+        def get_node(node):
+            if node is not None:
+                self.mserver.get_store(node).addCallback(parse_store)
+            else:
+                request.write(json.dumps({}))
+                request.finish()
+
+        if "guid" in request.args:
+            self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+        else:
+            request.write(json.dumps({}))
+            request.finish()
+        return server.NOT_DONE_YET
+
+    @staticmethod
+    def _profile_to_json(profile, guid):
+        profile_json = {
+            "name": profile.name,
+            "location": str(CountryCode.Name(profile.location)),
+            "public_key": profile.guid_key.public_key.encode("hex"),
+            "nsfw": profile.nsfw,
+            "vendor": profile.vendor,
+            "moderator": profile.moderator,
+            "moderation_fee": round(profile.moderation_fee, 2),
+            "handle": profile.handle,
+            "about": profile.about,
+            "short_description": profile.short_description[0:160],
+            "website": profile.website,
+            "email": profile.email,
+            "primary_color": profile.primary_color,
+            "secondary_color": profile.secondary_color,
+            "background_color": profile.background_color,
+            "text_color": profile.text_color,
+            "pgp_key": profile.pgp_key.public_key,
+            "avatar_hash": profile.avatar_hash.encode("hex"),
+            "header_hash": profile.header_hash.encode("hex"),
+            "social_accounts": {},
+            "last_modified": profile.last_modified,
+            "guid": guid
+        }
+        for account in profile.social:
+            profile_json["social_accounts"][str(
+                objects.Profile.SocialAccount.SocialType.Name(account.type)).lower()] = {
+                    "username": account.username,
+                    "proof_url": account.proof_url
+                }
+        if (profile.handle is not "" and "(unconfirmed)" not in profile.handle and
+                not blockchainid.validate(profile.handle, guid)):
+            profile_json["handle"] = ""
+        return profile_json
+
+    @staticmethod
+    def _get_page(store, request):
+        """
+        Returns a page of rows from the purchases, sales or cases store and the cursor
+        for the next page, or None if the request doesn't ask for a page by passing
+        any of the limit, cursor, sort, since or until arguments.
+        """
+        args = request.args
+        if not any(arg in args for arg in ("limit", "cursor", "sort", "since", "until")):
+            return None
+        return store.get_page(status=int(args["status"][0]) if "status" in args else None,
+                              since=float(args["since"][0]) if "since" in args else None,
+                              until=float(args["until"][0]) if "until" in args else None,
+                              start=args["cursor"][0] if "cursor" in args else None,
+                              limit=int(args["limit"][0]) if "limit" in args else ORDERS_PER_PAGE,
+                              ascending="sort" in args and args["sort"][0].lower() == "asc")
+
+    @staticmethod
+    def _listings_to_json(listings):
+        ret = []
+        for l in listings.listing:
+            listing_json = {
+                "title": l.title,
+                "contract_hash": l.contract_hash.encode("hex"),
+                "thumbnail_hash": l.thumbnail_hash.encode("hex"),
+                "category": l.category,
+                "price": l.price,
+                "currency_code": l.currency_code,
+                "nsfw": l.nsfw,
+                "origin": str(CountryCode.Name(l.origin)),
+                "ships_to": [],
+                "last_modified": l.last_modified,
+                "pinned": l.pinned,
+                "hidden": l.hidden
+            }
+            if l.contract_type != 0:
+                listing_json["contract_type"] = str(objects.Listings.ContractType.Name(l.contract_type))
+            for country in l.ships_to:
+                listing_json["ships_to"].append(str(CountryCode.Name(country)))
+            ret.append(listing_json)
+        return ret
+
     @GET('^/api/v1/get_followers')
     @authenticated
     def get_followers(self, request):
@@ -290,6 +349,8 @@ class OpenBazaarAPI(APIResource):
                     response["followers"].append(follower_json)
                 if followers[1] is not None:
                     response["count"] = followers[1]
+                if followers[2] is not None:
+                    response["cursor"] = followers[2]
                 request.setHeader('content-type', "application/json")
                 request.write(json.dumps(sanitize_html(response), indent=4))
                 request.finish()
@@ -298,7 +359,7 @@ class OpenBazaarAPI(APIResource):
                 request.finish()
         start = 0
         if "start" in request.args:
-            start = int(request.args["start"][0])
+            start = request.args["start"][0]
         if "guid" in request.args:
             def get_node(node):
                 if node is not None:
@@ -309,12 +370,9 @@ class OpenBazaarAPI(APIResource):
             self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
         else:
             ser = self.db.follow.get_followers(start)
-            if ser[0] is not None:
-                f = objects.Followers()
-                f.ParseFromString(ser[0])
-                parse_followers((f, ser[1]))
-            else:
-                parse_followers((None, 0))
+            f = objects.Followers()
+            f.ParseFromString(ser[0])
+            parse_followers((f, ser[1], ser[2]))
         return server.NOT_DONE_YET
 
     @GET('^/api/v1/get_following')
@@ -645,8 +703,6 @@ class OpenBazaarAPI(APIResource):
             request.finish()
             return server.NOT_DONE_YET
         else:
-            for vendor in self.protocol.vendors.values():
-                self.db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getProto().SerializeToString())
             PortMapper().clean_my_mappings(self.kserver.node.port)
             self.protocol.shutdown()
             reactor.stop()
@@ -955,7 +1011,7 @@ class OpenBazaarAPI(APIResource):
             }
             mods = []
             try:
-                for guid in json.loads(settings[11]):
+                for guid in self.db.settings.get_moderators():
                     info = self.db.moderators.get_moderator(guid)
                     if info is not None:
                         m = {
@@ -1007,15 +1063,43 @@ class OpenBazaarAPI(APIResource):
         request.finish()
         return server.NOT_DONE_YET
 
+    @GET('^/api/v1/rpc_metrics')
+    @authenticated
+    def get_rpc_metrics(self, request):
+        resp = rpc_metrics.to_dict()
+        resp["verification_cache"] = verification_stats()
+        resp["send_queues"] = self.protocol.scheduler.get_stats()
+        resp["load"] = self.protocol.overload.get_stats()
+        resp["rate_limiter"] = self.protocol.ban_score.get_stats()
+        resp["relays"] = self.protocol.relays.get_stats()
+        resp["connections"] = self.protocol.get_connection_stats()
+        resp["keep_alive"] = self.protocol.nat_timeout.get_stats()
+        resp["vendors"] = self.protocol.vendors.get_stats()
+        resp["database"] = self.mserver.protocol.adb.get_stats()
+        resp["write_queue"] = self.db.write_queue.get_stats()
+        request.setHeader('content-type', "application/json")
+        request.write(json.dumps(resp, indent=4))
+        request.finish()
+        return server.NOT_DONE_YET
+
     @GET('^/api/v1/get_notifications')
     @authenticated
     def get_notifications(self, request):
         limit = int(request.args["limit"][0]) if "limit" in request.args else 20
         start = request.args["start"][0] if "start" in request.args else ""
-        notifications = self.db.notifications.get_notifications(start, limit)
+        if "cursor" in request.args:
+            start = request.args["cursor"][0]
+        unread_only = "unread" in request.args and str_to_bool(request.args["unread"][0])
+        # one more is fetched to find where the next page starts
+        notifications = self.db.notifications.get_notifications(start, limit + 1, unread_only)
+        next_page = None
+        if len(notifications) > limit:
+            next_page = notifications[0][0]
+            notifications = notifications[1:]
         notification_dict = {
             "unread": self.db.notifications.get_unread_count(),
-            "notifications": []
+            "notifications": [],
+            "cursor": next_page
         }
         for n in notifications[::-1]:
             notification_json = {
@@ -1095,6 +1179,30 @@ class OpenBazaarAPI(APIResource):
         request.finish()
         return server.NOT_DONE_YET
 
+    @GET('^/api/v1/search')
+    @authenticated
+    def search(self, request):
+        """
+        Searches this node's listings, purchases, sales and chat messages. The `kind`
+        argument limits the search to one of them.
+        """
+        query = request.args["query"][0] if "query" in request.args else ""
+        kind = request.args["kind"][0] if "kind" in request.args else None
+        limit = int(request.args["limit"][0]) if "limit" in request.args else SEARCH_RESULTS
+        results = []
+        for hit in self.db.search.search(query, kind, max(1, min(limit, 100))):
+            results.append({
+                "kind": hit["kind"],
+                "id": hit["key"],
+                "guid": hit["ref"],
+                "title": hit["title"],
+                "snippet": hit["snippet"]
+            })
+        request.setHeader('content-type', "application/json")
+        request.write(json.dumps({"results": results}, indent=4))
+        request.finish()
+        return server.NOT_DONE_YET
+
     @DELETE('^/api/v1/chat_conversation')
     @authenticated
     def delete_conversations(self, request):
@@ -1124,7 +1232,10 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_sales')
     @authenticated
     def get_sales(self, request):
-        if "status" in request.args:
+        page = self._get_page(self.db.sales, request)
+        if page is not None:
+            sales = page[0]
+        elif "status" in request.args:
             sales = self.db.sales.get_by_status(request.args["status"][0])
         else:
             sales = self.db.sales.get_all()
@@ -1144,6 +1255,8 @@ class OpenBazaarAPI(APIResource):
                 "status_changed": False if sale[10] == 0 else True
             }
             sales_list.append(sale_json)
+        if page is not None:
+            sales_list = {"sales": sales_list, "cursor": page[1]}
         request.setHeader('content-type', "application/json")
         request.write(json.dumps(sanitize_html(sales_list), indent=4))
         request.finish()
@@ -1152,7 +1265,8 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_purchases')
     @authenticated
     def get_purchases(self, request):
-        purchases = self.db.purchases.get_all()
+        page = self._get_page(self.db.purchases, request)
+        purchases = page[0] if page is not None else self.db.purchases.get_all()
         purchases_list = []
         for purchase in purchases:
             purchase_json = {
@@ -1169,6 +1283,8 @@ class OpenBazaarAPI(APIResource):
                 "status_changed": False if purchase[10] == 0 else True
             }
             purchases_list.append(purchase_json)
+        if page is not None:
+            purchases_list = {"purchases": purchases_list, "cursor": page[1]}
         request.setHeader('content-type', "application/json")
         request.write(json.dumps(sanitize_html(purchases_list), indent=4))
         request.finish()
@@ -1341,7 +1457,8 @@ class OpenBazaarAPI(APIResource):
     @GET('^/api/v1/get_cases')
     @authenticated
     def get_cases(self, request):
-        cases = self.db.cases.get_all()
+        page = self._get_page(self.db.cases, request)
+        cases = page[0] if page is not None else self.db.cases.get_all()
         cases_list = []
         for case in cases:
             purchase_json = {
@@ -1359,6 +1476,8 @@ class OpenBazaarAPI(APIResource):
                 "status_changed": False if case[12] == 0 else True
             }
             cases_list.append(purchase_json)
+        if page is not None:
+            cases_list = {"cases": cases_list, "cursor": page[1]}
         request.setHeader('content-type', "application/json")
         request.write(json.dumps(sanitize_html(cases_list), indent=4))
         request.finish()
@@ -1397,18 +1516,41 @@ class OpenBazaarAPI(APIResource):
             else:
                 request.write(json.dumps({}))
                 request.finish()
+
+        def parse_page(page):
+            ratings, next_page = page
+            if ratings is not None:
+                parse_response({"ratings": ratings, "cursor": next_page})
+            else:
+                parse_response(None)
+
+        # either the rating counts and scores or a page of ratings can be asked for instead of all of them
+        aggregate = "aggregate" in request.args and str_to_bool(request.args["aggregate"][0])
+        start = request.args["start"][0] if "start" in request.args else None
+        contract_id = None
+        if "contract_id" in request.args and request.args["contract_id"][0] != "":
+            contract_id = request.args["contract_id"][0]
         if "guid" in request.args:
             def get_node(node):
                 if node is not None:
-                    if "contract_id" in request.args and request.args["contract_id"][0] != "":
-                        self.mserver.get_ratings(node, unhexlify(request.args["contract_id"][0]))\
-                            .addCallback(parse_response)
+                    listing_hash = unhexlify(contract_id) if contract_id is not None else None
+                    if aggregate:
+                        self.mserver.get_rating_aggregate(node, listing_hash).addCallback(parse_response)
+                    elif start is not None:
+                        self.mserver.get_ratings_page(node, listing_hash, start).addCallback(parse_page)
+                    elif listing_hash is not None:
+                        self.mserver.get_ratings(node, listing_hash).addCallback(parse_response)
                     else:
                         self.mserver.get_ratings(node).addCallback(parse_response)
                 else:
                     request.write(json.dumps({}))
                     request.finish()
             self.kserver.resolve(unhexlify(request.args["guid"][0])).addCallback(get_node)
+        elif aggregate:
+            parse_response(self.db.ratings.get_aggregate(contract_id))
+        elif start is not None:
+            ratings, next_page = self.db.ratings.get_ratings_page(contract_id, start)
+            parse_page(([json.loads(rating) for rating in ratings], next_page))
         else:
             ratings = []
             if "contract_id" in request.args and request.args["contract_id"][0] != "":
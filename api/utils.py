@@ -47,3 +47,9 @@ def sanitize_html(value):
     elif isinstance(value, basestring):
         value = bleach.clean(value, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES, styles=ALLOWED_STYLES)
     return value
+
+def strip_html(value):
+    """ Remove all markup from a string, leaving escaped plain text. """
+    if not any(c in value for c in "<>&"):
+        return value
+    return bleach.clean(value, tags=[], attributes={}, styles=[], strip=True)
@@ -25,6 +25,9 @@ from protos.objects import PlaintextMessage, Value, Listings
 ALLOWED_TAGS = ('h2', 'h3', 'h4', 'h5', 'h6', 'p', 'a', 'u', 'ul', 'ol', 'nl', 'li', 'b', 'i', 'strong',
                 'em', 'strike', 'hr', 'br', 'img', 'blockquote', 'span')
 
+# Number of vendors sampled from the vendor registry when building the homepage.
+HOMEPAGE_VENDORS = 100
+
 
 # pylint: disable=W0232
 class WSProtocol(Protocol):
@@ -51,13 +54,8 @@ class WSProtocol(Protocol):
             self.factory.outstanding_vendors = {}
             self.factory.outstanding_vendors[message_id] = queried
 
-        vendors = self.factory.mserver.protocol.multiplexer.vendors.values()
-
-        shuffle(vendors)
-        to_query = []
-        for vendor in vendors:
-            if vendor.id not in queried:
-                to_query.append(vendor)
+        registry = self.factory.mserver.protocol.multiplexer.vendors
+        to_query = registry.sample(quantity, exclude=set(queried))
 
         def handle_response(metadata, node):
             to_query.remove(node)
@@ -78,19 +76,17 @@ class WSProtocol(Protocol):
                 queried.append(node.id)
                 return True
             else:
-                if node.id in self.factory.mserver.protocol.multiplexer.vendors:
-                    del self.factory.mserver.protocol.multiplexer.vendors[node.id]
-                self.factory.db.vendors.delete_vendor(node.id.encode("hex"))
+                registry.failed(node.id)
                 return False
 
-        for node in to_query[:quantity]:
+        for node in to_query:
             self.factory.mserver.get_user_metadata(node).addCallback(handle_response, node)
 
     def get_moderators(self, message_id):
 
         def parse_response(moderators):
             if moderators is not None:
-                current_mods = json.loads(self.factory.db.settings.get()[11])
+                current_mods = self.factory.db.settings.get_moderators()
                 self.factory.db.moderators.clear_all(except_guids=current_mods)
 
                 def parse_profile(profile, node):
@@ -141,23 +137,13 @@ class WSProtocol(Protocol):
             self.factory.outstanding_listings = {}
             self.factory.outstanding_listings[message_id] = []
 
-        vendors = dict(self.factory.mserver.protocol.multiplexer.vendors)
+        registry = self.factory.mserver.protocol.multiplexer.vendors
+        following_guids = None
+        if only_following:
+            following_guids = self.factory.mserver.db.follow.get_following_guids()
+        vendors = dict((v.id, v) for v in registry.sample(HOMEPAGE_VENDORS, include=following_guids))
         self.log.info("Fetching listings from %s vendors" % len(vendors))
 
-        def get_following_from_vendors(vendors):
-            follow_data = self.factory.mserver.db.follow.get_following()
-            following_guids = []
-            if follow_data is not None:
-                f = objects.Following()
-                f.ParseFromString(follow_data)
-                for user in f.users:
-                    following_guids.append(user.guid)
-            vendor_list = []
-            for k, v in vendors.items():
-                if k in following_guids:
-                    vendor_list.append(v)
-            return vendor_list
-
         def handle_response(listings, node):
             count = 0
             if listings is not None:
@@ -204,23 +190,14 @@ class WSProtocol(Protocol):
             else:
                 if node.id in vendors:
                     del vendors[node.id]
-                if node.id in self.factory.mserver.protocol.multiplexer.vendors:
-                    del self.factory.mserver.protocol.multiplexer.vendors[node.id]
-                    self.factory.db.vendors.delete_vendor(node.id.encode("hex"))
-                if only_following:
-                    vendor_list = get_following_from_vendors(vendors)
-                else:
-                    vendor_list = vendors.values()
+                registry.failed(node.id)
+                vendor_list = vendors.values()
                 if len(vendor_list) > 0:
                     shuffle(vendor_list)
                     node_to_ask = vendor_list[0]
                     if node_to_ask is not None:
                         self.factory.mserver.get_listings(node_to_ask).addCallback(handle_response, node_to_ask)
-        if only_following:
-            vendor_list = get_following_from_vendors(vendors)
-        else:
-            vendor_list = vendors.values()
-        shuffle(vendor_list)
+        vendor_list = vendors.values()
         for vendor in vendor_list[:15]:
             self.factory.mserver.get_listings(vendor).addCallback(handle_response, vendor)
 
@@ -278,12 +255,11 @@ class WSProtocol(Protocol):
                                            (n.relayAddress.ip, n.relayAddress.port),
                                            n.natType, n.vendor)
                         if n.guid == KeyChain(self.factory.db).guid:
-                            proto = self.factory.db.listings.get_proto()
-                            l = Listings()
-                            l.ParseFromString(proto)
-                            for listing in l.listing:
-                                if listing.contract_hash == val.valueKey:
-                                    respond(listing, node_to_ask)
+                            ser = self.factory.db.listings.get_listing(val.valueKey)
+                            if ser is not None:
+                                listing = Listings.ListingMetadata()
+                                listing.ParseFromString(ser)
+                                respond(listing, node_to_ask)
                         else:
                             self.factory.mserver.get_contract_metadata(node_to_ask, val.valueKey)\
                                 .addCallback(respond, node_to_ask)
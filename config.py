@@ -13,7 +13,7 @@ from ConfigParser import ConfigParser
 from urlparse import urlparse
 
 SERVER_VERSION = "0.2.6"
-PROTOCOL_VERSION = 2
+PROTOCOL_VERSION = 7
 CONFIG_FILE = join(os.getcwd(), 'ob.cfg')
 
 # FIXME probably a better way to do this. This curretly checks two levels deep.
@@ -31,6 +31,8 @@ DEFAULTS = {
     'libbitcoin_servers': 'tcp://libbitcoin1.openbazaar.org:9091',
     'libbitcoin_servers_testnet': 'tcp://libbitcoin2.openbazaar.org:9091, <Z&{.=LJSPySefIKgCu99w.L%b^6VvuVp0+pbnOM',
     'resolver': 'http://resolver.onename.com/',
+    'bulk_bandwidth': '0',
+    'max_connections': '1000',
     'ssl_cert': None,
     'ssl_key': None,
     'ssl': False,
@@ -166,6 +168,8 @@ KSIZE = int(cfg.get('CONSTANTS', 'KSIZE'))
 ALPHA = int(cfg.get('CONSTANTS', 'ALPHA'))
 TRANSACTION_FEE = int(cfg.get('CONSTANTS', 'TRANSACTION_FEE'))
 RESOLVER = cfg.get('CONSTANTS', 'RESOLVER')
+BULK_BANDWIDTH = int(cfg.get('CONSTANTS', 'BULK_BANDWIDTH'))
+MAX_CONNECTIONS = int(cfg.get('CONSTANTS', 'MAX_CONNECTIONS'))
 SSL = str_to_bool(cfg.get('AUTHENTICATION', 'SSL'))
 SSL_CERT = cfg.get('AUTHENTICATION', 'SSL_CERT')
 SSL_KEY = cfg.get('AUTHENTICATION', 'SSL_KEY')
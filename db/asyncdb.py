@@ -0,0 +1,107 @@
+__author__ = 'chris'
+
+import time
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class AsyncDatabase(object):
+    """
+    Runs calls against a `Database` on a dedicated thread and returns Deferreds,
+    in the style of `twisted.enterprise.adbapi.ConnectionPool`, so slow queries
+    don't hold up the reactor. A single thread is used as SQLite serializes
+    writes anyway and it gets its own pooled connection to the database.
+
+    Store methods can be called through the facade directly:
+
+        adb.listings.get_proto().addCallback(...)
+
+    or several calls can be made in one trip to the database thread with
+    `runInteraction`.
+
+    The thread is started on first use and stopped when the reactor shuts down.
+    """
+
+    def __init__(self, database):
+        self.db = database
+        self.threadpool = None
+        self.running = False
+        self.shutdown_id = None
+        self.queued = 0
+        self.queries = 0
+        self.query_time = 0.0
+
+    def start(self):
+        if not self.running:
+            self.threadpool = ThreadPool(1, 1, "database")
+            self.threadpool.start()
+            self.shutdown_id = reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+            self.running = True
+
+    def stop(self):
+        if self.running:
+            self.threadpool.callInThread(self.db.close)
+            self.threadpool.stop()
+            if self.shutdown_id is not None:
+                try:
+                    reactor.removeSystemEventTrigger(self.shutdown_id)
+                except (ValueError, KeyError):
+                    pass
+                self.shutdown_id = None
+            self.running = False
+
+    def runInteraction(self, interaction, *args, **kw):
+        """
+        Calls `interaction(db, *args, **kw)` on the database thread, where `db` is
+        the wrapped `Database`, and returns a Deferred which fires with its result.
+        """
+        self.start()
+        self.queued += 1
+        d = deferToThreadPool(reactor, self.threadpool, self._run, interaction, args, kw)
+        d.addBoth(self._finished)
+        return d
+
+    def _run(self, interaction, args, kw):
+        start = time.time()
+        try:
+            return interaction(self.db, *args, **kw)
+        finally:
+            self.query_time += time.time() - start
+            self.queries += 1
+
+    def _finished(self, result):
+        self.queued -= 1
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return AsyncStore(self, name)
+
+    def get_stats(self):
+        return {
+            "queued": self.queued,
+            "queries": self.queries,
+            "average_query_ms": round(self.query_time * 1000 / self.queries, 3) if self.queries > 0 else 0
+        }
+
+
+class AsyncStore(object):
+    """
+    Stands in for one of the `Database` stores. Calling a method on it runs the
+    store method on the database thread and returns a Deferred.
+    """
+
+    def __init__(self, adb, store):
+        self.adb = adb
+        self.store = store
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        store = self.store
+
+        def call(*args, **kw):
+            return self.adb.runInteraction(lambda db: getattr(getattr(db, store), method)(*args, **kw))
+        return call
@@ -1,24 +1,358 @@
 __author__ = 'chris'
 
+import json
 import os
+import re
 import sqlite3 as lite
+import threading
 import time
-from api.utils import sanitize_html
-from collections import Counter
+from api.utils import sanitize_html, strip_html, smart_unicode
+from collections import Counter, OrderedDict
 from config import DATA_FOLDER
 from dht.node import Node
 from dht.utils import digest
+from log import Logger
 from protos import objects
 from protos.objects import Listings, Followers, Following
 from os.path import join
-from db.migrations import migration1, migration2, migration3, migration4, migration5, migration6, migration7
+from db.migrations import migration1, migration2, migration3, migration4, migration5, migration6, migration7, \
+    migration8, migration9, migration10, migration11, migration12, migration13, migration14, migration15
+
+# Schema migrations in order. The one at index i upgrades a database from user_version i to i + 1.
+MIGRATIONS = (migration1, migration2, migration3, migration4, migration5, migration6, migration7, migration8,
+              migration9, migration10, migration11, migration12, migration13, migration14, migration15)
+
+# Number of compiled statements each pooled connection keeps around for reuse.
+CACHED_STATEMENTS = 256
+
+# Followers returned in each page of a GET_FOLLOWERS response, and the prefix which
+# tells the cursor for the next page apart from the offsets sent by older nodes.
+FOLLOWERS_PER_PAGE = 30
+FOLLOWERS_CURSOR_PREFIX = "r"
+
+RATINGS_PER_PAGE = 20
+
+# Default and largest number of purchases, sales, cases or notifications in a page.
+ORDERS_PER_PAGE = 50
+MAX_PAGE_SIZE = 500
+
+# The scores, from one to five stars, a buyer gives in a rating. Feedback is the overall score.
+RATING_CATEGORIES = ("feedback", "quality", "description", "delivery_time", "customer_service")
+
+
+def rating_scores(rating):
+    """
+    Returns the scores in each of the RATING_CATEGORIES from a rating, which may be
+    the json string saved in the ratings table or the parsed rating. A missing or
+    invalid score counts as zero.
+    """
+    try:
+        if isinstance(rating, basestring):
+            rating = json.loads(rating)
+        summary = rating["tx_summary"]
+    except Exception:
+        summary = {}
+    scores = []
+    for category in RATING_CATEGORIES:
+        try:
+            score = int(summary[category])
+        except Exception:
+            score = 0
+        scores.append(score if 1 <= score <= 5 else 0)
+    return scores
+
+
+# Hits returned by a search of the local store, and the words of context shown around the matches.
+SEARCH_RESULTS = 20
+SEARCH_SNIPPET_TOKENS = 12
+
+# The kinds of documents kept in the search index.
+SEARCH_KINDS = ("listing", "purchase", "sale", "message")
+
+
+def create_search_index(cursor):
+    """
+    Creates the full text search index. Each document has a row in search_documents
+    and its text is in the search_index table under the same rowid. FTS5 is used
+    where sqlite was built with it as it can rank the hits, otherwise FTS4. Prefixes
+    of two and three characters are indexed so searching as the user types is fast.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS search_documents(id INTEGER PRIMARY KEY, kind TEXT, key TEXT,
+    ref TEXT, UNIQUE(kind, key))''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS index_search_documents_ref ON search_documents(ref);''')
+    try:
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, prefix='2 3')''')
+    except lite.OperationalError:
+        cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts4(title, body, prefix="2,3")''')
+
+
+def listing_search_text(contract):
+    """
+    Returns the title and the body text to index for a listing contract. The body
+    is made up of the description, category and keywords.
+    """
+    listing = contract["vendor_offer"]["listing"]
+    item = listing["item"]
+    body = [item.get("description", ""), item.get("category", ""), listing["metadata"].get("category", "")]
+    body.extend(item.get("keywords", []))
+    return item["title"], u"\n".join(smart_unicode(text) for text in body if text)
+
+
+def create_order_indexes(cursor):
+    """
+    Creates the indexes used to page through the purchases, sales and cases by
+    time, with or without a status filter.
+    """
+    for table in ("purchases", "sales", "cases"):
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_%s_timestamp ON %s(timestamp, id);''' % (table, table))
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_%s_status ON %s(status, timestamp, id);'''
+                       % (table, table))
+
+
+def get_order_page(database_path, table, columns, status=None, since=None, until=None, start=None,
+                   limit=ORDERS_PER_PAGE, ascending=False):
+    """
+    Returns a `tuple` of up to `limit` rows from the purchases, sales or cases table,
+    ordered by timestamp, and the id of the last one to pass as `start` for the
+    next page, which is None on the last page. An unknown `start` returns no rows.
+
+    Args:
+        table: the table to read.
+        columns: the columns to return, as a string.
+        status: only return rows with this status.
+        since: only return rows with a timestamp at or after this.
+        until: only return rows with a timestamp before this.
+        start: the id of the last row on the previous page.
+        ascending: oldest first if True, otherwise newest first.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    conn = Database.connect_database(database_path)
+    cursor = conn.cursor()
+    where, args = [], []
+    if status is not None:
+        where.append('''status=?''')
+        args.append(status)
+    if since is not None:
+        where.append('''timestamp>=?''')
+        args.append(since)
+    if until is not None:
+        where.append('''timestamp<?''')
+        args.append(until)
+    if start:
+        cursor.execute('''SELECT timestamp FROM %s WHERE id=?''' % table, (start,))
+        row = cursor.fetchone()
+        if row is None:
+            conn.close()
+            return [], None
+        # ties on the timestamp are broken by the id so no row is skipped or repeated
+        comparison = ">" if ascending else "<"
+        where.append('''(timestamp %s ? OR (timestamp=? AND id %s ?))''' % (comparison, comparison))
+        args.extend([row[0], row[0], start])
+    order = '''ASC''' if ascending else '''DESC'''
+    sql = '''SELECT id, %s FROM %s''' % (columns, table)
+    if where:
+        sql += ''' WHERE ''' + ''' AND '''.join(where)
+    sql += ''' ORDER BY timestamp %s, id %s LIMIT ?''' % (order, order)
+    cursor.execute(sql, args + [limit + 1])
+    rows = cursor.fetchall()
+    conn.close()
+    next_page = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], next_page
+
+
+# The audit events are counted in a rollup table for each of these periods, in seconds.
+AUDIT_PERIODS = OrderedDict([("hourly", 3600), ("daily", 86400)])
+
+
+def create_audit_rollups(cursor):
+    """
+    Creates the tables counting the audit events, and the number of distinct
+    shoppers behind them, for each contract and action in each of the AUDIT_PERIODS.
+    audit_shoppers holds the shoppers already counted in recent periods.
+    """
+    for resolution in AUDIT_PERIODS:
+        cursor.execute('''CREATE TABLE IF NOT EXISTS audit_%s(period INTEGER, contract_hash TEXT,
+    action_id INTEGER, views INTEGER, shoppers INTEGER,
+    PRIMARY KEY(period, contract_hash, action_id))''' % resolution)
+        cursor.execute('''CREATE INDEX IF NOT EXISTS index_audit_%s_contract ON audit_%s(contract_hash,
+    period);''' % (resolution, resolution))
+    cursor.execute('''CREATE TABLE IF NOT EXISTS audit_shoppers(resolution TEXT, period INTEGER,
+    contract_hash TEXT, action_id INTEGER, shopper_guid TEXT, PRIMARY KEY(resolution, period, contract_hash,
+    action_id, shopper_guid))''')
+
+
+class PooledConnection(lite.Connection):
+    """
+    A connection which stays open and is shared by all the stores in a thread.
+    The stores still call `close()` when they are done with it, which discards
+    anything they left uncommitted just like really closing it would have.
+    """
+
+    def close(self):
+        self.rollback()
+
+    def release(self):
+        lite.Connection.close(self)
+
+
+class ConnectionPool(threading.local):
+    """
+    Keeps one open connection per database file for each thread, so the stores
+    don't pay for opening a connection, reading the schema and compiling their
+    statements on every call. Connections use WAL journaling so readers don't
+    block the writer, and only sync at checkpoints.
+    """
+
+    def __init__(self):
+        threading.local.__init__(self)
+        self.connections = {}
+
+    def get(self, path):
+        conn = self.connections.get(path)
+        if conn is None:
+            conn = lite.connect(path, factory=PooledConnection, cached_statements=CACHED_STATEMENTS)
+            conn.text_factory = str
+            conn.execute('''PRAGMA journal_mode=WAL''')
+            conn.execute('''PRAGMA synchronous=NORMAL''')
+            self.connections[path] = conn
+        return conn
+
+    def release(self, path):
+        conn = self.connections.pop(path, None)
+        if conn is not None:
+            conn.release()
+
+
+pool = ConnectionPool()
+
+# Queued writes are committed together once this many are waiting, and otherwise whenever
+# the queue is flushed, which the server does every WRITE_FLUSH_INTERVAL seconds and on shutdown.
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 1
+
+
+class WriteQueue(object):
+    """
+    Holds inserts which don't need to reach the disk straight away, such as
+    notifications, chat messages, ratings, broadcasts and audit events, and
+    commits them in one transaction instead of one commit each. There is one
+    queue per database file, shared by all the stores using it.
+
+    Queued rows are kept in an overlay, keyed by table and primary key, so they
+    can be looked up before they are written. Stores call `sync` before reading
+    or changing a table with queued inserts, so they always see their own writes.
+    """
+
+    # database path -> `WriteQueue`
+    queues = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def for_path(database_path):
+        with WriteQueue.lock:
+            queue = WriteQueue.queues.get(database_path)
+            if queue is None:
+                queue = WriteQueue(database_path)
+                WriteQueue.queues[database_path] = queue
+            return queue
+
+    def __init__(self, database_path, batch_size=WRITE_BATCH_SIZE):
+        self.PATH = database_path
+        self.batch_size = batch_size
+        self.writes = []
+        # (table, key) -> row
+        self.overlay = {}
+        self.write_lock = threading.RLock()
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+        self.log = Logger(system=self)
+
+    def put(self, write, table=None, key=None, row=None):
+        """
+        Queues `write(cursor)` to be run in the next batch. If `key` is given, `row`
+        is returned by `get(table, key)` until the write is committed.
+        """
+        with self.write_lock:
+            self.writes.append((write, table, key))
+            if key is not None:
+                self.overlay[(table, key)] = row
+            if len(self.writes) >= self.batch_size:
+                self.flush()
+
+    def get(self, table, key):
+        return self.overlay.get((table, key))
+
+    def sync(self):
+        """Writes anything queued so a following query sees it."""
+        if self.writes:
+            self.flush()
+
+    def flush(self):
+        """
+        Commits every queued write in one transaction. Each write runs in its own
+        savepoint, so one which fails, for example on a duplicate key, is rolled
+        back entirely and dropped without failing the others. If the transaction
+        can't be committed the writes stay queued for the next flush.
+        """
+        with self.write_lock:
+            if not self.writes:
+                return
+            writes = self.writes
+            failed = 0
+            conn = Database.connect_database(self.PATH)
+            # The sqlite3 module commits before a SAVEPOINT statement, so the
+            # transaction is managed by hand for the duration of the flush.
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            try:
+                cursor.execute('''BEGIN''')
+                for write, table, key in writes:
+                    cursor.execute('''SAVEPOINT queued_write''')
+                    try:
+                        write(cursor)
+                    except Exception as e:
+                        cursor.execute('''ROLLBACK TO queued_write''')
+                        failed += 1
+                        self.log.warning("dropped queued write to %s %s: %s" % (table, key, str(e)))
+                    cursor.execute('''RELEASE queued_write''')
+                cursor.execute('''COMMIT''')
+            except lite.Error as e:
+                self.log.error("failed to flush queued writes: %s" % str(e))
+                try:
+                    cursor.execute('''ROLLBACK''')
+                except lite.Error:
+                    pass
+                return
+            finally:
+                conn.isolation_level = isolation_level
+                conn.close()
+            self.writes = []
+            self.overlay.clear()
+            self.flushes += 1
+            self.written += len(writes) - failed
+            self.failed += failed
+
+    def discard(self):
+        with self.write_lock:
+            self.writes = []
+            self.overlay.clear()
+
+    def get_stats(self):
+        return {
+            "pending": len(self.writes),
+            "flushes": self.flushes,
+            "written": self.written,
+            "failed": self.failed
+        }
 
 
 class Database(object):
 
     __slots__ = ['PATH', 'filemap', 'profile', 'listings', 'keys', 'follow', 'messages',
                  'notifications', 'broadcasts', 'vendors', 'moderators', 'purchases', 'sales',
-                 'cases', 'ratings', 'transactions', 'settings', 'audit_shopping']
+                 'cases', 'ratings', 'transactions', 'settings', 'audit_shopping', 'search', 'write_queue']
 
     def __init__(self, testnet=False, filepath=None):
         object.__setattr__(self, 'PATH', self._database_path(testnet, filepath))
@@ -39,6 +373,8 @@ class Database(object):
         object.__setattr__(self, 'transactions', Transactions(self.PATH))
         object.__setattr__(self, 'settings', Settings(self.PATH))
         object.__setattr__(self, 'audit_shopping', ShoppingEvents(self.PATH))
+        object.__setattr__(self, 'search', SearchIndex(self.PATH))
+        object.__setattr__(self, 'write_queue', WriteQueue.for_path(self.PATH))
 
         self._initialize_datafolder_tree()
         self._initialize_database(self.PATH)
@@ -46,6 +382,20 @@ class Database(object):
     def get_database_path(self):
         return self.PATH
 
+    def flush(self):
+        """
+        Commits the writes waiting in the `WriteQueue`.
+        """
+        self.write_queue.flush()
+
+    def close(self):
+        """
+        Commits any queued writes and closes this thread's pooled connection to the
+        database, which also checkpoints the write-ahead log.
+        """
+        self.write_queue.flush()
+        pool.release(self.PATH)
+
     def _initialize_database(self, database_path):
         """
         Create database, if not present, and clear cache.
@@ -53,7 +403,20 @@ class Database(object):
         if not database_path:
             raise RuntimeError('attempted to initialize empty path')
 
+        pool.release(database_path)
+        ProfileStore.clear_cache(database_path)
+        ListingsStore.clear_cache(database_path)
+        KeyStore.clear_cache(database_path)
+        Settings.clear_cache(database_path)
+        FollowData.clear_cache(database_path)
+        SearchIndex.clear_cache(database_path)
         if not os.path.isfile(database_path):
+            # writes queued for a database which has since been deleted are dropped
+            WriteQueue.for_path(database_path).discard()
+            # the write-ahead log of a deleted database must not be applied to the new one
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(database_path + suffix):
+                    os.remove(database_path + suffix)
             self._create_database(database_path)
             cache = join(DATA_FOLDER, "cache.pickle")
             if os.path.exists(cache):
@@ -83,9 +446,7 @@ class Database(object):
 
     @staticmethod
     def connect_database(path):
-        conn = lite.connect(path)
-        conn.text_factory = str
-        return conn
+        return pool.get(path)
 
     @staticmethod
     def _initialize_datafolder_tree():
@@ -118,19 +479,20 @@ class Database(object):
         conn = lite.connect(database_path)
         cursor = conn.cursor()
 
-        cursor.execute('''PRAGMA user_version = 6''')
+        cursor.execute('''PRAGMA user_version = 15''')
         cursor.execute('''CREATE TABLE hashmap(hash TEXT PRIMARY KEY, filepath TEXT)''')
 
         cursor.execute('''CREATE TABLE profile(id INTEGER PRIMARY KEY, serializedUserInfo BLOB, tempHandle TEXT)''')
 
-        cursor.execute('''CREATE TABLE listings(id INTEGER PRIMARY KEY, serializedListings BLOB)''')
+        cursor.execute('''CREATE TABLE listings(contractHash TEXT PRIMARY KEY, serializedListing BLOB,
+    hidden INTEGER)''')
 
         cursor.execute('''CREATE TABLE keys(type TEXT PRIMARY KEY, privkey BLOB, pubkey BLOB)''')
 
         cursor.execute('''CREATE TABLE followers(guid TEXT UNIQUE, serializedFollower TEXT)''')
         cursor.execute('''CREATE INDEX index_followers ON followers(serializedFollower);''')
 
-        cursor.execute('''CREATE TABLE following(id INTEGER PRIMARY KEY, serializedFollowing BLOB)''')
+        cursor.execute('''CREATE TABLE following(guid TEXT PRIMARY KEY, serializedUser BLOB)''')
 
         cursor.execute('''CREATE TABLE messages(msgID TEXT PRIMARY KEY, guid TEXT, handle TEXT, pubkey BLOB,
     subject TEXT, messageType TEXT, message TEXT, timestamp INTEGER, avatarHash BLOB, signature BLOB,
@@ -140,6 +502,10 @@ class Database(object):
         cursor.execute('''CREATE INDEX index_messages_read ON messages(read);''')
         cursor.execute('''CREATE INDEX index_timestamp ON messages(timestamp);''')
 
+        cursor.execute('''CREATE TABLE conversations(guid TEXT PRIMARY KEY, handle TEXT, pubkey BLOB,
+    lastMessage TEXT, timestamp INTEGER, avatarHash BLOB, unread INTEGER)''')
+        cursor.execute('''CREATE INDEX index_conversations_timestamp ON conversations(timestamp);''')
+
         cursor.execute('''CREATE TABLE notifications(notifID TEXT UNIQUE, guid BLOB, handle TEXT, type TEXT,
     orderId TEXT, title TEXT, timestamp INTEGER, imageHash BLOB, read INTEGER)''')
         cursor.execute('''CREATE INDEX index_notification_read ON notifications(read);''')
@@ -147,7 +513,9 @@ class Database(object):
         cursor.execute('''CREATE TABLE broadcasts(id TEXT PRIMARY KEY, guid BLOB, handle TEXT, message TEXT,
     timestamp INTEGER, avatarHash BLOB)''')
 
-        cursor.execute('''CREATE TABLE vendors(guid TEXT PRIMARY KEY, serializedNode BLOB)''')
+        cursor.execute('''CREATE TABLE vendors(guid TEXT PRIMARY KEY, serializedNode BLOB, lastSeen INTEGER,
+    score REAL)''')
+        cursor.execute('''CREATE INDEX index_vendors_last_seen ON vendors(lastSeen);''')
 
         cursor.execute('''CREATE TABLE moderators(guid TEXT PRIMARY KEY, pubkey BLOB, bitcoinKey BLOB,
     bitcoinSignature BLOB, handle TEXT, name TEXT, description TEXT, avatar BLOB, fee FLOAT)''')
@@ -167,6 +535,11 @@ class Database(object):
         cursor.execute('''CREATE TABLE ratings(listing TEXT, ratingID TEXT,  rating TEXT)''')
         cursor.execute('''CREATE INDEX index_listing ON ratings(listing);''')
         cursor.execute('''CREATE INDEX index_rating_id ON ratings(ratingID);''')
+        cursor.execute('''CREATE TABLE rating_aggregates(listing TEXT PRIMARY KEY, count INTEGER, feedback INTEGER,
+    quality INTEGER, description INTEGER, deliveryTime INTEGER, customerService INTEGER, oneStar INTEGER,
+    twoStars INTEGER, threeStars INTEGER, fourStars INTEGER, fiveStars INTEGER)''')
+
+        create_order_indexes(cursor)
 
         cursor.execute('''CREATE TABLE transactions(tx BLOB);''')
 
@@ -183,9 +556,11 @@ class Database(object):
             "timestamp" integer NOT NULL,
             action_id integer NOT NULL
           );''')
-        cursor.execute('''CREATE INDEX IF NOT EXISTS shopper_guid_index ON audit_shopping
-                          (audit_shopping_id ASC);''')
-        cursor.execute('''CREATE INDEX IF NOT EXISTS action_id_index ON audit_shopping (audit_shopping_id ASC);''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS shopper_guid_index ON audit_shopping(shopper_guid);''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS action_id_index ON audit_shopping(action_id, timestamp);''')
+        create_audit_rollups(cursor)
+
+        create_search_index(cursor)
 
         conn.commit()
         conn.close()
@@ -197,36 +572,10 @@ class Database(object):
         version = cursor.fetchone()[0]
         conn.close()
 
-        if version == 0:
-            migration1.migrate(self.PATH)
-            migration2.migrate(self.PATH)
-            migration3.migrate(self.PATH)
-            migration4.migrate(self.PATH)
-            migration5.migrate(self.PATH)
-            migration6.migrate(self.PATH)
-        elif version == 1:
-            migration2.migrate(self.PATH)
-            migration3.migrate(self.PATH)
-            migration4.migrate(self.PATH)
-            migration5.migrate(self.PATH)
-            migration6.migrate(self.PATH)
-        elif version == 2:
-            migration3.migrate(self.PATH)
-            migration4.migrate(self.PATH)
-            migration5.migrate(self.PATH)
-            migration6.migrate(self.PATH)
-        elif version == 3:
-            migration4.migrate(self.PATH)
-            migration5.migrate(self.PATH)
-            migration6.migrate(self.PATH)
-        elif version == 4:
-            migration5.migrate(self.PATH)
-            migration6.migrate(self.PATH)
-        elif version == 5:
-            migration6.migrate(self.PATH)
-            migration7.migrate(self.PATH)
-        elif version == 6:
-            migration7.migrate(self.PATH)
+        # Every migration above the stored version runs in order, so a
+        # database of any age reaches the current schema in one startup.
+        for migration in MIGRATIONS[version:]:
+            migration.migrate(self.PATH)
 
 
 class HashMap(object):
@@ -292,294 +641,520 @@ class ProfileStore(object):
     object). Also we will just serve this over the wire so we don't have to manually
     rebuild it every startup. To interact with the profile you should use the
     `market.profile` module and not this class directly.
+
+    The profile row is cached in memory, along with the parsed profile once it
+    has been asked for, and the cache is updated as the profile is saved.
     """
 
+    # database path -> [serialized profile, temp handle, parsed `Profile` or None]
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, database_path):
         self.PATH = database_path
 
-    def set_proto(self, proto):
-        conn = Database.connect_database(self.PATH)
-        with conn:
+    @staticmethod
+    def clear_cache(database_path):
+        with ProfileStore.lock:
+            ProfileStore.cache.pop(database_path, None)
+
+    def _get_cache(self):
+        """Returns the cache entry, reading the profile row if needed. Call with the lock held."""
+        entry = ProfileStore.cache.get(self.PATH)
+        if entry is None:
+            conn = Database.connect_database(self.PATH)
             cursor = conn.cursor()
-            handle = self.get_temp_handle()
-            cursor.execute('''INSERT OR REPLACE INTO profile(id, serializedUserInfo, tempHandle)
+            cursor.execute('''SELECT serializedUserInfo, tempHandle FROM profile WHERE id = 1''')
+            ret = cursor.fetchone()
+            conn.close()
+            entry = [ret[0], ret[1], None] if ret is not None else [None, "", None]
+            ProfileStore.cache[self.PATH] = entry
+        return entry
+
+    def set_proto(self, proto):
+        with ProfileStore.lock:
+            handle = self._get_cache()[1]
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO profile(id, serializedUserInfo, tempHandle)
                           VALUES (?,?,?)''', (1, proto, handle))
-            conn.commit()
-        conn.close()
+                conn.commit()
+            conn.close()
+            ProfileStore.cache[self.PATH] = [proto, handle, None]
 
     def get_proto(self):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT serializedUserInfo FROM profile WHERE id = 1''')
-        ret = cursor.fetchone()
-        conn.close()
-        if ret is None:
-            return None
-        return ret[0]
+        with ProfileStore.lock:
+            return self._get_cache()[0]
+
+    def get_profile(self):
+        """
+        Returns a copy of the profile as a `Profile` protobuf object, which is empty
+        if no profile has been saved. It is only parsed once after each change.
+        """
+        with ProfileStore.lock:
+            entry = self._get_cache()
+            if entry[2] is None:
+                parsed = objects.Profile()
+                if entry[0] is not None:
+                    parsed.ParseFromString(entry[0])
+                entry[2] = parsed
+            profile = objects.Profile()
+            profile.CopyFrom(entry[2])
+            return profile
 
     def set_temp_handle(self, handle):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            if self.get_proto() is None:
-                cursor.execute('''INSERT OR REPLACE INTO profile(id, tempHandle)
+        with ProfileStore.lock:
+            proto = self._get_cache()[0]
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                if proto is None:
+                    cursor.execute('''INSERT OR REPLACE INTO profile(id, tempHandle)
                           VALUES (?,?)''', (1, handle))
-            else:
-                cursor.execute('''UPDATE profile SET tempHandle=? WHERE id=?;''', (handle, 1))
-            conn.commit()
-        conn.close()
+                else:
+                    cursor.execute('''UPDATE profile SET tempHandle=? WHERE id=?;''', (handle, 1))
+                conn.commit()
+            conn.close()
+            ProfileStore.cache[self.PATH] = [proto, handle, None]
 
     def get_temp_handle(self):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT tempHandle FROM profile WHERE id = 1''')
-        ret = cursor.fetchone()
-        conn.close()
-        if ret is None:
-            return ""
-        else:
-            return ret[0]
+        with ProfileStore.lock:
+            return self._get_cache()[1]
 
 
 class ListingsStore(object):
     """
-    Stores a serialized `Listings` protobuf object. It contains metadata for all the
-    contracts hosted by this store. We will send this in response to a GET_LISTING
-    query. This should be updated each time a new contract is created.
+    Stores the `ListingMetadata` of each contract hosted by this store, one row per
+    contract keyed by its hash. The serialized `Listings` object we send in response
+    to a GET_LISTING query is cached in memory and updated as listings are added and
+    removed, rather than being rebuilt from the database on every request.
     """
 
+    # database path -> OrderedDict of contract hash -> (serialized `Listings` containing
+    # just that listing, hidden). The cache is shared by every store using the database.
+    cache = {}
+    # database path -> include_hidden -> serialized `Listings`, dropped whenever a listing changes
+    responses = {}
+    lock = threading.Lock()
+
     def __init__(self, database_path):
         self.PATH = database_path
 
+    @staticmethod
+    def clear_cache(database_path):
+        with ListingsStore.lock:
+            ListingsStore.cache.pop(database_path, None)
+            ListingsStore.responses.pop(database_path, None)
+
+    def _get_cache(self):
+        listings = ListingsStore.cache.get(self.PATH)
+        if listings is None:
+            listings = OrderedDict()
+            conn = Database.connect_database(self.PATH)
+            cursor = conn.cursor()
+            cursor.execute('''SELECT contractHash, serializedListing, hidden FROM listings ORDER BY rowid''')
+            for contract_hash, ser, hidden in cursor.fetchall():
+                listings[contract_hash] = (self._frame(ser), bool(hidden))
+            conn.close()
+            ListingsStore.cache[self.PATH] = listings
+        return listings
+
+    @staticmethod
+    def _frame(ser):
+        """
+        Serializes a `Listings` object holding only this listing. Protobuf messages can
+        be concatenated, so joining these gives the serialized `Listings` for all of them.
+        """
+        l = Listings()
+        l.listing.add().MergeFromString(ser)
+        return l.SerializeToString()
+
     def add_listing(self, proto):
         """
         Will also update an existing listing if the contract hash is the same.
         """
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            l = Listings()
-            ser = self.get_proto()
-            if ser is not None:
-                l.ParseFromString(ser)
-                for listing in l.listing:
-                    if listing.contract_hash == proto.contract_hash:
-                        l.listing.remove(listing)
-            l.listing.extend([proto])
-            cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
-                          VALUES (?,?)''', (1, l.SerializeToString()))
-            conn.commit()
-        conn.close()
+        contract_hash = proto.contract_hash.encode("hex")
+        ser = proto.SerializeToString()
+        with ListingsStore.lock:
+            listings = self._get_cache()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO listings(contractHash, serializedListing, hidden)
+                              VALUES (?,?,?)''', (contract_hash, ser, 1 if proto.hidden else 0))
+                conn.commit()
+            conn.close()
+            listings.pop(contract_hash, None)
+            listings[contract_hash] = (self._frame(ser), proto.hidden)
+            ListingsStore.responses.pop(self.PATH, None)
 
     def delete_listing(self, hash_value):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            ser = self.get_proto()
-            if ser is None:
-                return
-            l = Listings()
-            l.ParseFromString(ser)
-            for listing in l.listing:
-                if listing.contract_hash == hash_value:
-                    l.listing.remove(listing)
-            cursor.execute('''INSERT OR REPLACE INTO listings(id, serializedListings)
-                          VALUES (?,?)''', (1, l.SerializeToString()))
-            conn.commit()
-        conn.close()
+        contract_hash = hash_value.encode("hex")
+        with ListingsStore.lock:
+            listings = self._get_cache()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''DELETE FROM listings WHERE contractHash=?''', (contract_hash,))
+                conn.commit()
+            conn.close()
+            if listings.pop(contract_hash, None) is not None:
+                ListingsStore.responses.pop(self.PATH, None)
 
     def delete_all_listings(self):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''DELETE FROM listings''')
-            conn.commit()
-        conn.close()
+        with ListingsStore.lock:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''DELETE FROM listings''')
+                conn.commit()
+            conn.close()
+            ListingsStore.cache[self.PATH] = OrderedDict()
+            ListingsStore.responses.pop(self.PATH, None)
 
-    def get_proto(self):
+    def get_listing(self, hash_value):
+        """
+        Returns the serialized `ListingMetadata` for this contract hash or None.
+        """
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
-        cursor.execute('''SELECT serializedListings FROM listings WHERE id = 1''')
+        cursor.execute('''SELECT serializedListing FROM listings WHERE contractHash=?''',
+                       (hash_value.encode("hex"),))
         ret = cursor.fetchone()
         conn.close()
         if ret is None:
             return None
         return ret[0]
 
+    def get_proto(self, include_hidden=True):
+        """
+        Returns the serialized `Listings` object.
+
+        Args:
+            include_hidden: set to False to leave out listings the vendor has hidden.
+        """
+        with ListingsStore.lock:
+            responses = ListingsStore.responses.setdefault(self.PATH, {})
+            if include_hidden not in responses:
+                listings = self._get_cache()
+                responses[include_hidden] = "".join(frame for frame, hidden in listings.itervalues()
+                                                    if include_hidden or not hidden)
+            return responses[include_hidden]
+
 
 class KeyStore(object):
     """
-    Stores the keys for this node.
+    Stores the keys for this node. Keys are cached in memory once they have been
+    read, and the cache is updated as they are set.
     """
 
+    # database path -> key type -> (privkey, pubkey) or None
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, database_path):
         self.PATH = database_path
 
+    @staticmethod
+    def clear_cache(database_path):
+        with KeyStore.lock:
+            KeyStore.cache.pop(database_path, None)
+
     def set_key(self, key_type, privkey, pubkey):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR REPLACE INTO keys(type, privkey, pubkey)
+        with KeyStore.lock:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO keys(type, privkey, pubkey)
                           VALUES (?,?,?)''', (key_type, privkey, pubkey))
-            conn.commit()
-        conn.close()
+                conn.commit()
+            conn.close()
+            KeyStore.cache.setdefault(self.PATH, {})[key_type] = (privkey, pubkey)
 
     def get_key(self, key_type):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT privkey, pubkey FROM keys WHERE type=?''', (key_type,))
-        ret = cursor.fetchone()
-        conn.close()
-        if not ret:
-            return None
-        else:
+        with KeyStore.lock:
+            keys = KeyStore.cache.setdefault(self.PATH, {})
+            if key_type in keys:
+                return keys[key_type]
+            conn = Database.connect_database(self.PATH)
+            cursor = conn.cursor()
+            cursor.execute('''SELECT privkey, pubkey FROM keys WHERE type=?''', (key_type,))
+            ret = cursor.fetchone()
+            conn.close()
+            if not ret:
+                ret = None
+            keys[key_type] = ret
             return ret
 
     def delete_all_keys(self):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''DELETE FROM keys''')
-            conn.commit()
-        conn.close()
+        with KeyStore.lock:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''DELETE FROM keys''')
+                conn.commit()
+            conn.close()
+            KeyStore.cache.pop(self.PATH, None)
 
 
 class FollowData(object):
     """
     A class for saving and retrieving follower and following data
-    for this node.
+    for this node. The users we follow are stored one row per guid and the
+    serialized `Following` object we send in response to GET_FOLLOWING is
+    cached in memory and kept up to date as users are followed and unfollowed.
     """
 
+    # database path -> OrderedDict of hex guid -> serialized `Following` containing just that user
+    cache = {}
+    # database path -> serialized `Following`, dropped whenever a user is followed or unfollowed
+    responses = {}
+    # database path -> number of rows in the followers table
+    follower_counts = {}
+    lock = threading.Lock()
+
     def __init__(self, database_path):
         self.PATH = database_path
 
     def follow(self, proto):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
+        guid = proto.guid.encode("hex")
+        ser = proto.SerializeToString()
+        with FollowData.lock:
+            following = self._get_cache()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO following(guid, serializedUser) VALUES (?,?)''',
+                               (guid, ser))
+                conn.commit()
+            conn.close()
+            following.pop(guid, None)
             f = Following()
-            ser = self.get_following()
-            if ser is not None:
-                f.ParseFromString(ser)
-                for user in f.users:
-                    if user.guid == proto.guid:
-                        f.users.remove(user)
-            f.users.extend([proto])
-            cursor.execute('''INSERT OR REPLACE INTO following(id, serializedFollowing) VALUES (?,?)''',
-                           (1, f.SerializeToString()))
-            conn.commit()
-        conn.close()
+            f.users.add().MergeFromString(ser)
+            following[guid] = f.SerializeToString()
+            FollowData.responses.pop(self.PATH, None)
 
     def unfollow(self, guid):
-        conn = Database.connect_database(self.PATH)
-        with conn:
+        guid = guid.encode("hex")
+        with FollowData.lock:
+            following = self._get_cache()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''DELETE FROM following WHERE guid=?''', (guid,))
+                conn.commit()
+            conn.close()
+            if following.pop(guid, None) is not None:
+                FollowData.responses.pop(self.PATH, None)
+
+    @staticmethod
+    def clear_cache(database_path):
+        with FollowData.lock:
+            FollowData.cache.pop(database_path, None)
+            FollowData.responses.pop(database_path, None)
+            FollowData.follower_counts.pop(database_path, None)
+
+    def _get_cache(self):
+        following = FollowData.cache.get(self.PATH)
+        if following is None:
+            following = OrderedDict()
+            conn = Database.connect_database(self.PATH)
             cursor = conn.cursor()
-            f = Following()
-            ser = self.get_following()
-            if ser is not None:
-                f.ParseFromString(ser)
-                for user in f.users:
-                    if user.guid == guid:
-                        f.users.remove(user)
-            cursor.execute('''INSERT OR REPLACE INTO following(id, serializedFollowing) VALUES (?,?)''',
-                           (1, f.SerializeToString()))
-            conn.commit()
-        conn.close()
+            cursor.execute('''SELECT guid, serializedUser FROM following ORDER BY rowid''')
+            for guid, ser in cursor.fetchall():
+                f = Following()
+                f.users.add().MergeFromString(ser)
+                following[guid] = f.SerializeToString()
+            conn.close()
+            FollowData.cache[self.PATH] = following
+        return following
 
     def get_following(self):
+        """
+        Returns the serialized `Following` object for all the users we follow.
+        """
+        with FollowData.lock:
+            if self.PATH not in FollowData.responses:
+                FollowData.responses[self.PATH] = "".join(self._get_cache().itervalues())
+            return FollowData.responses[self.PATH]
+
+    def get_following_guids(self):
+        with FollowData.lock:
+            return [guid.decode("hex") for guid in self._get_cache()]
+
+    def get_user(self, guid):
+        """
+        Returns the serialized `Following.User` for this guid or None if we don't follow it.
+        """
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
-        cursor.execute('''SELECT serializedFollowing FROM following WHERE id=1''')
-        ret = cursor.fetchall()
+        cursor.execute('''SELECT serializedUser FROM following WHERE guid=?''', (guid.encode("hex"),))
+        ret = cursor.fetchone()
         conn.close()
-        if not ret:
+        if ret is None:
             return None
-        else:
-            return ret[0][0]
+        return ret[0]
 
     def is_following(self, guid):
-        f = Following()
-        ser = self.get_following()
-        if ser is not None:
-            f.ParseFromString(ser)
-            for user in f.users:
-                if user.guid == guid:
-                    return True
-        return False
+        with FollowData.lock:
+            return guid.encode("hex") in self._get_cache()
 
     def set_follower(self, proto):
-        conn = Database.connect_database(self.PATH)
         p = Followers.Follower()
         p.ParseFromString(proto)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR REPLACE INTO followers(guid, serializedFollower) VALUES (?,?)''',
-                           (p.guid.encode("hex"), proto.encode("hex")))
-            conn.commit()
-        conn.close()
+        guid = p.guid.encode("hex")
+        with FollowData.lock:
+            count = self.get_follower_count()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''SELECT 1 FROM followers WHERE guid=?''', (guid,))
+                if cursor.fetchone() is None:
+                    count += 1
+                cursor.execute('''INSERT OR REPLACE INTO followers(guid, serializedFollower) VALUES (?,?)''',
+                               (guid, proto.encode("hex")))
+                conn.commit()
+            conn.close()
+            FollowData.follower_counts[self.PATH] = count
 
     def delete_follower(self, guid):
-        conn = Database.connect_database(self.PATH)
-        with conn:
+        with FollowData.lock:
+            count = self.get_follower_count()
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''DELETE FROM followers WHERE guid=?''', (guid.encode("hex"), ))
+                count -= cursor.rowcount
+                conn.commit()
+            conn.close()
+            FollowData.follower_counts[self.PATH] = count
+
+    def get_follower_count(self):
+        count = FollowData.follower_counts.get(self.PATH)
+        if count is None:
+            conn = Database.connect_database(self.PATH)
             cursor = conn.cursor()
-            cursor.execute('''DELETE FROM followers WHERE guid=?''', (guid.encode("hex"), ))
-            conn.commit()
-        conn.close()
+            cursor.execute('''SELECT Count(*) FROM followers''')
+            count = cursor.fetchone()[0]
+            conn.close()
+            FollowData.follower_counts[self.PATH] = count
+        return count
 
     def get_followers(self, start=0):
+        """
+        Returns a page of followers, most recent first, as a `tuple` of the
+        serialized `Followers` object, the total number of followers and an
+        opaque cursor for the next page, which is None on the last page.
+
+        Args:
+            start: the cursor returned with the previous page. Older nodes send
+                the number of followers to skip instead, which still works but
+                gets slower the further into the list it goes.
+        """
+        start = str(start)
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
-
-        cursor.execute('''SELECT Count(*) FROM followers''')
-        count = cursor.fetchone()[0]
+        if start.startswith(FOLLOWERS_CURSOR_PREFIX):
+            cursor.execute('''SELECT rowid, serializedFollower FROM followers WHERE rowid<?
+                              ORDER BY rowid DESC LIMIT ?''',
+                           (int(start[len(FOLLOWERS_CURSOR_PREFIX):]), FOLLOWERS_PER_PAGE + 1))
+        else:
+            cursor.execute('''SELECT rowid, serializedFollower FROM followers ORDER BY rowid DESC
+                              LIMIT ? OFFSET ?''', (FOLLOWERS_PER_PAGE + 1, int(start)))
+        rows = cursor.fetchall()
+        conn.close()
 
         f = Followers()
-        if count > 0:
-            smt = '''select serializedFollower from followers order by rowid desc limit 30 offset ''' + str(start)
-            cursor.execute(smt)
-            serialized_followers = cursor.fetchall()
-            conn.close()
-            for proto in serialized_followers:
-                p = Followers.Follower()
-                p.ParseFromString(proto[0].decode("hex"))
-                f.followers.extend([p])
-        return (f.SerializeToString(), count)
+        for rowid, proto in rows[:FOLLOWERS_PER_PAGE]:
+            f.followers.add().MergeFromString(proto.decode("hex"))
+        next_page = None
+        if len(rows) > FOLLOWERS_PER_PAGE:
+            next_page = FOLLOWERS_CURSOR_PREFIX + str(rows[FOLLOWERS_PER_PAGE - 1][0])
+        with FollowData.lock:
+            count = self.get_follower_count()
+        return (f.SerializeToString(), count, next_page)
 
 
 class MessageStore(object):
     """
     Stores all of the chat messages for this node and allows retrieval of
-    messages and conversations as well as marking as read.
+    messages and conversations as well as marking as read. A summary of each
+    chat conversation is kept up to date in the conversations table as
+    messages are saved and read, so listing them doesn't touch the messages.
     """
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
 
     def save_message(self, guid, handle, pubkey, subject, message_type, message,
                      timestamp, avatar_hash, signature, is_outgoing, msg_id=None):
         """
-        Store message in database.
+        Queue the message to be stored in the database. Returns False if a message
+        with this id has already been saved.
         """
         try:
+            outgoing = 1 if is_outgoing else 0
+            msgID = digest(message + str(timestamp)).encode("hex") if msg_id is None else msg_id
+            if self.queue.get("messages", msgID) is not None:
+                return False
             conn = Database.connect_database(self.PATH)
-            with conn:
-                outgoing = 1 if is_outgoing else 0
-                msgID = digest(message + str(timestamp)).encode("hex") if msg_id is None else msg_id
-                cursor = conn.cursor()
+            cursor = conn.cursor()
+            cursor.execute('''SELECT msgID FROM messages WHERE msgID=?''', (msgID,))
+            exists = cursor.fetchone() is not None
+            conn.close()
+            if exists:
+                return False
+            row = (msgID, guid, handle, pubkey, subject, message_type, message, timestamp, avatar_hash,
+                   signature, outgoing, 0)
+
+            def write(cursor):
                 cursor.execute('''INSERT INTO messages(msgID, guid, handle, pubkey, subject,
         messageType, message, timestamp, avatarHash, signature, outgoing, read) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''',
-                               (msgID, guid, handle, pubkey, subject, message_type,
-                                message, timestamp, avatar_hash, signature, outgoing, 0))
-                conn.commit()
-            conn.close()
+                               row)
+                if message_type == "CHAT":
+                    self._update_conversation(cursor, guid, handle, pubkey, subject, message,
+                                              timestamp, avatar_hash, is_outgoing)
+                    SearchIndex._index(cursor, "message", msgID, handle, message, guid)
+            self.queue.put(write, "messages", msgID, row)
             return True
         except Exception:
             return False
 
+    @staticmethod
+    def _update_conversation(cursor, guid, handle, pubkey, subject, message, timestamp, avatar_hash, is_outgoing):
+        # the summary is sanitized once here rather than every time the chat list is loaded
+        handle = sanitize_html(handle)
+        message = sanitize_html(message)
+        cursor.execute('''INSERT OR IGNORE INTO conversations(guid, handle, pubkey, lastMessage, timestamp,
+    avatarHash, unread) VALUES (?,?,?,?,?,?,0)''', (guid, handle, pubkey, message, timestamp, avatar_hash))
+        # messages can arrive out of order so only a newer one replaces the last message
+        cursor.execute('''UPDATE conversations SET handle=COALESCE(NULLIF(?, ''), handle), pubkey=?,
+    lastMessage=?, timestamp=?, avatarHash=COALESCE(NULLIF(?, ''), avatarHash) WHERE guid=? AND timestamp<=?''',
+                       (handle, pubkey, message, timestamp, avatar_hash, guid, timestamp))
+        if not is_outgoing and subject == "":
+            cursor.execute('''UPDATE conversations SET unread=unread+1 WHERE guid=?''', (guid,))
+
+    def update_conversation_profile(self, guid, handle, avatar_hash):
+        """
+        Updates the handle and avatar shown for a conversation, if there is one
+        with this guid, after downloading the user's profile.
+        """
+        self.queue.sync()
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''UPDATE conversations SET handle=?, avatarHash=? WHERE guid=?''',
+                           (sanitize_html(handle), avatar_hash, guid))
+            conn.commit()
+        conn.close()
+
     def get_messages(self, guid, message_type, msgID=None, limit=20):
         """
         Return all messages matching guid and message_type.
         """
+        self.queue.sync()
         if msgID == None:
             timestamp = 4294967295
         else:
@@ -597,6 +1172,7 @@ WHERE guid=? AND messageType=? AND timestamp<? ORDER BY timestamp DESC LIMIT 20'
         """
         Return all messages matching guid and message_type.
         """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT guid, handle, pubkey, subject, messageType, message, timestamp,
@@ -611,50 +1187,32 @@ avatarHash, signature, outgoing, read FROM messages WHERE subject=? ''',
         Get all 'conversations' composed of messages of type 'CHAT'.
 
         Returns:
-          Array of dictionaries, one element for each guid. Dictionaries
-          include last message only.
+          Array of dictionaries, one element for each guid, most recent first.
+          Dictionaries include last message only. The handle and message were
+          sanitized when they were saved.
         """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
-        cursor.execute('''SELECT DISTINCT guid FROM messages''',)
-        guids = cursor.fetchall()
+        cursor.execute('''SELECT guid, handle, pubkey, lastMessage, timestamp, avatarHash, unread
+FROM conversations ORDER BY timestamp DESC''')
         ret = []
-        unread = self.get_unread()
-        for g in guids:
-            cursor.execute('''SELECT avatarHash, message, max(timestamp), pubkey FROM messages
-WHERE guid=? and messageType=?''', (g[0], "CHAT"))
-            val = cursor.fetchone()
-            avatar_hash = None
-            handle = ""
-            if val[0] is not None:
-                try:
-                    with open(join(DATA_FOLDER, 'cache', g[0] + ".profile"), "r") as filename:
-                        profile = filename.read()
-                    p = objects.Profile()
-                    p.ParseFromString(profile)
-                    avatar_hash = p.avatar_hash.encode("hex")
-                    handle = p.handle
-                except Exception:
-                    cursor.execute('''SELECT avatarHash FROM messages
-WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
-                    avi = cursor.fetchone()
-                    if avi[0] is not None:
-                        avatar_hash = avi[0].encode("hex")
-
-                ret.append({"guid": g[0],
-                            "avatar_hash": avatar_hash,
-                            "handle": handle,
-                            "last_message": val[1],
-                            "timestamp": val[2],
-                            "public_key": val[3].encode("hex"),
-                            "unread": 0 if g[0] not in unread else unread[g[0]]})
-        conn.close()
-        return sanitize_html(ret)
+        for guid, handle, pubkey, message, timestamp, avatar_hash, unread in cursor.fetchall():
+            ret.append({"guid": guid,
+                        "avatar_hash": avatar_hash.encode("hex") if avatar_hash else None,
+                        "handle": handle,
+                        "last_message": message,
+                        "timestamp": timestamp,
+                        "public_key": pubkey.encode("hex"),
+                        "unread": unread})
+        conn.close()
+        return ret
 
     def get_unread(self):
         """
         Get Counter of guids which have unread, incoming messages.
         """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT guid FROM messages WHERE read=0 and outgoing=0 and subject=""''',)
@@ -666,6 +1224,7 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         return Counter(ret)
 
     def get_timestamp(self, msgID):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT timestamp FROM messages WHERE msgID=? and messageType=?''', (msgID, "CHAT"))
@@ -679,10 +1238,12 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         """
         Mark all messages for guid as read.
         """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
             cursor.execute('''UPDATE messages SET read=? WHERE guid=?;''', (1, guid))
+            cursor.execute('''UPDATE conversations SET unread=0 WHERE guid=?''', (guid,))
             conn.commit()
         conn.close()
 
@@ -690,10 +1251,13 @@ WHERE guid=? and messageType=? and avatarHash NOT NULL''', (g[0], "CHAT"))
         """
         Delete all messages of type 'CHAT' for guid.
         """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM messages WHERE guid=? AND messageType="CHAT"''', (guid, ))
+            cursor.execute('''DELETE FROM conversations WHERE guid=?''', (guid, ))
+            SearchIndex._remove(cursor, "message", ref=guid)
         conn.commit()
         conn.close()
 
@@ -705,28 +1269,38 @@ class NotificationStore(object):
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
 
     def save_notification(self, notif_id, guid, handle, notif_type, order_id, title, timestamp, image_hash):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
+        row = (notif_id, guid, handle, notif_type, order_id, title, timestamp, image_hash, 0)
+
+        def write(cursor):
             cursor.execute('''INSERT INTO notifications(notifID, guid, handle, type, orderId, title, timestamp,
-imageHash, read) VALUES (?,?,?,?,?,?,?,?,?)''', (notif_id, guid, handle, notif_type, order_id, title, timestamp,
-                                                 image_hash, 0))
-            conn.commit()
-        conn.close()
+imageHash, read) VALUES (?,?,?,?,?,?,?,?,?)''', row)
+        self.queue.put(write, "notifications", notif_id, row)
 
-    def get_notifications(self, notif_id, limit):
+    def get_notifications(self, notif_id, limit, unread_only=False):
+        """
+        Returns up to `limit` notifications, oldest first, going back from the one
+        with id `notif_id`, or from the latest if there is no such notification.
+        """
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         start = self.get_row(notif_id)
-        cursor.execute('''SELECT notifID, guid, handle, type, orderId, title, timestamp,
-imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, start-limit))
-        ret = cursor.fetchall()
+        # notifications can be deleted so the rowids aren't contiguous
+        if unread_only:
+            cursor.execute('''SELECT notifID, guid, handle, type, orderId, title, timestamp,
+imageHash, read FROM notifications WHERE read=0 AND rowid<=? ORDER BY rowid DESC LIMIT ?''', (start, limit))
+        else:
+            cursor.execute('''SELECT notifID, guid, handle, type, orderId, title, timestamp,
+imageHash, read FROM notifications WHERE rowid<=? ORDER BY rowid DESC LIMIT ?''', (start, limit))
+        ret = cursor.fetchall()[::-1]
         conn.close()
         return ret
 
     def get_row(self, notif_id):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT MAX(rowid) FROM notifications''')
@@ -739,6 +1313,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         return max_row if not ret else ret[0]
 
     def mark_as_read(self, notif_id):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
@@ -747,6 +1322,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         conn.close()
 
     def get_unread_count(self):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT notifID FROM notifications WHERE read=?''', (0, ))
@@ -755,6 +1331,7 @@ imageHash, read FROM notifications WHERE rowid <=? AND rowid > ?''', (start, sta
         return len(ret)
 
     def delete_notification(self, notif_id):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
@@ -770,17 +1347,18 @@ class BroadcastStore(object):
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
 
     def save_broadcast(self, broadcast_id, guid, handle, message, timestamp, avatar_hash):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
+        row = (broadcast_id, guid, handle, message, timestamp, avatar_hash)
+
+        def write(cursor):
             cursor.execute('''INSERT INTO broadcasts(id, guid, handle, message, timestamp, avatarHash)
-    VALUES (?,?,?,?,?,?)''', (broadcast_id, guid, handle, message, timestamp, avatar_hash))
-            conn.commit()
-        conn.close()
+    VALUES (?,?,?,?,?,?)''', row)
+        self.queue.put(write, "broadcasts", broadcast_id, row)
 
     def get_broadcasts(self):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT id, guid, handle, message, timestamp, avatarHash FROM broadcasts''')
@@ -789,6 +1367,7 @@ class BroadcastStore(object):
         return ret
 
     def delete_broadcast(self, broadcast_id):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
@@ -805,18 +1384,47 @@ class VendorStore(object):
     def __init__(self, database_path):
         self.PATH = database_path
 
-    def save_vendor(self, guid, serialized_node):
+    def save_vendor(self, guid, serialized_node, last_seen=0, score=0.5):
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
             try:
-                cursor.execute('''INSERT OR REPLACE INTO vendors(guid, serializedNode)
-    VALUES (?,?)''', (guid, serialized_node))
+                cursor.execute('''INSERT OR REPLACE INTO vendors(guid, serializedNode, lastSeen, score)
+    VALUES (?,?,?,?)''', (guid, serialized_node, last_seen, score))
             except Exception as e:
                 print e.message
             conn.commit()
         conn.close()
 
+    def save_vendors(self, vendors):
+        """
+        Saves a batch of vendors in a single transaction.
+
+        Args:
+            vendors: a list of (guid, serialized_node, last_seen, score) `tuple`s.
+        """
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''INSERT OR REPLACE INTO vendors(guid, serializedNode, lastSeen, score)
+    VALUES (?,?,?,?)''', vendors)
+            conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _parse_node(serialized_node):
+        proto = objects.Node()
+        proto.ParseFromString(serialized_node)
+        return Node(proto.guid,
+                    proto.nodeAddress.ip,
+                    proto.nodeAddress.port,
+                    proto.publicKey,
+                    None if not proto.HasField("relayAddress") else
+                    (proto.relayAddress.ip, proto.relayAddress.port),
+                    proto.natType,
+                    proto.vendor,
+                    [(r.ip, r.port) for r in proto.backupRelayAddresses])
+
     def get_vendors(self):
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
@@ -825,22 +1433,32 @@ class VendorStore(object):
         nodes = {}
         for n in ret:
             try:
-                proto = objects.Node()
-                proto.ParseFromString(n[0])
-                node = Node(proto.guid,
-                            proto.nodeAddress.ip,
-                            proto.nodeAddress.port,
-                            proto.publicKey,
-                            None if not proto.HasField("relayAddress") else
-                            (proto.relayAddress.ip, proto.relayAddress.port),
-                            proto.natType,
-                            proto.vendor)
+                node = self._parse_node(n[0])
                 nodes[node.id] = node
             except Exception, e:
                 print e.message
         conn.close()
         return nodes
 
+    def get_vendor_records(self, limit):
+        """
+        Returns up to `limit` of the most recently seen vendors as a list of
+        (node, last_seen, score) `tuple`s, least recently seen first.
+        """
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        cursor.execute('''SELECT serializedNode, lastSeen, score FROM vendors ORDER BY lastSeen DESC
+    LIMIT ?''', (limit,))
+        ret = cursor.fetchall()
+        conn.close()
+        records = []
+        for n in reversed(ret):
+            try:
+                records.append((self._parse_node(n[0]), n[1] or 0, n[2] if n[2] is not None else 0.5))
+            except Exception, e:
+                print e.message
+        return records
+
     def delete_vendor(self, guid):
         conn = Database.connect_database(self.PATH)
         with conn:
@@ -849,6 +1467,14 @@ class VendorStore(object):
             conn.commit()
         conn.close()
 
+    def delete_vendors(self, guids):
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('''DELETE FROM vendors WHERE guid=?''', [(guid,) for guid in guids])
+            conn.commit()
+        conn.close()
+
 
 class ModeratorStore(object):
     """
@@ -921,6 +1547,7 @@ class Purchases(object):
 address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''',
                                (order_id, title, description, timestamp, btc, address,
                                 status, thumbnail, vendor, proofSig, contract_type, 0))
+                SearchIndex._index(cursor, "purchase", order_id, title, description, vendor)
             except Exception as e:
                 print e.message
             conn.commit()
@@ -943,6 +1570,7 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM purchases WHERE id=?''', (order_id,))
+            SearchIndex._remove(cursor, "purchase", order_id)
             conn.commit()
         conn.close()
 
@@ -955,6 +1583,14 @@ address, status, thumbnail, vendor, proofSig, contractType, unread) VALUES (?,?,
         conn.close()
         return ret
 
+    def get_page(self, status=None, since=None, until=None, start=None, limit=ORDERS_PER_PAGE, ascending=False):
+        """
+        Returns a page of purchases, in the same form as `get_all`, and the id to
+        start the next page from. See `get_order_page`.
+        """
+        return get_order_page(self.PATH, "purchases", '''title, description, timestamp, btc, status,
+ thumbnail, vendor, contractType, unread, statusChanged''', status, since, until, start, limit, ascending)
+
     def get_unfunded(self):
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
@@ -1050,6 +1686,7 @@ class Sales(object):
 status, thumbnail, buyer, contractType, unread) VALUES (?,?,?,?,?,?,?,?,?,?,?)''',
                                (order_id, title, description, timestamp, btc, address, status,
                                 thumbnail, buyer, contract_type, 0))
+                SearchIndex._index(cursor, "sale", order_id, title, description, buyer)
             except Exception as e:
                 print e.message
             conn.commit()
@@ -1072,6 +1709,7 @@ thumbnail, buyer, contractType, unread FROM sales WHERE id=?''', (order_id,))
         with conn:
             cursor = conn.cursor()
             cursor.execute('''DELETE FROM sales WHERE id=?''', (order_id,))
+            SearchIndex._remove(cursor, "sale", order_id)
             conn.commit()
         conn.close()
 
@@ -1094,6 +1732,14 @@ status=?''', (status,))
         conn.close()
         return ret
 
+    def get_page(self, status=None, since=None, until=None, start=None, limit=ORDERS_PER_PAGE, ascending=False):
+        """
+        Returns a page of sales, in the same form as `get_all`, and the id to
+        start the next page from. See `get_order_page`.
+        """
+        return get_order_page(self.PATH, "sales", '''title, description, timestamp, btc, status,
+thumbnail, buyer, contractType, unread, statusChanged''', status, since, until, start, limit, ascending)
+
     def get_unfunded(self):
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
@@ -1208,6 +1854,14 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
         conn.close()
         return ret
 
+    def get_page(self, status=None, since=None, until=None, start=None, limit=ORDERS_PER_PAGE, ascending=False):
+        """
+        Returns a page of cases, in the same form as `get_all`, and the id to
+        start the next page from. See `get_order_page`.
+        """
+        return get_order_page(self.PATH, "cases", '''title, timestamp, orderDate, btc, thumbnail,
+buyer, vendor, validation, claim, status, unread, statusChanged''', status, since, until, start, limit, ascending)
+
     def update_unread(self, order_id, reset=False):
         conn = Database.connect_database(self.PATH)
         with conn:
@@ -1249,23 +1903,92 @@ buyer, vendor, validation, claim, status, unread, statusChanged FROM cases ''')
 
 class Ratings(object):
     """
-    Store ratings for each contract in the db.
+    Store ratings for each contract in the db. The number of ratings, the sum
+    of the scores in each category and how many ratings gave each number of
+    stars are kept for every listing so the score can be shown without loading
+    the ratings themselves.
     """
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
 
     def add_rating(self, listing_hash, rating):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            rating_id = digest(rating).encode("hex")
-            cursor = conn.cursor()
+        scores = rating_scores(rating)
+        rating_id = digest(rating).encode("hex")
+
+        def write(cursor):
             cursor.execute('''INSERT INTO ratings(listing, ratingID, rating) VALUES (?,?,?)''',
                            (listing_hash, rating_id, rating))
-            conn.commit()
+            cursor.execute('''INSERT OR IGNORE INTO rating_aggregates(listing, count, feedback, quality,
+    description, deliveryTime, customerService, oneStar, twoStars, threeStars, fourStars, fiveStars)
+    VALUES (?,0,0,0,0,0,0,0,0,0,0,0)''', (listing_hash,))
+            stars = [1 if scores[0] == n else 0 for n in range(1, 6)]
+            cursor.execute('''UPDATE rating_aggregates SET count=count+1, feedback=feedback+?, quality=quality+?,
+    description=description+?, deliveryTime=deliveryTime+?, customerService=customerService+?, oneStar=oneStar+?,
+    twoStars=twoStars+?, threeStars=threeStars+?, fourStars=fourStars+?, fiveStars=fiveStars+? WHERE listing=?''',
+                           tuple(scores) + tuple(stars) + (listing_hash,))
+        self.queue.put(write, "ratings", rating_id, (listing_hash, rating_id, rating))
+
+    def get_aggregate(self, listing_hash=None):
+        """
+        Returns a `dict` with the number of ratings for the listing, the sum of the
+        scores in each of the RATING_CATEGORIES and how many ratings gave one to five
+        stars for feedback. The ratings of all listings are combined if `listing_hash`
+        is None.
+        """
+        self.queue.sync()
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        columns = '''SUM(count), SUM(feedback), SUM(quality), SUM(description), SUM(deliveryTime),
+    SUM(customerService), SUM(oneStar), SUM(twoStars), SUM(threeStars), SUM(fourStars), SUM(fiveStars)'''
+        if listing_hash is None:
+            cursor.execute('''SELECT ''' + columns + ''' FROM rating_aggregates''')
+        else:
+            cursor.execute('''SELECT ''' + columns + ''' FROM rating_aggregates WHERE listing=?''',
+                           (listing_hash,))
+        row = [value or 0 for value in cursor.fetchone()]
+        conn.close()
+        return {
+            "count": row[0],
+            "sums": dict(zip(RATING_CATEGORIES, row[1:6])),
+            "stars": row[6:11]
+        }
+
+    def get_ratings_page(self, listing_hash=None, start=None, limit=RATINGS_PER_PAGE):
+        """
+        Returns a `tuple` of up to `limit` ratings, oldest first, and the id of the
+        last one to pass as `start` for the next page, which is None on the last
+        page. An unknown `start` returns no ratings.
+
+        Args:
+            listing_hash: the listing to return ratings for or None for all listings.
+            start: the id of the last rating on the previous page.
+        """
+        self.queue.sync()
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        row_id = 0
+        if start:
+            cursor.execute('''SELECT rowid FROM ratings WHERE ratingID=?''', (start, ))
+            row = cursor.fetchone()
+            if row is None:
+                conn.close()
+                return [], None
+            row_id = row[0]
+        if listing_hash is None:
+            cursor.execute('''SELECT ratingID, rating FROM ratings WHERE rowid>? ORDER BY rowid LIMIT ?''',
+                           (row_id, limit + 1))
+        else:
+            cursor.execute('''SELECT ratingID, rating FROM ratings WHERE listing=? AND rowid>? ORDER BY rowid
+    LIMIT ?''', (listing_hash, row_id, limit + 1))
+        rows = cursor.fetchall()
         conn.close()
+        next_page = rows[limit - 1][0] if len(rows) > limit else None
+        return [rating for rating_id, rating in rows[:limit]], next_page
 
     def get_listing_ratings(self, listing_hash, starting_id=None):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         if starting_id is None:
@@ -1287,6 +2010,7 @@ class Ratings(object):
                 return ret
 
     def get_all_ratings(self, starting_id=None):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         if starting_id is None:
@@ -1343,75 +2067,174 @@ class Transactions(object):
 
 class Settings(object):
     """
-    Stores the UI settings.
+    Stores the UI settings. The settings and credentials rows are cached in memory
+    and read again from the database after every change, and the moderator list
+    is only parsed once after each change.
     """
 
+    # database path -> row id -> row, and "moderators" -> parsed moderator list
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, database_path):
         self.PATH = database_path
 
+    @staticmethod
+    def clear_cache(database_path):
+        with Settings.lock:
+            Settings.cache.pop(database_path, None)
+
+    def _get_row(self, row_id, columns):
+        """Returns a settings row, reading it if it isn't cached. Call with the lock held."""
+        rows = Settings.cache.setdefault(self.PATH, {})
+        if row_id not in rows:
+            conn = Database.connect_database(self.PATH)
+            cursor = conn.cursor()
+            cursor.execute('''SELECT %s FROM settings WHERE id=?''' % columns, (row_id,))
+            rows[row_id] = cursor.fetchone()
+            conn.close()
+        return rows[row_id]
+
     def update(self, refundAddress, currencyCode, country, language, timeZone, notifications,
                shipping_addresses, blocked, terms_conditions, refund_policy, moderator_list, smtp_notifications,
                smtp_server, smtp_sender, smtp_recipient, smtp_username, smtp_password):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR REPLACE INTO settings(id, refundAddress, currencyCode, country,
+        with Settings.lock:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO settings(id, refundAddress, currencyCode, country,
 language, timeZone, notifications, shippingAddresses, blocked, termsConditions,
 refundPolicy, moderatorList, smtpNotifications, smtpServer, smtpSender,
 smtpRecipient, smtpUsername, smtpPassword) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
-                           (1, refundAddress, currencyCode, country, language, timeZone,
-                            notifications, shipping_addresses, blocked, terms_conditions,
-                            refund_policy, moderator_list, smtp_notifications, smtp_server,
-                            smtp_sender, smtp_recipient, smtp_username, smtp_password))
-            conn.commit()
-        conn.close()
+                               (1, refundAddress, currencyCode, country, language, timeZone,
+                                notifications, shipping_addresses, blocked, terms_conditions,
+                                refund_policy, moderator_list, smtp_notifications, smtp_server,
+                                smtp_sender, smtp_recipient, smtp_username, smtp_password))
+                conn.commit()
+            conn.close()
+            Settings.cache.pop(self.PATH, None)
 
     def get(self):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT * FROM settings WHERE id=1''')
-        ret = cursor.fetchone()
-        conn.close()
-        return ret
+        with Settings.lock:
+            return self._get_row(1, "*")
+
+    def get_moderators(self):
+        """
+        Returns the list of guids of the moderators chosen in the settings.
+        """
+        with Settings.lock:
+            rows = Settings.cache.setdefault(self.PATH, {})
+            moderators = rows.get("moderators")
+            if moderators is None:
+                settings = self._get_row(1, "*")
+                try:
+                    moderators = json.loads(settings[11]) if settings is not None and settings[11] else []
+                except ValueError:
+                    moderators = []
+                rows["moderators"] = moderators
+            return list(moderators)
 
     def set_credentials(self, username, password):
-        conn = Database.connect_database(self.PATH)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR REPLACE INTO settings(id, username, password) VALUES (?,?,?)''',
-                           (2, username, password))
-            conn.commit()
-        conn.close()
+        with Settings.lock:
+            conn = Database.connect_database(self.PATH)
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute('''INSERT OR REPLACE INTO settings(id, username, password) VALUES (?,?,?)''',
+                               (2, username, password))
+                conn.commit()
+            conn.close()
+            Settings.cache.pop(self.PATH, None)
 
     def get_credentials(self):
-        conn = Database.connect_database(self.PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT username, password FROM settings WHERE id=2''')
-        ret = cursor.fetchone()
-        conn.close()
-        return ret
+        with Settings.lock:
+            return self._get_row(2, "username, password")
 
 class ShoppingEvents(object):
     """
-    Stores audit events for shoppers on your storefront
+    Stores audit events for shoppers on your storefront. As events are saved they
+    are also counted in the hourly and daily rollup tables, so the number of views
+    and shoppers over time can be read without going through the events.
     """
 
     def __init__(self, database_path):
         self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
 
     def set(self, shopper_guid, action_id, contract_hash=None):
+        event = (shopper_guid, action_id, contract_hash or '', int(time.time()))
+        self.queue.put(lambda cursor: self._add_events(cursor, [event]))
+
+    def add_events(self, events):
+        """
+        Saves a batch of events in one transaction.
+
+        Args:
+            events: a list of (shopper_guid, action_id, contract_hash, timestamp) tuples.
+        """
         conn = Database.connect_database(self.PATH)
         with conn:
             cursor = conn.cursor()
-            timestamp = int(time.time())
-            if not contract_hash:
-                contract_hash = ''
-            cursor.execute('''INSERT INTO audit_shopping(shopper_guid, timestamp, contract_hash, action_id) VALUES
-                              (?,?,?,?)''', (shopper_guid, timestamp, contract_hash, action_id))
+            self._add_events(cursor, [(guid, action_id, contract_hash or '', int(timestamp))
+                                      for guid, action_id, contract_hash, timestamp in events])
             conn.commit()
         conn.close()
 
+    @staticmethod
+    def _add_events(cursor, events):
+        cursor.executemany('''INSERT INTO audit_shopping(shopper_guid, action_id, contract_hash, timestamp)
+    VALUES (?,?,?,?)''', events)
+        now = int(time.time())
+        for resolution, seconds in AUDIT_PERIODS.items():
+            views = Counter()
+            shoppers = set()
+            for guid, action_id, contract_hash, timestamp in events:
+                key = (timestamp - timestamp % seconds, contract_hash, action_id)
+                views[key] += 1
+                shoppers.add(key + (guid,))
+            new_shoppers = Counter()
+            for period, contract_hash, action_id, guid in shoppers:
+                cursor.execute('''INSERT OR IGNORE INTO audit_shoppers(resolution, period, contract_hash,
+    action_id, shopper_guid) VALUES (?,?,?,?,?)''', (resolution, period, contract_hash, action_id, guid))
+                if cursor.rowcount == 1:
+                    new_shoppers[(period, contract_hash, action_id)] += 1
+            for key, count in views.items():
+                cursor.execute('''INSERT OR IGNORE INTO audit_%s(period, contract_hash, action_id, views, shoppers)
+    VALUES (?,?,?,0,0)''' % resolution, key)
+                cursor.execute('''UPDATE audit_%s SET views=views+?, shoppers=shoppers+? WHERE period=? AND
+    contract_hash=? AND action_id=?''' % resolution, (count, new_shoppers[key]) + key)
+            # only the shoppers of the current and previous periods are needed to spot new ones
+            cursor.execute('''DELETE FROM audit_shoppers WHERE resolution=? AND period<?''',
+                           (resolution, now - now % seconds - seconds))
+
+    def get_rollups(self, resolution="daily", contract_hash=None, action_id=None, since=0):
+        """
+        Returns (period, contract_hash, action_id, views, shoppers) rows from the
+        rollup for one of the AUDIT_PERIODS, oldest first. `period` is the time
+        at which the hour or day started and `shoppers` the number of distinct
+        shoppers behind the views. Events without a contract have an empty
+        contract_hash.
+        """
+        if resolution not in AUDIT_PERIODS:
+            raise ValueError("unknown resolution %s" % resolution)
+        self.queue.sync()
+        sql = '''SELECT period, contract_hash, action_id, views, shoppers FROM audit_%s
+    WHERE period>=?''' % resolution
+        args = [since - since % AUDIT_PERIODS[resolution]]
+        if contract_hash is not None:
+            sql += ''' AND contract_hash=?'''
+            args.append(contract_hash)
+        if action_id is not None:
+            sql += ''' AND action_id=?'''
+            args.append(action_id)
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        cursor.execute(sql + ''' ORDER BY period, contract_hash, action_id''', args)
+        ret = cursor.fetchall()
+        conn.close()
+        return ret
+
     def get(self):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
         cursor.execute('''SELECT * FROM audit_shopping''')
@@ -1420,9 +2243,142 @@ class ShoppingEvents(object):
         return ret
 
     def get_events_by_id(self, event_id):
+        self.queue.sync()
         conn = Database.connect_database(self.PATH)
         cursor = conn.cursor()
-        cursor.execute('''SELECT * FROM audit_shopping WHERE event_id=?''', event_id)
+        cursor.execute('''SELECT * FROM audit_shopping WHERE audit_shopping_id=?''', (event_id,))
         ret = cursor.fetchall()
         conn.close()
         return ret
+
+
+class SearchIndex(object):
+    """
+    A full text index over this node's listings, purchases, sales and chat messages
+    so they can be searched without loading every one of them. Documents are added
+    and removed by the stores and the contract as they are saved and deleted, and
+    their text is stripped of markup as it is indexed so the snippets returned are
+    safe to show.
+    """
+
+    # database path -> True if the index is an FTS5 table, which ranks the hits
+    modules = {}
+    lock = threading.Lock()
+
+    def __init__(self, database_path):
+        self.PATH = database_path
+        self.queue = WriteQueue.for_path(database_path)
+
+    @staticmethod
+    def clear_cache(database_path):
+        with SearchIndex.lock:
+            SearchIndex.modules.pop(database_path, None)
+
+    @staticmethod
+    def _index(cursor, kind, key, title, body, ref=None):
+        cursor.execute('''SELECT id FROM search_documents WHERE kind=? AND key=?''', (kind, key))
+        row = cursor.fetchone()
+        if row is not None:
+            doc_id = row[0]
+            cursor.execute('''DELETE FROM search_index WHERE rowid=?''', (doc_id,))
+            cursor.execute('''UPDATE search_documents SET ref=? WHERE id=?''', (ref, doc_id))
+        else:
+            cursor.execute('''INSERT INTO search_documents(kind, key, ref) VALUES (?,?,?)''', (kind, key, ref))
+            doc_id = cursor.lastrowid
+        cursor.execute('''INSERT INTO search_index(rowid, title, body) VALUES (?,?,?)''',
+                       (doc_id, strip_html(title or u""), strip_html(body or u"")))
+
+    @staticmethod
+    def _remove(cursor, kind, key=None, ref=None):
+        if key is not None:
+            where, args = '''kind=? AND key=?''', (kind, key)
+        else:
+            where, args = '''kind=? AND ref=?''', (kind, ref)
+        cursor.execute('''DELETE FROM search_index WHERE rowid IN
+    (SELECT id FROM search_documents WHERE %s)''' % where, args)
+        cursor.execute('''DELETE FROM search_documents WHERE %s''' % where, args)
+
+    def add(self, kind, key, title, body, ref=None):
+        """
+        Indexes a document, replacing what was indexed before under this kind and key.
+
+        Args:
+            kind: one of the SEARCH_KINDS.
+            key: the contract hash, order id or message id of the document.
+            title: the title, or for a message the sender's handle.
+            body: the rest of the text to index.
+            ref: the guid of the other party, if any, returned with the hits.
+        """
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            self._index(cursor, kind, key, title, body, ref)
+            conn.commit()
+        conn.close()
+
+    def remove(self, kind, key):
+        conn = Database.connect_database(self.PATH)
+        with conn:
+            cursor = conn.cursor()
+            self._remove(cursor, kind, key)
+            conn.commit()
+        conn.close()
+
+    def _is_fts5(self, cursor):
+        fts5 = SearchIndex.modules.get(self.PATH)
+        if fts5 is None:
+            cursor.execute('''SELECT sql FROM sqlite_master WHERE name="search_index"''')
+            fts5 = "fts5" in cursor.fetchone()[0].lower()
+            SearchIndex.modules[self.PATH] = fts5
+        return fts5
+
+    @staticmethod
+    def _match_expression(query):
+        # only the words of the query are used, so search operators and quotes
+        # typed by the user can't make the query invalid
+        words = [w.lower() for w in re.findall(r"\w+", smart_unicode(query), re.UNICODE)]
+        if not words:
+            return None
+        # the last word is matched as a prefix so results show up while it is being typed
+        return u" ".join(words) + (u"*" if len(words[-1]) > 1 else u"")
+
+    def search(self, query, kind=None, limit=SEARCH_RESULTS):
+        """
+        Searches the index for documents containing all of the words in `query`.
+
+        Returns:
+            A list of dictionaries with the kind, key, ref, title and a snippet of
+            the matching text, with the matches wrapped in <b> tags. With FTS5 the
+            best matches come first, with matches in the title counting for more,
+            otherwise the most recently indexed come first.
+        """
+        self.queue.sync()
+        match = self._match_expression(query)
+        if match is None:
+            return []
+        conn = Database.connect_database(self.PATH)
+        cursor = conn.cursor()
+        if self._is_fts5(cursor):
+            columns = '''snippet(search_index, -1, '<b>', '</b>', '...', %d),
+    bm25(search_index, 10.0, 1.0) AS score''' % SEARCH_SNIPPET_TOKENS
+        else:
+            columns = '''snippet(search_index, '<b>', '</b>', '...', -1, %d),
+    -search_index.rowid AS score''' % SEARCH_SNIPPET_TOKENS
+        sql = '''SELECT d.kind, d.key, d.ref, search_index.title, %s FROM search_index
+    JOIN search_documents d ON d.id=search_index.rowid WHERE search_index MATCH ?''' % columns
+        args = [match]
+        if kind is not None:
+            sql += ''' AND d.kind=?'''
+            args.append(kind)
+        sql += ''' ORDER BY score LIMIT ?'''
+        args.append(limit)
+        cursor.execute(sql, args)
+        ret = []
+        for kind, key, ref, title, snippet, _ in cursor.fetchall():
+            ret.append({"kind": kind,
+                        "key": key,
+                        "ref": ref,
+                        "title": title,
+                        "snippet": snippet})
+        conn.close()
+        return ret
@@ -0,0 +1,31 @@
+import sqlite3
+from protos import objects
+
+
+def migrate(database_path):
+    print "migrating to db version 10"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+    # read the users we follow from db
+    cursor.execute('''SELECT serializedFollowing FROM following WHERE id=1''')
+    following = cursor.fetchone()
+
+    # delete following table
+    cursor.execute('''DROP TABLE following''')
+
+    # create new table
+    cursor.execute('''CREATE TABLE following(guid TEXT PRIMARY KEY, serializedUser BLOB)''')
+
+    # write the users back into db
+    if following is not None:
+        f = objects.Following()
+        f.ParseFromString(following[0])
+        for user in f.users:
+            cursor.execute('''INSERT OR REPLACE INTO following(guid, serializedUser) VALUES (?,?)''',
+                           (user.guid.encode("hex"), user.SerializeToString()))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 10''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,36 @@
+import sqlite3
+from api.utils import sanitize_html
+
+
+def migrate(database_path):
+    print "migrating to db version 11"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # keep a summary of each chat conversation so the chat list doesn't have to scan the messages
+    cursor.execute('''CREATE TABLE IF NOT EXISTS conversations(guid TEXT PRIMARY KEY, handle TEXT, pubkey BLOB,
+    lastMessage TEXT, timestamp INTEGER, avatarHash BLOB, unread INTEGER)''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS index_conversations_timestamp ON conversations(timestamp);''')
+
+    # fill it in from the existing messages, the bare columns come from the latest message of each guid
+    cursor.execute('''INSERT OR REPLACE INTO conversations(guid, handle, pubkey, lastMessage, timestamp,
+    avatarHash, unread) SELECT guid, handle, pubkey, message, max(timestamp), avatarHash, 0 FROM messages
+    WHERE messageType="CHAT" GROUP BY guid''')
+    cursor.execute('''UPDATE conversations SET
+    handle=(SELECT handle FROM messages WHERE messages.guid=conversations.guid AND messageType="CHAT"
+            AND handle!="" ORDER BY timestamp DESC LIMIT 1),
+    avatarHash=(SELECT avatarHash FROM messages WHERE messages.guid=conversations.guid AND messageType="CHAT"
+                AND avatarHash!="" ORDER BY timestamp DESC LIMIT 1),
+    unread=(SELECT Count(*) FROM messages WHERE messages.guid=conversations.guid AND read=0 AND outgoing=0
+            AND subject="")''')
+    cursor.execute('''UPDATE conversations SET handle="" WHERE handle IS NULL''')
+    cursor.execute('''SELECT guid, handle, lastMessage FROM conversations''')
+    for guid, handle, message in cursor.fetchall():
+        cursor.execute('''UPDATE conversations SET handle=?, lastMessage=? WHERE guid=?''',
+                       (sanitize_html(handle), sanitize_html(message), guid))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 11''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,37 @@
+import sqlite3
+
+
+def migrate(database_path):
+    # imported here as db.datastore imports the migrations
+    from db.datastore import rating_scores
+
+    print "migrating to db version 12"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # keep the number of ratings and their scores for each listing
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rating_aggregates(listing TEXT PRIMARY KEY, count INTEGER,
+    feedback INTEGER, quality INTEGER, description INTEGER, deliveryTime INTEGER, customerService INTEGER,
+    oneStar INTEGER, twoStars INTEGER, threeStars INTEGER, fourStars INTEGER, fiveStars INTEGER)''')
+
+    # add up the existing ratings
+    aggregates = {}
+    cursor.execute('''SELECT listing, rating FROM ratings''')
+    for listing, rating in cursor.fetchall():
+        scores = rating_scores(rating)
+        aggregate = aggregates.setdefault(listing, [0] * 11)
+        aggregate[0] += 1
+        for i, score in enumerate(scores):
+            aggregate[i + 1] += score
+        if scores[0] > 0:
+            aggregate[5 + scores[0]] += 1
+    for listing, aggregate in aggregates.items():
+        cursor.execute('''INSERT OR REPLACE INTO rating_aggregates(listing, count, feedback, quality, description,
+    deliveryTime, customerService, oneStar, twoStars, threeStars, fourStars, fiveStars)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?)''', (listing,) + tuple(aggregate))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 12''')
+    conn.commit()
+    conn.close()
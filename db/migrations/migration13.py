@@ -0,0 +1,44 @@
+import json
+import sqlite3
+from config import DATA_FOLDER
+
+
+def migrate(database_path):
+    # imported here as db.datastore imports the migrations
+    from db.datastore import SearchIndex, create_search_index, listing_search_text
+
+    print "migrating to db version 13"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # full text index over the listings, orders and chat messages
+    create_search_index(cursor)
+
+    # index the listings from their contracts on disk
+    cursor.execute('''SELECT hashmap.hash, hashmap.filepath FROM listings
+    JOIN hashmap ON hashmap.hash=listings.contractHash''')
+    for contract_hash, file_path in cursor.fetchall():
+        try:
+            with open(DATA_FOLDER + file_path, "r") as f:
+                title, body = listing_search_text(json.loads(f.read()))
+        except Exception:
+            continue
+        SearchIndex._index(cursor, "listing", contract_hash, title, body)
+
+    cursor.execute('''SELECT id, title, description, vendor FROM purchases''')
+    for order_id, title, description, vendor in cursor.fetchall():
+        SearchIndex._index(cursor, "purchase", order_id, title, description, vendor)
+
+    cursor.execute('''SELECT id, title, description, buyer FROM sales''')
+    for order_id, title, description, buyer in cursor.fetchall():
+        SearchIndex._index(cursor, "sale", order_id, title, description, buyer)
+
+    cursor.execute('''SELECT msgID, handle, message, guid FROM messages WHERE messageType="CHAT"''')
+    for msg_id, handle, message, guid in cursor.fetchall():
+        SearchIndex._index(cursor, "message", msg_id, handle, message, guid)
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 13''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,35 @@
+import sqlite3
+import time
+
+
+def migrate(database_path):
+    # imported here as db.datastore imports the migrations
+    from db.datastore import AUDIT_PERIODS, create_audit_rollups
+
+    print "migrating to db version 14"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # the indexes were declared on the primary key instead of the columns they are named after
+    cursor.execute('''DROP INDEX IF EXISTS shopper_guid_index''')
+    cursor.execute('''DROP INDEX IF EXISTS action_id_index''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS shopper_guid_index ON audit_shopping(shopper_guid);''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS action_id_index ON audit_shopping(action_id, timestamp);''')
+
+    # roll up the existing events by hour and by day
+    create_audit_rollups(cursor)
+    recent = int(time.time()) - 2 * AUDIT_PERIODS["daily"]
+    for resolution, seconds in AUDIT_PERIODS.items():
+        cursor.execute('''INSERT OR REPLACE INTO audit_%s(period, contract_hash, action_id, views, shoppers)
+    SELECT timestamp - timestamp %% ?, contract_hash, action_id, Count(*), Count(DISTINCT shopper_guid)
+    FROM audit_shopping GROUP BY 1, 2, 3''' % resolution, (seconds,))
+        # the shoppers seen in the current periods, so new events only count new shoppers
+        cursor.execute('''INSERT OR IGNORE INTO audit_shoppers(resolution, period, contract_hash, action_id,
+    shopper_guid) SELECT ?, timestamp - timestamp % ?, contract_hash, action_id, shopper_guid
+    FROM audit_shopping WHERE timestamp >= ?''', (resolution, seconds, recent))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 14''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,19 @@
+import sqlite3
+
+
+def migrate(database_path):
+    # imported here as db.datastore imports the migrations
+    from db.datastore import create_order_indexes
+
+    print "migrating to db version 15"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # index the orders and cases by time and by status and time so they can be paged through
+    create_order_indexes(cursor)
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 15''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,19 @@
+import sqlite3
+
+
+def migrate(database_path):
+    print "migrating to db version 8"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+
+    # track when we last heard from each vendor and how reliably it answers
+    cursor.execute('''ALTER TABLE vendors ADD COLUMN "lastSeen" INTEGER''')
+    cursor.execute('''ALTER TABLE vendors ADD COLUMN "score" REAL''')
+    cursor.execute('''UPDATE vendors SET lastSeen = 0, score = 0.5;''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS index_vendors_last_seen ON vendors(lastSeen);''')
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 8''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,33 @@
+import sqlite3
+from protos import objects
+
+
+def migrate(database_path):
+    print "migrating to db version 9"
+    conn = sqlite3.connect(database_path)
+    conn.text_factory = str
+    cursor = conn.cursor()
+    # read listings from db
+    cursor.execute('''SELECT serializedListings FROM listings WHERE id=1''')
+    listings = cursor.fetchone()
+
+    # delete listings table
+    cursor.execute('''DROP TABLE listings''')
+
+    # create new table
+    cursor.execute('''CREATE TABLE listings(contractHash TEXT PRIMARY KEY, serializedListing BLOB,
+    hidden INTEGER)''')
+
+    # write listings back into db
+    if listings is not None:
+        l = objects.Listings()
+        l.ParseFromString(listings[0])
+        for listing in l.listing:
+            cursor.execute('''INSERT OR REPLACE INTO listings(contractHash, serializedListing, hidden)
+                              VALUES (?,?,?)''', (listing.contract_hash.encode("hex"),
+                                                  listing.SerializeToString(), 1 if listing.hidden else 0))
+
+    # update version
+    cursor.execute('''PRAGMA user_version = 9''')
+    conn.commit()
+    conn.close()
@@ -0,0 +1,39 @@
+import os
+import threading
+from twisted.trial import unittest
+
+from db.asyncdb import AsyncDatabase
+from db.datastore import Database
+
+
+class AsyncDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(filepath="test_async.db")
+        self.adb = AsyncDatabase(self.db)
+
+    def tearDown(self):
+        self.adb.stop()
+        self.db.close()
+        os.remove("test_async.db")
+
+    def test_runInteraction(self):
+        def interaction(db, key):
+            db.keys.set_key(key, "privkey", "pubkey")
+            return threading.current_thread().name, db.keys.get_key(key)
+
+        def check(result):
+            thread_name, key = result
+            self.assertNotEqual(thread_name, threading.current_thread().name)
+            self.assertEqual(key, ("privkey", "pubkey"))
+            self.assertEqual(self.adb.get_stats()["queued"], 0)
+            self.assertEqual(self.adb.get_stats()["queries"], 1)
+        return self.adb.runInteraction(interaction, "guid").addCallback(check)
+
+    def test_store_proxy(self):
+        self.db.keys.set_key("guid", "privkey", "pubkey")
+        return self.adb.keys.get_key("guid").addCallback(self.assertEqual, ("privkey", "pubkey"))
+
+    def test_interaction_failure(self):
+        def interaction(db):
+            raise ValueError("failed")
+        return self.assertFailure(self.adb.runInteraction(interaction), ValueError)
@@ -1,7 +1,9 @@
+import json
 import os
+import sqlite3 as lite
 import unittest
 import time
-from db.datastore import Database
+from db.datastore import Database, ListingsStore, FollowData, FOLLOWERS_PER_PAGE
 from dht.utils import digest
 from config import DATA_FOLDER
 from protos.objects import Profile, Listings, Following, Metadata, Followers, Node, FULL_CONE
@@ -70,8 +72,22 @@ class DatastoreTest(unittest.TestCase):
         self.settings = self.db.settings
 
     def tearDown(self):
+        self.db.close()
         os.remove("test.db")
 
+    def test_connection_pool(self):
+        conn = Database.connect_database("test.db")
+        self.assertIs(Database.connect_database("test.db"), conn)
+        self.assertEqual(conn.execute('''PRAGMA journal_mode''').fetchone()[0], "wal")
+
+        # closing a pooled connection discards uncommitted changes but keeps it open
+        conn.execute('''INSERT INTO transactions(tx) VALUES (?)''', ("tx",))
+        conn.close()
+        self.assertEqual(self.db.transactions.get_transactions(), [])
+
+        self.db.close()
+        self.assertIsNot(Database.connect_database("test.db"), conn)
+
     def test_hashmapInsert(self):
         self.hm.insert(self.test_hash, self.test_file)
         f = self.hm.get_file(self.test_hash)
@@ -134,6 +150,41 @@ class DatastoreTest(unittest.TestCase):
         self.ls.delete_all_listings()
         self.assertEqual(None, self.ls.delete_listing(self.test_hash))
 
+    def test_listingsCache(self):
+        self.ls.delete_all_listings()
+        self.ls.add_listing(self.lm)
+        hidden = Listings.ListingMetadata()
+        hidden.contract_hash = self.test_hash2
+        hidden.title = "HIDDEN CONTRACT"
+        hidden.hidden = True
+        self.ls.add_listing(hidden)
+
+        val = Listings()
+        val.ParseFromString(self.ls.get_proto())
+        self.assertEqual([self.lm, hidden], list(val.listing))
+        val = Listings()
+        val.ParseFromString(self.ls.get_proto(include_hidden=False))
+        self.assertEqual([self.lm], list(val.listing))
+
+        # updating a listing moves it to the end
+        self.lm.title = "UPDATED TITLE"
+        self.ls.add_listing(self.lm)
+        val = Listings()
+        val.ParseFromString(Database(filepath="test.db").listings.get_proto())
+        self.assertEqual([hidden, self.lm], list(val.listing))
+
+        val = Listings.ListingMetadata()
+        val.ParseFromString(self.ls.get_listing(self.test_hash2))
+        self.assertEqual(hidden, val)
+        self.ls.delete_listing(self.test_hash2)
+        self.assertIsNone(self.ls.get_listing(self.test_hash2))
+
+        # the cache is rebuilt from the database in the same order
+        ListingsStore.clear_cache("test.db")
+        val = Listings()
+        val.ParseFromString(self.ls.get_proto())
+        self.assertEqual([self.lm], list(val.listing))
+
     def test_setGUIDKey(self):
         self.ks.set_key("guid", "privkey", "signed_privkey")
         key = self.ks.get_key("guid")
@@ -157,11 +208,37 @@ class DatastoreTest(unittest.TestCase):
         self.assertTrue(self.fd.is_following(self.u.guid))
 
         self.fd.unfollow(self.u.guid)
-        self.fd.unfollow(self.f)
+        self.fd.unfollow(self.f.guid)
         following = self.fd.get_following()
         self.assertEqual(following, '')
         self.assertFalse(self.fd.is_following(self.u.guid))
 
+    def test_following_cache(self):
+        u2 = Following.User()
+        u2.guid = '0000000000000000000000000000000002'
+        u2.pubkey = 'pubkey2'
+        self.fd.follow(self.u)
+        self.fd.follow(u2)
+        self.assertEqual(self.fd.get_following_guids(), [self.u.guid, u2.guid])
+
+        val = Following.User()
+        val.ParseFromString(self.fd.get_user(self.u.guid))
+        self.assertEqual(self.u, val)
+        self.assertIsNone(self.fd.get_user('0000000000000000000000000000000003'))
+
+        # following a user again moves it to the end
+        self.fd.follow(self.u)
+        f = Following()
+        f.ParseFromString(self.fd.get_following())
+        self.assertEqual([u2, self.u], list(f.users))
+
+        FollowData.clear_cache("test.db")
+        self.assertTrue(self.fd.is_following(u2.guid))
+        self.fd.unfollow(u2.guid)
+        f = Following()
+        f.ParseFromString(self.fd.get_following())
+        self.assertEqual([self.u], list(f.users))
+
     def test_deleteFollower(self):
         self.fd.set_follower(self.f.SerializeToString())
         self.fd.set_follower(self.f.SerializeToString())
@@ -171,6 +248,30 @@ class DatastoreTest(unittest.TestCase):
         f = self.fd.get_followers()
         self.assertEqual(f[0], '')
 
+    def test_followers_pagination(self):
+        for i in range(FOLLOWERS_PER_PAGE * 2 + 5):
+            self.f.guid = digest(str(i))
+            self.fd.set_follower(self.f.SerializeToString())
+        self.fd.set_follower(self.f.SerializeToString())
+        self.fd.delete_follower(digest("0"))
+
+        guids = []
+        ser, count, next_page = self.fd.get_followers()
+        self.assertEqual(count, FOLLOWERS_PER_PAGE * 2 + 4)
+        while True:
+            f = Followers()
+            f.ParseFromString(ser)
+            guids.extend(follower.guid for follower in f.followers)
+            if next_page is None:
+                break
+            ser, count, next_page = self.fd.get_followers(next_page)
+        self.assertEqual(guids, [digest(str(i)) for i in range(FOLLOWERS_PER_PAGE * 2 + 4, 0, -1)])
+
+        # offsets from older nodes still work
+        f = Followers()
+        f.ParseFromString(self.fd.get_followers("30")[0])
+        self.assertEqual(f.followers[0].guid, digest(str(FOLLOWERS_PER_PAGE * 2 + 4 - 30)))
+
     def test_MassageStore(self):
         msgs = self.ms.get_messages(self.u.guid, 'CHAT')
         self.assertEqual(0, len(msgs))
@@ -199,6 +300,163 @@ class DatastoreTest(unittest.TestCase):
         msgs = self.ms.get_messages(self.u.guid, 'CHAT')
         self.assertEqual(0, len(msgs))
 
+    def test_conversations(self):
+        self.ms.save_message('guid1', '@one', 'key1', '', 'CHAT', 'first', 100, 'avatar1', '', False, 'm1')
+        self.ms.save_message('guid1', '', 'key1', '', 'CHAT', 'second', 200, '', '', False, 'm2')
+        self.ms.save_message('guid1', '', 'key1', '', 'CHAT', 'late', 150, '', '', False, 'm3')
+        self.ms.save_message('guid2', '@two', 'key2', '', 'CHAT', 'reply', 300, '', '', True, 'm4')
+        self.ms.save_message('guid3', '@three', 'key3', 'order', 'ORDER', 'not a chat', 400, '', '', False, 'm5')
+        # a duplicate message doesn't change the summary
+        self.assertFalse(self.ms.save_message('guid1', '', 'key1', '', 'CHAT', 'dup', 500, '', '', False, 'm1'))
+
+        conversations = self.ms.get_conversations()
+        self.assertEqual([c["guid"] for c in conversations], ['guid2', 'guid1'])
+        self.assertEqual(conversations[1]["last_message"], 'second')
+        self.assertEqual(conversations[1]["timestamp"], 200)
+        self.assertEqual(conversations[1]["handle"], '@one')
+        self.assertEqual(conversations[1]["avatar_hash"], 'avatar1'.encode("hex"))
+        self.assertEqual(conversations[1]["unread"], 3)
+        self.assertEqual(conversations[0]["unread"], 0)
+        self.assertIsNone(conversations[0]["avatar_hash"])
+
+        self.ms.mark_as_read('guid1')
+        self.ms.update_conversation_profile('guid1', '@renamed', 'avatar2')
+        conversation = self.ms.get_conversations()[1]
+        self.assertEqual(conversation["unread"], 0)
+        self.assertEqual(conversation["handle"], '@renamed')
+        self.assertEqual(conversation["avatar_hash"], 'avatar2'.encode("hex"))
+
+        self.ms.delete_messages('guid2')
+        self.assertEqual([c["guid"] for c in self.ms.get_conversations()], ['guid1'])
+
+        self.ms.save_message('guid4', '@four', 'key4', '', 'CHAT', '<script>x</script>', 600, '', '', False)
+        self.assertEqual(self.ms.get_conversations()[0]["last_message"], '&lt;script&gt;x&lt;/script&gt;')
+
+    def test_write_queue(self):
+        queue = self.db.write_queue
+        before = queue.get_stats()
+        self.ns.save_notification('n1', 'guid', 'handle', 'FOLLOW', '', 'title', 100, '')
+        self.ns.save_notification('n1', 'guid', 'handle', 'FOLLOW', '', 'title', 100, '')
+        self.assertTrue(self.ms.save_message('guid1', '@one', 'key1', '', 'CHAT', 'hi', 100, '', '', False, 'm1'))
+        # a queued message is seen before it is written
+        self.assertFalse(self.ms.save_message('guid1', '@one', 'key1', '', 'CHAT', 'hi', 100, '', '', False, 'm1'))
+        self.assertEqual(queue.get_stats()["pending"], 3)
+
+        # nothing is on disk until the queue is flushed
+        other = lite.connect("test.db")
+        self.assertEqual(other.execute('''SELECT Count(*) FROM notifications''').fetchone()[0], 0)
+
+        # reading a queued table commits the writes first, skipping the duplicate
+        self.assertEqual(self.ns.get_unread_count(), 1)
+        after = queue.get_stats()
+        self.assertEqual(after["pending"], 0)
+        self.assertEqual(after["flushes"] - before["flushes"], 1)
+        self.assertEqual(after["written"] - before["written"], 2)
+        self.assertEqual(after["failed"] - before["failed"], 1)
+        self.assertEqual(other.execute('''SELECT Count(*) FROM messages''').fetchone()[0], 1)
+
+        # and closing the database commits anything left
+        self.bs.save_broadcast('b1', 'guid', 'handle', 'message', 100, '')
+        self.db.close()
+        self.assertEqual(other.execute('''SELECT Count(*) FROM broadcasts''').fetchone()[0], 1)
+        other.close()
+
+        self.addCleanup(setattr, queue, "batch_size", queue.batch_size)
+        queue.batch_size = 3
+        for i in range(3):
+            self.db.audit_shopping.set('shopper', 1, 'contract %s' % i)
+        self.assertEqual(queue.get_stats()["pending"], 0)
+
+    def test_write_queue_rolls_back_failed_write(self):
+        queue = self.db.write_queue
+        before = queue.get_stats()
+
+        def half_applied(cursor):
+            cursor.execute('''INSERT INTO broadcasts(id, guid) VALUES (?,?)''', ('b1', 'guid'))
+            raise ValueError("failed after the insert")
+
+        queue.put(half_applied, "broadcasts", "b1")
+        self.bs.save_broadcast('b2', 'guid', 'handle', 'message', 100, '')
+        queue.flush()
+        self.assertEqual([b[0] for b in self.bs.get_broadcasts()], ["b2"])
+        self.assertEqual(queue.get_stats()["failed"] - before["failed"], 1)
+
+    def test_audit_rollups(self):
+        audit = self.db.audit_shopping
+        today = int(time.time()) // 86400 * 86400
+        day = today - 7 * 86400
+        audit.add_events([('shopper1', 1, 'c1', day + 10), ('shopper1', 1, 'c1', day + 20),
+                          ('shopper2', 1, 'c1', day + 3700), ('shopper1', 0, None, day + 30)])
+        audit.set('shopper2', 1, 'c1')
+        self.assertEqual(len(audit.get()), 5)
+
+        hourly = audit.get_rollups("hourly", 'c1', since=day)
+        self.assertEqual(hourly[0], (day, 'c1', 1, 2, 1))
+        self.assertEqual(hourly[1], (day + 3600, 'c1', 1, 1, 1))
+        daily = audit.get_rollups("daily", since=day)
+        self.assertEqual(daily, [(day, '', 0, 1, 1), (day, 'c1', 1, 3, 2), (today, 'c1', 1, 1, 1)])
+        self.assertEqual(audit.get_rollups("daily", action_id=0, since=day + 100), [(day, '', 0, 1, 1)])
+        self.assertRaises(ValueError, audit.get_rollups, "weekly")
+
+        cursor = lite.connect("test.db").cursor()
+        cursor.execute('''PRAGMA index_info(shopper_guid_index)''')
+        self.assertEqual([row[2] for row in cursor.fetchall()], ['shopper_guid'])
+
+    def test_search(self):
+        search = self.db.search
+        search.add('listing', 'c1', 'Red wool sweater', '<p>A warm sweater knitted from wool</p>')
+        search.add('listing', 'c2', 'Wool socks', 'Socks for hiking, like a sweater for your feet')
+        self.sales.new_sale('order1', 'Wool socks', 'Socks for hiking', 100, 1, 'addr', 0, '', 'buyer1', 'good')
+        self.ms.save_message('guid1', '@one', 'key1', '', 'CHAT', 'when will the sweater ship?', 100, '', '',
+                             False, 'm1')
+
+        hits = search.search('sweater')
+        self.assertEqual(len(hits), 3)
+        # a match in the title ranks above one in the body
+        self.assertEqual(hits[0]["key"], 'c1')
+        self.assertIn('<b>sweater</b>', hits[0]["snippet"].lower())
+        self.assertNotIn('<p>', hits[0]["snippet"])
+        self.assertEqual([h["key"] for h in search.search('sweater', 'message')], ['m1'])
+        self.assertEqual(search.search('sweater', 'message')[0]["ref"], 'guid1')
+        self.assertEqual(len(search.search('swea')), 3)
+        self.assertEqual(sorted(h["key"] for h in search.search('wool socks')), ['c2', 'order1'])
+        # search syntax in the query is ignored rather than raising
+        self.assertEqual(len(search.search('"wool" (socks* -')), 2)
+        self.assertEqual(search.search('  '), [])
+
+        search.add('listing', 'c1', 'Blue cotton shirt', '')
+        self.assertEqual(search.search('cotton')[0]["key"], 'c1')
+        self.assertEqual(len(search.search('sweater')), 2)
+        search.remove('listing', 'c2')
+        self.sales.delete_sale('order1')
+        self.assertEqual(search.search('socks'), [])
+        self.ms.delete_messages('guid1')
+        self.assertEqual(search.search('sweater'), [])
+
+    def test_ratings(self):
+        ratings = self.db.ratings
+        for i in range(5):
+            ratings.add_rating("listing1", json.dumps({"tx_summary": {"feedback": i + 1, "quality": 5, "id": i}}))
+        ratings.add_rating("listing2", json.dumps({"tx_summary": {"feedback": 5, "quality": "invalid"}}))
+
+        aggregate = ratings.get_aggregate("listing1")
+        self.assertEqual(aggregate["count"], 5)
+        self.assertEqual(aggregate["sums"]["feedback"], 15)
+        self.assertEqual(aggregate["sums"]["quality"], 25)
+        self.assertEqual(aggregate["stars"], [1, 1, 1, 1, 1])
+        aggregate = ratings.get_aggregate()
+        self.assertEqual(aggregate["count"], 6)
+        self.assertEqual(aggregate["stars"], [1, 1, 1, 1, 2])
+        self.assertEqual(ratings.get_aggregate("unrated")["count"], 0)
+
+        page, next_page = ratings.get_ratings_page("listing1", limit=3)
+        self.assertEqual([json.loads(r)["tx_summary"]["id"] for r in page], [0, 1, 2])
+        page, next_page = ratings.get_ratings_page("listing1", next_page, limit=3)
+        self.assertEqual([json.loads(r)["tx_summary"]["id"] for r in page], [3, 4])
+        self.assertIsNone(next_page)
+        self.assertEqual(len(ratings.get_ratings_page()[0]), 6)
+        self.assertEqual(ratings.get_ratings_page("listing1", "unknown"), ([], None))
+
     def test_BroadcastStore(self):
         bmsgs = self.bs.get_broadcasts()
         self.assertEqual(0, len(bmsgs))
@@ -316,6 +574,38 @@ class DatastoreTest(unittest.TestCase):
         n = self.ns.get_notifications("1234", 20)
         self.assertTrue(len(n) == 0)
 
+    def test_notifications_pagination(self):
+        for i in range(6):
+            self.ns.save_notification("n%s" % i, 'guid', 'handle', 'FOLLOW', '', '', i, '')
+        self.ns.delete_notification("n3")
+        self.ns.mark_as_read("n5")
+        self.assertEqual([n[0] for n in self.ns.get_notifications("", 3)], ["n2", "n4", "n5"])
+        self.assertEqual([n[0] for n in self.ns.get_notifications("n2", 3)], ["n0", "n1", "n2"])
+        self.assertEqual([n[0] for n in self.ns.get_notifications("", 2, unread_only=True)], ["n2", "n4"])
+
+    def test_orders_pagination(self):
+        for i in range(5):
+            self.sales.new_sale('s%s' % i, 'title', '', 100 + i // 2, 1, '', i % 2, '', 'buyer', '')
+        page, cursor = self.sales.get_page(limit=2)
+        self.assertEqual([s[0] for s in page], ['s4', 's3'])
+        page, cursor = self.sales.get_page(start=cursor, limit=2)
+        self.assertEqual([s[0] for s in page], ['s2', 's1'])
+        page, cursor = self.sales.get_page(start=cursor, limit=2)
+        self.assertEqual([s[0] for s in page], ['s0'])
+        self.assertIsNone(cursor)
+        self.assertEqual(page[0], self.sales.get_all()[0])
+
+        page, cursor = self.sales.get_page(status=1, ascending=True, limit=1)
+        self.assertEqual([s[0] for s in page], ['s1'])
+        self.assertEqual([s[0] for s in self.sales.get_page(status=1, start=cursor, ascending=True)[0]], ['s3'])
+        self.assertEqual([s[0] for s in self.sales.get_page(since=101, until=102)[0]], ['s3', 's2'])
+        self.assertEqual(self.sales.get_page(start='unknown'), ([], None))
+
+        self.purchases.new_purchase('p1', 'title', '', 100, 1, '', 0, '', 'vendor', '', '')
+        self.assertEqual(self.purchases.get_page()[0], self.purchases.get_all())
+        self.db.cases.new_case('c1', 'title', 100, '', 1, '', 'buyer', 'vendor', '{}', 'claim')
+        self.assertEqual(self.db.cases.get_page()[0], self.db.cases.get_all())
+
     def test_VendorStore(self):
         v = self.vs.get_vendors()
         self.assertEqual(v, {})
@@ -334,6 +624,23 @@ class DatastoreTest(unittest.TestCase):
         v = self.vs.get_vendors()
         self.assertEqual(v, {})
 
+    def test_VendorStore_batch(self):
+        rows = []
+        for i in range(3):
+            n = Node()
+            n.guid = digest(str(i))
+            n.publicKey = digest("signed pubkey")
+            n.nodeAddress.ip = "127.0.0.1"
+            n.nodeAddress.port = 1234 + i
+            n.natType = FULL_CONE
+            rows.append((n.guid.encode("hex"), n.SerializeToString(), 100 - i, 0.5 + i * 0.1))
+        self.vs.save_vendors(rows)
+        records = self.vs.get_vendor_records(2)
+        self.assertEqual([r[0].id for r in records], [digest("1"), digest("0")])
+        self.assertEqual(records[1][1:], (100, 0.5))
+        self.vs.delete_vendors([digest("0").encode("hex"), digest("1").encode("hex")])
+        self.assertEqual(self.vs.get_vendors().keys(), [digest("2")])
+
     def test_Settings(self):
         NUM_SETTINGS = 20
         settings = self.settings.get()
@@ -347,3 +654,33 @@ class DatastoreTest(unittest.TestCase):
 
 
 
+
+    def test_settings_cache(self):
+        self.assertEqual(self.settings.get_moderators(), [])
+        self.settings.update('', 'BTC', 'AUSTRALIA', 'EN', '', '', '', '', '', '', '["mod1", "mod2"]',
+                             '', '', '', '', '', '')
+        self.assertEqual(self.settings.get_moderators(), ["mod1", "mod2"])
+        self.settings.get_moderators().append("mod3")
+        self.assertEqual(self.settings.get_moderators(), ["mod1", "mod2"])
+        self.settings.set_credentials("user", "pass")
+        self.assertEqual(self.settings.get_credentials(), ("user", "pass"))
+        self.assertEqual(self.settings.get()[11], '["mod1", "mod2"]')
+        # the cache is rebuilt when the database is opened again
+        self.assertEqual(Database(filepath="test.db").settings.get_credentials(), ("user", "pass"))
+
+    def test_profile_and_keys_cache(self):
+        self.assertEqual(self.ps.get_profile(), Profile())
+        self.ps.set_temp_handle("@temp")
+        self.ps.set_proto(self.sp.SerializeToString())
+        profile = self.ps.get_profile()
+        self.assertEqual(profile, self.sp)
+        # callers get their own copy of the parsed profile
+        profile.name = "Changed"
+        self.assertEqual(self.ps.get_profile().name, "Test User")
+        self.assertEqual(self.ps.get_temp_handle(), "@temp")
+
+        self.assertIsNone(self.ks.get_key("guid"))
+        self.ks.set_key("guid", "privkey", "pubkey")
+        self.assertEqual(self.ks.get_key("guid"), ("privkey", "pubkey"))
+        self.ks.delete_all_keys()
+        self.assertIsNone(self.ks.get_key("guid"))
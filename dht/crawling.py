@@ -233,7 +233,8 @@ class RPCFindResponse(object):
                 newNode = Node(n.guid, n.nodeAddress.ip, n.nodeAddress.port, n.publicKey,
                                None if not n.HasField("relayAddress") else (n.relayAddress.ip, n.relayAddress.port),
                                n.natType,
-                               n.vendor)
+                               n.vendor,
+                               [(r.ip, r.port) for r in n.backupRelayAddresses])
                 nodes.append(newNode)
             except Exception:
                 pass
@@ -8,18 +8,14 @@ Copyright (c) 2015 OpenBazaar
 import pickle
 import httplib
 import random
-from binascii import hexlify
+from binascii import unhexlify
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer, reactor, task
 
-import nacl.signing
-import nacl.hash
-import nacl.encoding
-
 from seed import peers
 from log import Logger
 from dht.protocol import KademliaProtocol
-from dht.utils import deferredDict, digest
+from dht.utils import deferredDict, digest, valid_guid, verify_signature
 from dht.storage import ForgetfulStorage
 from dht.node import Node
 from dht.crawling import ValueSpiderCrawl
@@ -28,7 +24,6 @@ from dht.crawling import NodeSpiderCrawl
 from protos import objects
 
 from config import SEEDS, SEEDS_TESTNET
-from random import shuffle
 
 
 def _anyRespondSuccess(responses):
@@ -133,8 +128,7 @@ class Server(object):
                         n.ParseFromString(peer)
                         tup = (str(n.nodeAddress.ip), n.nodeAddress.port)
                         nodes.append(tup)
-                    verify_key = nacl.signing.VerifyKey(pubkey, encoder=nacl.encoding.HexEncoder)
-                    verify_key.verify("".join(proto.serializedNode), proto.signature)
+                    verify_signature(unhexlify(pubkey), "".join(proto.serializedNode), proto.signature)
                     self.log.info("%s returned %s addresses" % (seed, len(nodes)))
                 except Exception, e:
                     self.log.error("failed to query seed: %s" % str(e))
@@ -174,16 +168,13 @@ class Server(object):
 
         def initTable(results):
             response = False
-            potential_relay_nodes = []
             for addr, result in results.items():
                 if result[0]:
                     response = True
                     n = objects.Node()
                     try:
                         n.ParseFromString(result[1][0])
-                        h = nacl.hash.sha512(n.publicKey)
-                        hash_pow = h[40:]
-                        if int(hash_pow[:6], 16) >= 50 or hexlify(n.guid) != h[:40]:
+                        if not valid_guid(n.guid, n.publicKey):
                             raise Exception('Invalid GUID')
                         node = Node(n.guid, addr[0], addr[1], n.publicKey,
                                     None if not n.HasField("relayAddress") else
@@ -191,8 +182,6 @@ class Server(object):
                                     n.natType,
                                     n.vendor)
                         self.protocol.router.addContact(node)
-                        if n.natType == objects.FULL_CONE:
-                            potential_relay_nodes.append((addr[0], addr[1]))
                     except Exception:
                         self.log.warning("bootstrap node returned invalid GUID")
             if not response:
@@ -201,9 +190,8 @@ class Server(object):
                 else:
                     self.bootstrap(self.querySeed(SEEDS), d)
                 return
-            if len(potential_relay_nodes) > 0 and self.node.nat_type != objects.FULL_CONE:
-                shuffle(potential_relay_nodes)
-                self.node.relay_node = potential_relay_nodes[0]
+            # the ping responses have been fed into the relay index, pick the best relays
+            self.protocol.multiplexer.update_relays()
 
             d.callback(True)
         ds = {}
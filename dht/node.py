@@ -10,12 +10,13 @@ from protos import objects
 
 class Node(object):
     def __init__(self, node_id, ip=None, port=None, pubkey=None,
-                 relay_node=None, nat_type=None, vendor=False):
+                 relay_node=None, nat_type=None, vendor=False, backup_relay_nodes=None):
         self.id = node_id
         self.ip = ip
         self.port = port
         self.pubkey = pubkey
         self.relay_node = relay_node
+        self.backup_relay_nodes = backup_relay_nodes or []
         self.nat_type = nat_type
         self.vendor = vendor
         self.long_id = long(node_id.encode('hex'), 16)
@@ -38,6 +39,11 @@ class Node(object):
             relay_address.port = self.relay_node[1]
             n.relayAddress.MergeFrom(relay_address)
 
+        for relay in self.backup_relay_nodes:
+            relay_address = n.backupRelayAddresses.add()
+            relay_address.ip = relay[0]
+            relay_address.port = relay[1]
+
         return n
 
     def sameHomeAs(self, node):
@@ -21,6 +21,8 @@ from protos.message import PING, STUN, STORE, DELETE, FIND_NODE, FIND_VALUE, HOL
 class KademliaProtocol(RPCProtocol):
     implements(MessageProcessor)
 
+    sheddable_commands = (FIND_VALUE,)
+
     def __init__(self, sourceNode, storage, ksize, database, signing_key):
         self.ksize = ksize
         self.router = RoutingTable(self, ksize, sourceNode)
@@ -235,6 +237,8 @@ class KademliaProtocol(RPCProtocol):
                 self.log.debug("call response from new node, transferring key/values")
                 reactor.callLater(1, self.transferKeyValues, node)
             self.router.addContact(node)
+        elif self.is_backing_off(node):
+            self.log.debug("%s asked us to calm down, keeping it in the router" % node)
         else:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
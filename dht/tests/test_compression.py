@@ -0,0 +1,54 @@
+import os
+import zlib
+
+from twisted.trial import unittest
+
+from net.compression import add_arguments, get_arguments, MAX_DECOMPRESSED_SIZE
+from protos.message import Message
+
+
+class CompressionTest(unittest.TestCase):
+    def test_round_trip(self):
+        m = Message()
+        large = "{\n    \"vendor_offer\": {}\n}" * 100
+        saved, elapsed = add_arguments(m, ["small", large, 5], compress=True)
+        self.assertEqual(list(m.compressedArguments), [1])
+        self.assertEqual(saved, len(large) - len(m.arguments[1]))
+        self.assertGreater(saved, 0)
+
+        m2 = Message()
+        m2.ParseFromString(m.SerializeToString())
+        args, elapsed = get_arguments(m2)
+        self.assertEqual(args, ("small", large, "5"))
+
+    def test_not_compressed(self):
+        large = "a" * 2000
+        m = Message()
+        self.assertEqual(add_arguments(m, [large], compress=False), (0, 0.0))
+        self.assertEqual(len(m.compressedArguments), 0)
+
+        # incompressible data is sent as is
+        data = os.urandom(2000)
+        m = Message()
+        add_arguments(m, [data], compress=True)
+        self.assertEqual(len(m.compressedArguments), 0)
+        self.assertEqual(get_arguments(m)[0], (data,))
+
+    def test_decompression_limit(self):
+        m = Message()
+        m.arguments.append(zlib.compress("\x00" * (MAX_DECOMPRESSED_SIZE + 1)))
+        m.compressedArguments.append(0)
+        self.assertRaises(Exception, get_arguments, m)
+
+    def test_decompression_limit_is_per_message(self):
+        m = Message()
+        half = zlib.compress("\x00" * (MAX_DECOMPRESSED_SIZE / 2 + 1))
+        m.arguments.extend([half, half])
+        m.compressedArguments.extend([0, 1])
+        self.assertRaises(Exception, get_arguments, m)
+
+    def test_invalid_index(self):
+        m = Message()
+        m.arguments.append("a")
+        m.compressedArguments.append(3)
+        self.assertRaises(Exception, get_arguments, m)
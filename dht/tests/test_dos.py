@@ -0,0 +1,80 @@
+import mock
+from twisted.trial import unittest
+
+from net.dos import BanScore, BUCKET_SIZE, REFILL_RATE, COSTS
+from protos.message import Message, FOLLOW, FIND_VALUE, GET_IMAGE, PING, BATCH
+
+
+class BanScoreTest(unittest.TestCase):
+    def setUp(self):
+        self.multiplexer = mock.MagicMock()
+        self.ban_score = BanScore(self.multiplexer)
+        self.peer = ("123.45.67.89", 12345)
+        self.now = 1000.0
+        patcher = mock.patch("net.dos.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _message(command):
+        m = Message()
+        m.command = command
+        return m
+
+    def test_burst_then_throttle(self):
+        burst = BUCKET_SIZE / COSTS[GET_IMAGE]
+        for _ in range(burst):
+            self.assertTrue(self.ban_score.process_message(self.peer, self._message(GET_IMAGE)))
+        self.assertFalse(self.ban_score.process_message(self.peer, self._message(GET_IMAGE)))
+        self.assertEqual(self.ban_score.get_stats()["throttled"], {"GET_IMAGE": 1})
+        self.assertFalse(self.multiplexer.ban_ip.called)
+
+        # other commands have their own bucket
+        self.assertTrue(self.ban_score.process_message(self.peer, self._message(FIND_VALUE)))
+
+        # tokens are refilled lazily on the next message
+        self.now += float(COSTS[GET_IMAGE]) / REFILL_RATE
+        self.assertTrue(self.ban_score.process_message(self.peer, self._message(GET_IMAGE)))
+        self.assertFalse(self.ban_score.process_message(self.peer, self._message(GET_IMAGE)))
+
+    def test_batch_charges_sub_requests(self):
+        batch = self._message(BATCH)
+        batch.arguments.extend([self._message(GET_IMAGE).SerializeToString()] * 20)
+        self.assertTrue(self.ban_score.process_message(self.peer, batch))
+        self.assertEqual(self.ban_score.buckets.get((self.peer[0], GET_IMAGE))[0],
+                         BUCKET_SIZE - 20 * COSTS[GET_IMAGE])
+
+        # the second batch doesn't fit in what is left of the GET_IMAGE bucket
+        self.assertFalse(self.ban_score.process_message(self.peer, batch))
+        self.assertEqual(self.ban_score.buckets.get((self.peer[0], BATCH))[0], BUCKET_SIZE - COSTS[BATCH])
+        self.assertEqual(self.ban_score.get_stats()["throttled"], {"GET_IMAGE": 1})
+
+    def test_compressed_batch_charged_once_inflated(self):
+        batch = self._message(BATCH)
+        batch.arguments.extend(["compressed"] * 20)
+        batch.compressedArguments.extend(range(20))
+        self.assertTrue(self.ban_score.process_message(self.peer, batch))
+        self.assertIsNone(self.ban_score.buckets.get((self.peer[0], GET_IMAGE)))
+
+        requests = [self._message(GET_IMAGE).SerializeToString()] * 20
+        self.assertTrue(self.ban_score.charge_batch(self.peer, requests))
+        self.assertFalse(self.ban_score.charge_batch(self.peer, requests))
+
+    def test_free_commands(self):
+        for _ in range(1000):
+            self.assertTrue(self.ban_score.process_message(self.peer, self._message(PING)))
+        self.assertEqual(len(self.ban_score.buckets), 0)
+
+    @mock.patch("net.dos.reactor")
+    def test_ban_on_follow_flood(self, reactor):
+        for _ in range(3):
+            self.assertTrue(self.ban_score.process_message(self.peer, self._message(FOLLOW)))
+        self.assertFalse(self.ban_score.process_message(self.peer, self._message(FOLLOW)))
+        self.multiplexer.ban_ip.assert_called_once_with(self.peer[0])
+        self.assertTrue(reactor.callLater.called)
+
+    def test_buckets_bounded(self):
+        ban_score = BanScore(self.multiplexer, max_buckets=10)
+        for i in range(20):
+            ban_score.process_message(("10.0.0.%d" % i, 1), self._message(FIND_VALUE))
+        self.assertEqual(len(ban_score.buckets), 10)
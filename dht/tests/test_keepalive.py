@@ -0,0 +1,60 @@
+from twisted.trial import unittest
+
+from net.keepalive import NatTimeoutEstimator, DEFAULT_INTERVAL, MIN_INTERVAL, MAX_INTERVAL, SAFETY_FACTOR
+
+
+class NatTimeoutEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.estimator = NatTimeoutEstimator()
+        self.peer = ("1.1.1.1", 1)
+
+    def test_default_interval(self):
+        self.assertEqual(self.estimator.interval(), DEFAULT_INTERVAL)
+        self.assertTrue(self.estimator.needs_probe())
+
+    def test_probe_success_raises_interval(self):
+        self.estimator.start_probe(self.peer)
+        self.assertEqual(self.estimator.probe_target, DEFAULT_INTERVAL * 2)
+        self.assertFalse(self.estimator.needs_probe())
+
+        self.estimator.observe(self.peer, 65)
+        self.assertIsNone(self.estimator.probe)
+        self.assertEqual(self.estimator.lower, 65)
+        self.assertEqual(self.estimator.interval(), 65 * SAFETY_FACTOR)
+
+    def test_probe_failure_bounds_interval(self):
+        self.estimator.observe(self.peer, 100)
+        self.estimator.start_probe(self.peer)
+        self.estimator.probe_failed()
+        self.assertEqual(self.estimator.upper, 200)
+        self.assertEqual(self.estimator.interval(), 100 * SAFETY_FACTOR)
+
+        # the next probe bisects the bounds
+        self.estimator.start_probe(self.peer)
+        self.assertEqual(self.estimator.probe_target, 150)
+
+        # silences at or above the upper bound don't count
+        self.estimator.observe(("2.2.2.2", 2), 250)
+        self.assertEqual(self.estimator.lower, 100)
+
+    def test_short_timeout(self):
+        self.estimator.start_probe(self.peer)
+        self.estimator.probe_failed()
+        self.estimator.upper = 10
+        self.assertEqual(self.estimator.interval(), MIN_INTERVAL)
+
+    def test_stops_probing(self):
+        self.estimator.observe(self.peer, MAX_INTERVAL)
+        self.assertFalse(self.estimator.needs_probe())
+        self.assertEqual(self.estimator.interval(), MAX_INTERVAL * SAFETY_FACTOR)
+
+        self.estimator = NatTimeoutEstimator()
+        self.estimator.lower, self.estimator.upper = 95, 100
+        self.assertFalse(self.estimator.needs_probe())
+
+    def test_cancel_probe(self):
+        self.estimator.start_probe(self.peer)
+        self.estimator.cancel_probe(("2.2.2.2", 2))
+        self.assertEqual(self.estimator.probe, self.peer)
+        self.estimator.cancel_probe(self.peer)
+        self.assertIsNone(self.estimator.probe)
@@ -51,6 +51,13 @@ class NodeTest(unittest.TestCase):
         n2 = Node(rid, "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 1234), objects.FULL_CONE, True)
         self.assertEqual(n1, n2.getProto())
 
+        backup = n1.backupRelayAddresses.add()
+        backup.ip = "127.0.0.2"
+        backup.port = 5678
+        n2 = Node(rid, "127.0.0.1", 1234, digest("pubkey"), ("127.0.0.1", 1234), objects.FULL_CONE, True,
+                  [("127.0.0.2", 5678)])
+        self.assertEqual(n1, n2.getProto())
+
     def test_tuple(self):
         n = Node('127.0.0.1', 0, 'testkey')
         i = n.__iter__()
@@ -8,6 +8,7 @@ import nacl.signing
 import nacl.encoding
 import nacl.hash
 import os
+import zlib
 from txrudp import connection, rudp, packet, constants
 from twisted.trial import unittest
 from twisted.internet import task, address, udp, defer, reactor
@@ -17,6 +18,8 @@ from dht.utils import digest
 from dht.storage import ForgetfulStorage
 from dht.node import Node
 from protos import message, objects
+from net.metrics import rpc_metrics
+from net.keepalive import KEEP_ALIVE_FRAME, DEFAULT_INTERVAL, NatTimeoutEstimator
 from net.wireprotocol import OpenBazaarProtocol
 from db import datastore
 from config import PROTOCOL_VERSION
@@ -70,6 +73,7 @@ class KademliaProtocolTest(unittest.TestCase):
         if self.con.state != connection.State.SHUTDOWN:
             self.con.shutdown()
         self.wire_protocol.shutdown()
+        self.db.close()
         os.remove("test.db")
 
     def test_invalid_datagram(self):
@@ -617,3 +621,235 @@ class KademliaProtocolTest(unittest.TestCase):
         val = self.protocol.rpc_delete(n, 'testkeyword', 'key', 'testsig')
         self.assertEqual(val, ["False"])
         val = self.protocol.rpc_delete(n, '', '', '')
+
+    def test_rpc_metrics(self):
+        rpc_metrics.reset()
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.protocol.ping(n)
+        message_id = self.protocol._outstanding.keys()[0]
+        self.protocol._acceptResponse(message_id, ("test",), n)
+        self.protocol.ping(n)
+        self.protocol.timeout(n)
+
+        stats = rpc_metrics.to_dict()["outgoing"]["PING"]
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["responses"], 1)
+        self.assertEqual(stats["response_bytes"], 4)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertEqual(sum(stats["latency_histogram"].values()), 1)
+
+    def test_connection_cap(self):
+        self.wire_protocol.max_connections = 2
+        addr3 = ('213.45.76.98', 33333)
+        con1 = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+        con2 = self.wire_protocol.make_new_connection(self.own_addr, self.addr2)
+        self.assertEqual(self.wire_protocol.evictable.keys(), [self.addr1, self.addr2])
+
+        # both connections were just made so an incoming peer is refused
+        self.assertIsNone(self.wire_protocol.make_new_connection(self.own_addr, addr3))
+        self.assertNotIn(addr3, self.wire_protocol)
+        self.assertEqual(self.wire_protocol.connection_stats["rejected"], 1)
+
+        # once they are idle the least recently active one is evicted
+        self.wire_protocol.evictable[self.addr1] = time.time() - 60
+        self.wire_protocol.evictable[self.addr2] = time.time() - 60
+        self.wire_protocol.touch(self.addr1)
+        con3 = self.wire_protocol.make_new_connection(self.own_addr, addr3)
+        self.assertIsNotNone(con3)
+        self.assertEqual(con2.state, connection.State.SHUTDOWN)
+        self.assertEqual(con1.state, connection.State.CONNECTING)
+        self.assertEqual(self.wire_protocol.evictable.keys(), [self.addr1, addr3])
+        self.assertEqual(self.wire_protocol.connection_stats["evicted"], 1)
+
+        # connections we initiate ourselves are never refused
+        self.wire_protocol.make_new_connection(self.own_addr, self.addr2, outgoing=True)
+        self.assertIn(self.addr2, self.wire_protocol)
+        self.assertEqual(self.wire_protocol.connection_stats["outgoing_over_cap"], 1)
+
+    def test_eviction_skips_needed_connections(self):
+        self.wire_protocol.max_connections = 41
+        addresses = [('10.0.0.%d' % i, 1000 + i) for i in range(41)]
+        for addr in addresses:
+            self.wire_protocol.make_new_connection(self.own_addr, addr)
+            self.wire_protocol.evictable[addr] = time.time() - 60
+        # the 40 oldest connections are routing table peers which must be kept open
+        for addr in addresses[:40]:
+            self.wire_protocol[addr].handler.is_disposable = lambda: False
+
+        con = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+        self.assertIsNotNone(con)
+        self.assertNotIn(addresses[40], self.wire_protocol)
+        self.assertEqual(self.wire_protocol.evictable.keys(), [self.addr1])
+
+        # they come back into the index once they are active again
+        self.wire_protocol.touch(addresses[0])
+        self.assertEqual(self.wire_protocol.evictable.keys(), [self.addr1, addresses[0]])
+
+    def test_keep_alive_visits_due_connections(self):
+        now = [1000000.0]
+        with mock.patch("net.wireprotocol.time.time", side_effect=lambda: now[0]):
+            cons = [self.wire_protocol.make_new_connection(self.own_addr, ('10.0.0.%d' % i, 1000 + i))
+                    for i in range(3)]
+            self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+            for con in cons:
+                con._state = connection.State.CONNECTED
+                con.handler.keep_alive = mock.Mock()
+                con.handler.is_disposable = lambda: False
+            interval = self.wire_protocol.nat_timeout.interval()
+
+            # nothing is due before the keep alive interval has passed
+            now[0] += interval - 1
+            self.wire_protocol.keep_alive()
+            self.assertFalse(any(con.handler.keep_alive.called for con in cons))
+
+            # a connection which sent something in the meantime is only put back in the queue
+            cons[0].handler.last_sent = now[0]
+            now[0] += 1
+            self.wire_protocol.keep_alive()
+            self.assertFalse(cons[0].handler.keep_alive.called)
+            self.assertEqual(cons[1].handler.keep_alive.call_count, 1)
+            self.assertEqual(cons[2].handler.keep_alive.call_count, 1)
+            self.assertEqual(self.wire_protocol.keep_alive_due[cons[0].dest_addr], now[0] - 1 + interval)
+
+            # the connection still connecting is requeued without a keep alive
+            self.assertIn(self.addr1, self.wire_protocol.keep_alive_due)
+
+            # closed connections leave the queue
+            self.wire_protocol[cons[1].dest_addr].shutdown()
+            self.assertNotIn(cons[1].dest_addr, self.wire_protocol.keep_alive_due)
+
+    def test_throttled_request_is_not_inflated(self):
+        m = message.Message()
+        m.messageID = digest("msgid")
+        m.command = message.FIND_VALUE
+        m.testnet = False
+        m.arguments.append(zlib.compress("\x00" * 1000))
+        m.compressedArguments.append(0)
+        ban_score = mock.Mock()
+        ban_score.process_message.return_value = False
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        with mock.patch("net.rpcudp.get_arguments") as get_arguments:
+            self.assertFalse(self.protocol.receive_message(m, n, mock.Mock(), ban_score))
+            self.assertFalse(get_arguments.called)
+
+    def test_calm_down_when_overloaded(self):
+        self._connecting_to_connected()
+        self.wire_protocol.overload.outstanding = self.wire_protocol.overload.max_outstanding + 1
+
+        m = message.Message()
+        m.messageID = digest("msgid")
+        m.sender.MergeFrom(self.protocol.sourceNode.getProto())
+        m.command = message.Command.Value("FIND_VALUE")
+        m.protoVer = self.version
+        m.testnet = False
+        m.arguments.append(digest("Keyword"))
+        m.signature = self.signing_key.sign(m.SerializeToString())[:64]
+        self.handler.on_connection_made()
+        self.handler.receive_message(m.SerializeToString())
+
+        self.clock.advance(100 * constants.PACKET_TIMEOUT)
+        connection.REACTOR.runUntilCurrent()
+        sent_packet = packet.Packet.from_bytes(self.proto_mock.send_datagram.call_args_list[0][0][0])
+        m2 = message.Message()
+        m2.ParseFromString(sent_packet.payload)
+        self.assertEqual(m2.command, message.CALM_DOWN)
+        self.assertEqual(m2.arguments[0], str(self.wire_protocol.overload.backoff_interval()))
+        self.assertEqual(self.wire_protocol.overload.shed, 1)
+
+    def test_acceptCalmDown(self):
+        self._connecting_to_connected()
+        self.wire_protocol[self.addr1] = self.con
+        n = Node(digest("S"), self.addr1[0], self.addr1[1])
+        self.protocol.router.addContact(n)
+
+        d = self.protocol.callFindValue(n, Node(digest("Keyword")))
+        message_id = self.protocol._outstanding.keys()[0]
+        self.protocol._acceptCalmDown(message_id, ("30",), n)
+        self.assertEqual(self.successResultOf(d), (False, None))
+        self.assertTrue(self.protocol.is_backing_off(n))
+        self.assertNotIn(message_id, self.protocol._outstanding)
+        self.assertFalse(self.protocol.router.isNewNode(n))
+
+        # further low priority requests aren't sent until the interval has passed
+        d = self.protocol.callFindValue(n, Node(digest("Keyword")))
+        self.assertEqual(self.successResultOf(d), (False, None))
+        self.assertEqual(len(self.protocol._outstanding), 0)
+        self.protocol._backoff[self.addr1] = time.time() - 1
+        self.assertFalse(self.protocol.is_backing_off(n))
+
+    def test_state_change_callback(self):
+        con = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+        self.assertIsNone(con.handler.addr)
+        con._state = connection.State.CONNECTED
+        self.assertEqual(con.handler.addr, "%s:%s" % self.addr1)
+        self.assertEqual(con.state, connection.State.CONNECTED)
+
+    def test_keep_alive_frame(self):
+        con = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+        con._state = connection.State.CONNECTED
+        handler = con.handler
+        handler.node = Node(digest("S"), self.addr1[0], self.addr1[1], nat_type=objects.FULL_CONE)
+
+        # old peers are pinged, new ones get a keep alive frame
+        handler.last_sent = time.time() - 400
+        with mock.patch.object(self.protocol, "callPing") as ping:
+            handler.keep_alive()
+            self.assertTrue(ping.called)
+        handler.remote_node_version = self.version
+        with mock.patch.object(self.wire_protocol.scheduler, "send") as send:
+            handler.keep_alive()
+            send.assert_called_once_with(con, KEEP_ALIVE_FRAME, mock.ANY)
+
+        # receiving one only records how long we had been silent
+        handler.last_sent = time.time() - 40
+        self.assertTrue(handler.receive_message(KEEP_ALIVE_FRAME))
+        self.assertGreaterEqual(self.wire_protocol.nat_timeout.lower, 40)
+
+    def _run_nat_probe(self, nat_timeout):
+        """
+        Runs the keep alive loop against a peer which sends a keep alive frame every
+        DEFAULT_INTERVAL seconds. Its frames only get through while our NAT mapping,
+        which expires `nat_timeout` seconds after we last sent something, is open.
+        Returns once the first probe has finished.
+        """
+        now = [1000000]
+        self.wire_protocol.nat_type = objects.RESTRICTED
+        self.wire_protocol.nat_timeout = NatTimeoutEstimator()
+        estimator = self.wire_protocol.nat_timeout
+        with mock.patch("net.wireprotocol.time.time", side_effect=lambda: now[0]):
+            con = self.wire_protocol.make_new_connection(self.own_addr, self.addr1)
+            con._state = connection.State.CONNECTED
+            handler = con.handler
+            handler.node = Node(digest("S"), self.addr1[0], self.addr1[1], nat_type=objects.RESTRICTED)
+            handler.remote_node_version = self.version
+            handler.is_disposable = lambda: False
+
+            def send(connection, datagram, priority):
+                connection.handler.last_sent = now[0]
+            with mock.patch.object(self.wire_protocol.scheduler, "send", side_effect=send) as sent:
+                for _ in range(1000):
+                    now[0] += 1
+                    if now[0] % DEFAULT_INTERVAL == 0 and now[0] - handler.last_sent < nat_timeout:
+                        handler.receive_message(KEEP_ALIVE_FRAME)
+                    self.wire_protocol.keep_alive()
+                    if estimator.probes == 1 and estimator.probe is None:
+                        return estimator, sent.call_count
+        self.fail("the nat timeout probe never finished")
+
+    def test_nat_probe_succeeds_against_chatty_peer(self):
+        estimator, _ = self._run_nat_probe(100)
+        self.assertIsNone(estimator.upper)
+        self.assertGreaterEqual(estimator.lower, DEFAULT_INTERVAL * 2)
+        self.assertLess(estimator.lower, 100)
+        self.assertGreater(estimator.interval(), DEFAULT_INTERVAL)
+
+    def test_nat_probe_fails_against_chatty_peer(self):
+        estimator, sent = self._run_nat_probe(45)
+        self.assertEqual(estimator.upper, DEFAULT_INTERVAL * 2)
+        self.assertLess(estimator.lower, 45)
+        self.assertLess(estimator.interval(), 45)
+        # we go back to sending keep alives once the probe has failed
+        self.assertGreater(sent, 0)
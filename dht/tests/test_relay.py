@@ -0,0 +1,39 @@
+from twisted.trial import unittest
+
+from net.relay import RelayIndex
+
+
+class RelayIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = RelayIndex(max_relays=2, max_candidates=4)
+        self.index.record_rtt(("1.1.1.1", 1), 0.3)
+        self.index.record_rtt(("2.2.2.2", 2), 0.1)
+        self.index.record_rtt(("3.3.3.3", 3), 0.2)
+
+    def test_select_fastest(self):
+        self.assertEqual(self.index.select(), [("2.2.2.2", 2), ("3.3.3.3", 3)])
+
+    def test_select_keeps_current_relays(self):
+        self.index.select()
+        self.index.record_rtt(("4.4.4.4", 4), 0.01)
+        self.assertEqual(self.index.select(), [("2.2.2.2", 2), ("3.3.3.3", 3)])
+
+    def test_relayed_traffic_improves_score(self):
+        self.index.relays = [("1.1.1.1", 1)]
+        self.index.record_relayed(("1.1.1.1", 1), 10 * 1024 * 1024)
+        self.index.relays = []
+        self.assertEqual(self.index.select()[0], ("1.1.1.1", 1))
+
+    def test_fail_over(self):
+        self.index.select()
+        relays = self.index.fail_over(("2.2.2.2", 2))
+        self.assertEqual(relays, [("3.3.3.3", 3), ("1.1.1.1", 1)])
+        self.assertNotIn(("2.2.2.2", 2), self.index.candidates)
+
+    def test_candidates_bounded(self):
+        self.index.select()
+        self.index.record_rtt(("4.4.4.4", 4), 0.5)
+        self.index.record_rtt(("5.5.5.5", 5), 0.5)
+        self.assertEqual(len(self.index.candidates), 4)
+        self.assertNotIn(("1.1.1.1", 1), self.index.candidates)
+        self.assertIn(("2.2.2.2", 2), self.index.candidates)
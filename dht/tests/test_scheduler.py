@@ -0,0 +1,57 @@
+from collections import deque
+
+import mock
+from twisted.trial import unittest
+from txrudp.connection import State
+
+from net.scheduler import SendScheduler, ConnectionQueue, MAX_BACKLOG, CONTROL, COMMERCE, CHAT, BULK
+
+
+class SendSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.state = State.CONNECTED
+        self.connection._segment_queue = deque()
+        self.scheduler = SendScheduler()
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_send_immediately(self):
+        self.scheduler.send(self.connection, "ping", CONTROL)
+        self.connection.send_message.assert_called_once_with("ping")
+        self.assertEqual(len(self.scheduler.queues), 0)
+
+    def test_queue_when_backlogged(self):
+        self.connection._segment_queue.extend(range(MAX_BACKLOG))
+        self.scheduler.send(self.connection, "image", BULK)
+        self.scheduler.send(self.connection, "order", COMMERCE)
+        self.assertFalse(self.connection.send_message.called)
+        stats = self.scheduler.get_stats()["classes"]
+        self.assertEqual(stats["bulk"]["queued_messages"], 1)
+        self.assertEqual(stats["commerce"]["queued_messages"], 1)
+
+        self.connection._segment_queue.clear()
+        self.scheduler.pump()
+        sent = [c[0][0] for c in self.connection.send_message.call_args_list]
+        self.assertEqual(sent, ["order", "image"])
+        self.assertEqual(len(self.scheduler.queues), 0)
+
+    def test_bulk_rate_limit(self):
+        scheduler = SendScheduler(bulk_rate=10)
+        scheduler.send(self.connection, "x" * 20, BULK)
+        scheduler.send(self.connection, "y" * 20, BULK)
+        scheduler.send(self.connection, "chat", CHAT)
+        sent = [c[0][0] for c in self.connection.send_message.call_args_list]
+        self.assertEqual(sent, ["x" * 20, "chat"])
+        self.assertEqual(scheduler.get_stats()["classes"]["bulk"]["queued_messages"], 1)
+        scheduler.stop()
+
+    def test_weighted_fair_queueing(self):
+        q = ConnectionQueue()
+        for _ in range(30):
+            q.push("b" * 1000, BULK)
+            q.push("c" * 1000, CONTROL)
+        first = [q.pop()[1] for _ in range(26)]
+        self.assertEqual(first.count(CONTROL), 24)
+        self.assertEqual(first.count(BULK), 2)
@@ -1,9 +1,13 @@
 import hashlib
+import nacl.exceptions
+import nacl.signing
 
 from twisted.trial import unittest
 from twisted.internet import defer
 
-from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict
+from dht.utils import digest, sharedPrefix, OrderedSet, deferredDict, LRUCache, valid_guid, verify_signature, \
+    signature_cache, guid_cache
+from keys.guid import GUID
 
 
 class UtilsTest(unittest.TestCase):
@@ -56,3 +60,55 @@ class OrderedSetTest(unittest.TestCase):
         o.push('2')
         o.push('1')
         self.assertEqual(o, ['2', '1'])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        c = LRUCache(2)
+        c["a"] = 1
+        c["b"] = 2
+        self.assertEqual(c.get("a"), 1)
+        c["c"] = 3
+        self.assertTrue("a" in c)
+        self.assertFalse("b" in c)
+        self.assertEqual(len(c), 2)
+
+    def test_stats(self):
+        c = LRUCache(2)
+        c["a"] = 1
+        c.get("a")
+        c.get("b")
+        stats = c.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+
+class VerificationTest(unittest.TestCase):
+    def setUp(self):
+        signature_cache.clear()
+        guid_cache.clear()
+        self.signing_key = nacl.signing.SigningKey.generate()
+        self.pubkey = self.signing_key.verify_key.encode()
+
+    def test_verify_signature(self):
+        signature = self.signing_key.sign("hello")[:64]
+        verify_signature(self.pubkey, "hello", signature)
+        verify_signature(self.pubkey, "hello", signature)
+        self.assertEqual(signature_cache.hits, 1)
+        self.assertEqual(signature_cache.misses, 1)
+
+    def test_verify_bad_signature(self):
+        signature = self.signing_key.sign("hello")[:64]
+        self.assertRaises(nacl.exceptions.BadSignatureError, verify_signature, self.pubkey, "goodbye", signature)
+        self.assertRaises(nacl.exceptions.BadSignatureError, verify_signature, self.pubkey, "goodbye", signature)
+        self.assertEqual(signature_cache.hits, 1)
+
+    def test_valid_guid(self):
+        g = GUID()
+        pubkey = g.verify_key.encode()
+        self.assertTrue(valid_guid(g.guid, pubkey))
+        self.assertTrue(valid_guid(g.guid, pubkey))
+        self.assertEqual(guid_cache.hits, 1)
+        self.assertFalse(valid_guid(g.guid, self.pubkey))
+        self.assertFalse(valid_guid(digest("guid"), pubkey))
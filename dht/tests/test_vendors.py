@@ -0,0 +1,59 @@
+import mock
+from twisted.trial import unittest
+
+from dht.node import Node
+from dht.utils import digest
+from net.vendors import VendorRegistry, INITIAL_SCORE
+from protos.objects import FULL_CONE
+
+
+class VendorRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.store = mock.Mock()
+        self.old = Node(digest("old"), "1.1.1.1", 1, digest("pubkey"), nat_type=FULL_CONE, vendor=True)
+        self.store.get_vendor_records.return_value = [(self.old, 100, 0.5)]
+        self.registry = VendorRegistry(self.store, max_vendors=2)
+        self.a = Node(digest("a"), "2.2.2.2", 2, digest("pubkey"), nat_type=FULL_CONE, vendor=True)
+        self.b = Node(digest("b"), "3.3.3.3", 3, digest("pubkey"), nat_type=FULL_CONE, vendor=True)
+
+    def test_loaded_from_store(self):
+        self.store.get_vendor_records.assert_called_once_with(2)
+        self.assertIn(self.old.id, self.registry)
+        self.assertEqual(self.registry.get(self.old.id), self.old)
+
+    def test_evicts_least_recently_seen(self):
+        self.registry.seen(self.a)
+        self.registry.seen(self.old)
+        self.registry.seen(self.b)
+        self.assertEqual(self.registry.vendors.keys(), [self.old.id, self.b.id])
+        self.assertEqual(self.registry.removed, set([self.a.id]))
+        self.assertEqual(self.registry.evicted, 1)
+
+    def test_liveness(self):
+        self.registry.seen(self.a)
+        self.assertEqual(self.registry.vendors[self.a.id][2], INITIAL_SCORE)
+        self.registry.seen(self.a)
+        self.assertGreater(self.registry.vendors[self.a.id][2], INITIAL_SCORE)
+        for _ in range(5):
+            self.registry.failed(self.a.id)
+        self.assertNotIn(self.a.id, self.registry)
+
+    def test_flush(self):
+        self.registry.seen(self.a)
+        self.registry.remove(self.old.id)
+        self.registry.flush()
+        rows = self.store.save_vendors.call_args[0][0]
+        self.assertEqual([r[0] for r in rows], [self.a.id.encode("hex")])
+        self.store.delete_vendors.assert_called_once_with([self.old.id.encode("hex")])
+        self.assertEqual(self.registry.get_stats()["pending_writes"], 0)
+
+        # nothing changed so nothing is written
+        self.store.reset_mock()
+        self.registry.flush()
+        self.assertFalse(self.store.save_vendors.called)
+
+    def test_sample(self):
+        self.registry.seen(self.a)
+        self.assertEqual(len(self.registry.sample(5)), 2)
+        self.assertEqual(self.registry.sample(5, exclude=set([self.old.id])), [self.a])
+        self.assertEqual(self.registry.sample(5, include=[self.old.id, self.b.id]), [self.old])
@@ -3,8 +3,13 @@ General catchall for functions that don't make sense as methods.
 
 Copyright (c) 2014 Brian Muller
 """
+import bitcointools
 import hashlib
+import nacl.exceptions
+import nacl.hash
+import nacl.signing
 import operator
+from collections import OrderedDict
 
 from twisted.internet import defer
 
@@ -73,3 +78,118 @@ def sharedPrefix(args):
             break
         i += 1
     return args[0][:i]
+
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used key once it
+    grows past `max_size` entries. Lookups are counted so the hit rate
+    can be reported.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            del self._items[key]
+        elif len(self._items) >= self.max_size:
+            self._items.popitem(last=False)
+        self._items[key] = value
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups > 0 else 0.0
+        }
+
+
+# Verification results are keyed on (pubkey, digest of the message, signature)
+# so the same profile, listing or follower entry is only checked once.
+signature_cache = LRUCache(10000)
+# Maps a guid to the public key which was shown to hash to it with a valid proof of work.
+guid_cache = LRUCache(10000)
+
+
+def verify_signature(pubkey, message, signature):
+    """
+    Verify an ed25519 signature, consulting `signature_cache` first.
+
+    Raises:
+        nacl.exceptions.BadSignatureError: if the signature is not valid.
+    """
+    key = ("ed25519", pubkey, hashlib.sha256(message).digest(), signature)
+    valid = signature_cache.get(key)
+    if valid is None:
+        try:
+            nacl.signing.VerifyKey(pubkey).verify(message, signature)
+            valid = True
+        except nacl.exceptions.BadSignatureError:
+            valid = False
+        signature_cache[key] = valid
+    if not valid:
+        raise nacl.exceptions.BadSignatureError("Signature was forged or corrupt")
+    return message
+
+
+def verify_ecdsa(message, signature, pubkey):
+    """
+    Returns whether `signature` is a valid bitcoin signature on `message`.
+    `signature` is in the base64 format returned by `bitcointools.ecdsa_raw_sign`.
+    """
+    key = ("ecdsa", pubkey, hashlib.sha256(message).digest(), signature)
+    valid = signature_cache.get(key)
+    if valid is None:
+        valid = bool(bitcointools.ecdsa_raw_verify(message, bitcointools.decode_sig(signature), pubkey))
+        signature_cache[key] = valid
+    return valid
+
+
+def valid_guid(guid, pubkey):
+    """
+    Returns whether the raw `guid` is the hash of `pubkey` and meets the
+    proof of work target.
+    """
+    if guid_cache.get(guid) == pubkey:
+        return True
+    h = nacl.hash.sha512(pubkey)
+    pow_hash = h[40:]
+    if int(pow_hash[:6], 16) >= 50 or guid.encode("hex") != h[:40]:
+        return False
+    guid_cache[guid] = pubkey
+    return True
+
+
+def verification_stats():
+    return {
+        "signatures": signature_cache.get_stats(),
+        "guids": guid_cache.get_stats()
+    }
@@ -13,7 +13,7 @@ class Multiplexer(Interface):
 
     processors = Attribute("""A list of `MessageProcessors`""")
     testnet = Attribute("""`bool` are we using testnet""")
-    vendors = Attribute("""A list `dht.node.Node` vendors""")
+    vendors = Attribute("""A `net.vendors.VendorRegistry` of known vendors""")
     ws = Attribute("""The websocket API server""")
     blockchain = Attribute("""The `LibbitcoinClient` instance""")
 
@@ -32,7 +32,7 @@ class Multiplexer(Interface):
         Set the ws and blockchain attributes.
         """
 
-    def send_message(datagram, address, relay_addr):
+    def send_message(datagram, address, relay_addr, priority):
         """
         Send a message over the wire to the given address
 
@@ -40,6 +40,7 @@ class Multiplexer(Interface):
             datagram: the serialized message to send
             address: the recipients address `tuple`
             relay_addr: a replay address `tuple` if used, otherwise None
+            priority: the `net.scheduler` priority class used to order outgoing messages
         """
 
     def __getitem__(addr):
@@ -71,6 +72,12 @@ class ConnectionHandler(Interface):
         Return True if this is the first time this is called else False
         """
 
+    def on_state_change(previous, state):
+        """
+        Called by the connection whenever its `txrudp.connection.State` changes, for example
+        when the handshake completes or the connection is shut down.
+        """
+
 
 class Connection(Interface):
     """
@@ -108,9 +115,9 @@ class MessageProcessor(Interface):
 
             connection: the txrudp connection to the peer who sent the message. To respond directly to the peer call
                       connection.send_message()
-            ban_score: a `net.dos.BanScore` object used to keep track of misbehaving peers. We need it here because
-                the processor determines if the incoming message is a request or a response before passing it into
-                the BanScore.
+            ban_score: a `net.dos.BanScore` object used to rate limit and ban misbehaving peers. We need it here
+                because the processor determines if the incoming message is a request or a response before passing
+                it into the BanScore. Requests it rejects must be dropped without being handled.
         """
 
     def connect_multiplexer(multiplexer):
@@ -1,16 +1,28 @@
 __author__ = 'hoffmabc'
 
+import time
 from log import Logger
+from twisted.internet.task import LoopingCall
+
+# Events are written to the database once this many are waiting or every
+# FLUSH_INTERVAL seconds, whichever comes first.
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 30
 
 
 class Audit(object):
     """
-    A class for handling audit information
+    A class for handling audit information. Events are buffered in memory and
+    saved to the database in batches, so recording one costs the rpc handlers
+    nothing more than appending to a list.
     """
 
-    def __init__(self, db, enabled=True):
+    def __init__(self, db, enabled=True, batch_size=BATCH_SIZE):
         self.db = db
         self.enabled = enabled
+        self.batch_size = batch_size
+        self.events = []
+        self.flush_loop = LoopingCall(self.flush)
 
         self.log = Logger(system=self)
 
@@ -26,9 +38,31 @@ class Audit(object):
     def record(self, guid, action_id, contract_hash=None):
         if self.enabled is not True:
             return
-        self.log.info("Recording Audit Event [%s]" % action_id)
 
         if action_id in self.action_ids:
-            self.db.audit_shopping.set(guid, self.action_ids[action_id], contract_hash)
+            self.events.append((guid, self.action_ids[action_id], contract_hash, int(time.time())))
+            if not self.flush_loop.running:
+                self.flush_loop.start(FLUSH_INTERVAL, now=False)
+            if len(self.events) >= self.batch_size:
+                self.flush()
         else:
             self.log.error("Could not identify this action id")
+
+    def flush(self):
+        """Saves the buffered events to the database in one transaction."""
+        if not self.events:
+            return
+        events = self.events
+        self.events = []
+        try:
+            self.db.audit_shopping.add_events(events)
+            self.log.debug("Recorded %s audit events" % len(events))
+        except Exception, e:
+            # keep them for the next flush
+            self.events = events + self.events
+            self.log.error("failed to save audit events: %s" % str(e))
+
+    def stop(self):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
@@ -17,6 +17,7 @@ from collections import OrderedDict
 from config import DATA_FOLDER, TRANSACTION_FEE
 from copy import deepcopy
 from datetime import datetime
+from db.datastore import listing_search_text
 from dht.utils import digest
 from hashlib import sha256
 from keys.bip32utils import derive_childkey
@@ -1009,6 +1010,7 @@ class Contract(object):
         # delete the listing metadata from the db
         contract_hash = unhexlify(self.contract["vendor_offer"]["listing"]["contract_id"])
         self.db.listings.delete_listing(contract_hash)
+        self.db.search.remove("listing", contract_hash.encode("hex"))
 
         # remove the pointer to the contract from the filemap
         self.db.filemap.delete(contract_hash.encode("hex"))
@@ -1087,6 +1089,10 @@ class Contract(object):
         # save the `ListingMetadata` protobuf to the database as well
         self.db.listings.add_listing(data)
 
+        # and index the listing's text so it shows up in searches of the store
+        title, body = listing_search_text(self.contract)
+        self.db.search.add("listing", data.contract_hash.encode("hex"), title, body)
+
     def process_refund(self, refund_json, blockchain, notification_listener):
         self.blockchain = blockchain
         if "refund" in self.contract:
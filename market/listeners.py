@@ -58,16 +58,14 @@ class BroadcastListenerImpl(object):
 
     def notify(self, guid, message):
         # pull the metadata for this node from the db
-        f = Following()
-        ser = self.db.follow.get_following()
+        ser = self.db.follow.get_user(guid)
         handle = ""
         avatar_hash = ""
         if ser is not None:
-            f.ParseFromString(ser)
-            for user in f.users:
-                if user.guid == guid:
-                    avatar_hash = user.metadata.avatar_hash
-                    handle = user.metadata.handle
+            user = Following.User()
+            user.ParseFromString(ser)
+            avatar_hash = user.metadata.avatar_hash
+            handle = user.metadata.handle
         timestamp = int(time.time())
         broadcast_id = digest(random.getrandbits(255)).encode("hex")
         self.db.broadcasts.save_broadcast(broadcast_id, guid.encode("hex"), handle, message,
@@ -11,7 +11,7 @@ from protos.countries import CountryCode
 
 def migratev2(db):
     ser = db.listings.get_proto()
-    if ser is not None:
+    if ser:
         path = os.path.join(DATA_FOLDER, "listings.csv")
         with open(path, 'w') as csvfile:
             fieldnames = ["contract_type", "pricing_currency", "language", "title", "description", "processing_time",
@@ -6,7 +6,6 @@ import gnupg
 import httplib
 import json
 import nacl.signing
-import nacl.hash
 import nacl.encoding
 import nacl.utils
 import obelisk
@@ -18,21 +17,25 @@ from binascii import unhexlify
 from bitcoin.core import b2lx
 from collections import OrderedDict
 from config import DATA_FOLDER, TRANSACTION_FEE
+from db.datastore import RATING_CATEGORIES, rating_scores
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, valid_guid, verify_ecdsa, verify_signature
 from keys.bip32utils import derive_childkey
 from keys.keychain import KeyChain
 from log import Logger
 from market.contracts import Contract
 from market.moderation import process_dispute, close_dispute
 from market.profile import Profile
-from market.protocol import MarketProtocol
+from market.protocol import MarketProtocol, RATING_PAGES_VERSION, RATINGS_AGGREGATE
 from market.transactions import BitcoinTransaction
 from nacl.public import PrivateKey, PublicKey, Box
 from protos import objects
+from protos.message import GET_PROFILE, GET_LISTINGS
 from seed import peers
 from twisted.internet import defer, reactor, task
 
+MAX_CHUNKS_IN_FLIGHT = 4
+
 
 class Server(object):
     def __init__(self, kserver, signing_key, database, audit=True):
@@ -47,6 +50,7 @@ class Server(object):
         self.db = database
         self.log = Logger(system=self)
         self.protocol = MarketProtocol(kserver.node, self.router, signing_key, database, audit)
+        self.image_downloads = {}
         task.LoopingCall(self.update_listings).start(3600, now=True)
 
     def querySeed(self, list_seed_pubkey):
@@ -71,8 +75,7 @@ class Server(object):
                 reread_data = data.decode("zlib")
                 proto = peers.PeerSeeds()
                 proto.ParseFromString(reread_data)
-                verify_key = nacl.signing.VerifyKey(pubkey, encoder=nacl.encoding.HexEncoder)
-                verify_key.verify("".join(proto.serializedNode), proto.signature)
+                verify_signature(unhexlify(pubkey), "".join(proto.serializedNode), proto.signature)
                 for peer in proto.serializedNode:
                     try:
                         n = objects.Node()
@@ -109,14 +112,11 @@ class Server(object):
                     signature = contract["vendor_offer"]["signatures"]["guid"]
                     verify_obj = json.dumps(contract["vendor_offer"]["listing"], indent=4)
 
-                    verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                    verify_key.verify(verify_obj, base64.b64decode(signature))
+                    verify_signature(node_to_ask.pubkey, verify_obj, base64.b64decode(signature))
 
                     bitcoin_key = contract["vendor_offer"]["listing"]["id"]["pubkeys"]["bitcoin"]
                     bitcoin_sig = contract["vendor_offer"]["signatures"]["bitcoin"]
-                    valid = bitcointools.ecdsa_raw_verify(verify_obj, bitcointools.decode_sig(bitcoin_sig),
-                                                          bitcoin_key)
-                    if not valid:
+                    if not verify_ecdsa(verify_obj, bitcoin_sig, bitcoin_key):
                         raise Exception("Invalid Bitcoin signature")
 
                     if "moderators" in contract["vendor_offer"]["listing"]:
@@ -125,12 +125,9 @@ class Server(object):
                             guid_key = moderator["pubkeys"]["guid"]
                             bitcoin_key = moderator["pubkeys"]["bitcoin"]["key"]
                             bitcoin_sig = base64.b64decode(moderator["pubkeys"]["bitcoin"]["signature"])
-                            h = nacl.hash.sha512(unhexlify(guid_key))
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or guid != h[:40]:
+                            if not valid_guid(unhexlify(guid), unhexlify(guid_key)):
                                 raise Exception('Invalid GUID')
-                            verify_key = nacl.signing.VerifyKey(guid_key, encoder=nacl.encoding.HexEncoder)
-                            verify_key.verify(unhexlify(bitcoin_key), bitcoin_sig)
+                            verify_signature(unhexlify(guid_key), unhexlify(bitcoin_key), bitcoin_sig)
                             #TODO: should probably also validate the handle here.
                     self.cache(result[1][0], id_in_contract)
                     if "image_hashes" in contract["vendor_offer"]["listing"]["item"]:
@@ -169,44 +166,204 @@ class Server(object):
             except Exception:
                 return None
 
+        def fetch(version):
+            if version > 3:
+                return self._get_image_chunked(node_to_ask, image_hash)
+            self.log.info("fetching image %s from %s" % (image_hash.encode("hex"), node_to_ask))
+            d = self.protocol.callGetImage(node_to_ask, image_hash)
+            return d.addCallback(get_result)
+
         if node_to_ask.ip is None or len(image_hash) != 20:
             return defer.succeed(None)
-        self.log.info("fetching image %s from %s" % (image_hash.encode("hex"), node_to_ask))
-        d = self.protocol.callGetImage(node_to_ask, image_hash)
-        return d.addCallback(get_result)
+        return self._get_remote_node_version(node_to_ask).addCallback(fetch)
 
-    def get_profile(self, node_to_ask):
+    def _get_image_chunked(self, node_to_ask, image_hash):
         """
-        Downloads the profile from the given node. If the images do not already
-        exist in cache, it will download and cache them before returning the profile.
+        Downloads an image using GET_IMAGE_CHUNK. The manifest is fetched first, then
+        the chunks are requested with at most MAX_CHUNKS_IN_FLIGHT outstanding at a time.
+        Each chunk is checked against its digest in the manifest and written to a .part
+        file in the cache, so if the download is interrupted the next attempt only
+        requests the chunks which are missing or corrupt. A chunk which still fails its
+        digest check after three retries fails the download and the .part file is removed.
         """
-
-        def get_result(result):
+        if image_hash in self.image_downloads:
+            waiter = defer.Deferred()
+            self.image_downloads[image_hash].append(waiter)
+            return waiter
+        self.image_downloads[image_hash] = []
+
+        hex_hash = image_hash.encode("hex")
+        part_path = os.path.join(DATA_FOLDER, "cache", hex_hash + ".part")
+        state = {"pending": [], "in_flight": 0, "retries": {}, "failed": False, "discard": False}
+        manifest = {}
+
+        def notify(image):
+            for waiter in self.image_downloads.pop(image_hash, []):
+                waiter.callback(image)
+
+        def finish():
+            image = None
+            if not state["failed"]:
+                try:
+                    with open(part_path, "rb") as part_file:
+                        image = part_file.read()
+                    if digest(image) == image_hash:
+                        os.rename(part_path, os.path.join(DATA_FOLDER, "cache", hex_hash))
+                    else:
+                        os.remove(part_path)
+                        image = None
+                except (IOError, OSError), e:
+                    self.log.warning("failed to save image %s: %s" % (hex_hash, str(e)))
+                    image = None
+            elif state["discard"] and os.path.isfile(part_path):
+                os.remove(part_path)
+            notify(image)
+            return image
+
+        def abort():
+            state["failed"] = True
+            del state["pending"][:]
+
+        def request_chunks():
+            while len(state["pending"]) > 0 and state["in_flight"] < MAX_CHUNKS_IN_FLIGHT:
+                index = state["pending"].pop(0)
+                state["in_flight"] += 1
+                self.protocol.callGetImageChunk(node_to_ask, image_hash, index).addCallbacks(
+                    save_chunk, chunk_failed, callbackArgs=(index,), errbackArgs=(index,))
+            if state["in_flight"] == 0 and not d.called:
+                d.callback(finish())
+
+        def save_chunk(result, index):
+            state["in_flight"] -= 1
+            try:
+                if not result[0]:
+                    self.log.warning("lost connection to %s while fetching image %s" % (node_to_ask, hex_hash))
+                    abort()
+                elif result[1] is not None and digest(result[1][0]) == manifest["hashes"][index]:
+                    with open(part_path, "r+b") as part_file:
+                        part_file.seek(index * manifest["chunk_size"])
+                        part_file.write(result[1][0])
+                elif state["retries"].get(index, 0) < 3:
+                    state["retries"][index] = state["retries"].get(index, 0) + 1
+                    state["pending"].append(index)
+                else:
+                    self.log.warning("chunk %s of image %s from %s is corrupt, giving up" %
+                                     (index, hex_hash, node_to_ask))
+                    state["discard"] = True
+                    abort()
+            except Exception, e:
+                self.log.warning("failed to save chunk %s of image %s: %s" % (index, hex_hash, str(e)))
+                abort()
+            finally:
+                request_chunks()
+
+        def chunk_failed(failure, index):
+            state["in_flight"] -= 1
+            self.log.warning("failed to fetch chunk %s of image %s from %s: %s" %
+                             (index, hex_hash, node_to_ask, failure.getErrorMessage()))
+            abort()
+            request_chunks()
+
+        def parse_manifest(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
-                p = objects.Profile()
-                p.ParseFromString(result[1][0])
-                if p.pgp_key.public_key:
-                    gpg = gnupg.GPG()
-                    gpg.import_keys(p.pgp_key.publicKey)
-                    if not gpg.verify(p.pgp_key.signature) or \
-                                    node_to_ask.id.encode('hex') not in p.pgp_key.signature:
-                        p.ClearField("pgp_key")
-                if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.avatar_hash.encode("hex"))):
-                    self.get_image(node_to_ask, p.avatar_hash)
-                if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.header_hash.encode("hex"))):
-                    self.get_image(node_to_ask, p.header_hash)
-                self.cache(result[1][0], node_to_ask.id.encode("hex") + ".profile")
-                return p
+                size = int(result[1][0])
+                chunk_size = int(result[1][1])
+                hashes = result[1][2]
+                count = (size + chunk_size - 1) // chunk_size
+                if chunk_size <= 0 or len(hashes) != count * 20:
+                    raise Exception("Invalid image manifest")
+                manifest["chunk_size"] = chunk_size
+                manifest["hashes"] = [hashes[i * 20:(i + 1) * 20] for i in range(count)]
             except Exception:
+                state["failed"] = True
+                notify(None)
                 return None
 
+            try:
+                if os.path.isfile(part_path):
+                    with open(part_path, "rb") as part_file:
+                        for index in range(count):
+                            if digest(part_file.read(chunk_size)) != manifest["hashes"][index]:
+                                state["pending"].append(index)
+                    self.log.info("resuming download of image %s from %s, %s of %s chunks remaining" %
+                                  (hex_hash, node_to_ask, len(state["pending"]), count))
+                else:
+                    open(part_path, "wb").close()
+                    state["pending"] = range(count)
+                    self.log.info("fetching image %s from %s in %s chunks" % (hex_hash, node_to_ask, count))
+            except IOError, e:
+                self.log.warning("failed to open the download of image %s: %s" % (hex_hash, str(e)))
+                state["failed"] = True
+                notify(None)
+                return None
+            request_chunks()
+            return d
+
+        def manifest_failed(failure):
+            self.log.warning("failed to fetch the manifest of image %s from %s: %s" %
+                             (hex_hash, node_to_ask, failure.getErrorMessage()))
+            state["failed"] = True
+            notify(None)
+            return None
+
+        d = defer.Deferred()
+        d_manifest = self.protocol.callGetImageChunk(node_to_ask, image_hash)
+        return d_manifest.addCallbacks(parse_manifest, manifest_failed)
+
+    def _remote_node_version(self, node):
+        """
+        Returns the protocol version advertised by the node or zero if we
+        don't have a connection to it.
+        """
+        peer = (node.ip, node.port)
+        if peer in self.protocol.multiplexer:
+            return self.protocol.multiplexer[peer].handler.remote_node_version
+        return 0
+
+    def _get_remote_node_version(self, node):
+        """
+        Fires with the protocol version advertised by the node. If we haven't heard
+        from it on the current connection it is pinged first, so the first request
+        to a peer isn't sent in the oldest form just because we didn't know better.
+        """
+        peer = (node.ip, node.port)
+        if peer in self.protocol.multiplexer and self.protocol.multiplexer[peer].handler.node is not None:
+            return defer.succeed(self.protocol.multiplexer[peer].handler.remote_node_version)
+        d = self.kserver.protocol.callPing(node)
+        return d.addBoth(lambda _: self._remote_node_version(node))
+
+    def get_profile(self, node_to_ask):
+        """
+        Downloads the profile from the given node. If the images do not already
+        exist in cache, it will download and cache them before returning the profile.
+        """
+
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching profile from %s" % node_to_ask)
         d = self.protocol.callGetProfile(node_to_ask)
-        return d.addCallback(get_result)
+        return d.addCallback(self._parse_profile, node_to_ask)
+
+    def _parse_profile(self, result, node_to_ask):
+        try:
+            verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
+            p = objects.Profile()
+            p.ParseFromString(result[1][0])
+            if p.pgp_key.public_key:
+                gpg = gnupg.GPG()
+                gpg.import_keys(p.pgp_key.publicKey)
+                if not gpg.verify(p.pgp_key.signature) or \
+                                node_to_ask.id.encode('hex') not in p.pgp_key.signature:
+                    p.ClearField("pgp_key")
+            if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.avatar_hash.encode("hex"))):
+                self.get_image(node_to_ask, p.avatar_hash)
+            if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', p.header_hash.encode("hex"))):
+                self.get_image(node_to_ask, p.header_hash)
+            self.cache(result[1][0], node_to_ask.id.encode("hex") + ".profile")
+            self.db.messages.update_conversation_profile(node_to_ask.id.encode("hex"), p.handle, p.avatar_hash)
+            return p
+        except Exception:
+            return None
 
     def get_user_metadata(self, node_to_ask):
         """
@@ -218,8 +375,7 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 m = objects.Metadata()
                 m.ParseFromString(result[1][0])
                 if not os.path.isfile(os.path.join(DATA_FOLDER, 'cache', m.avatar_hash.encode("hex"))):
@@ -241,21 +397,46 @@ class Server(object):
         should be fetched with a get_contract call.
         """
 
-        def get_result(result):
-            try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
-                l = objects.Listings()
-                l.ParseFromString(result[1][0])
-                return l
-            except Exception:
-                return None
-
         if node_to_ask.ip is None:
             return defer.succeed(None)
         self.log.info("fetching store listings from %s" % node_to_ask)
         d = self.protocol.callGetListings(node_to_ask)
-        return d.addCallback(get_result)
+        return d.addCallback(self._parse_listings, node_to_ask)
+
+    @staticmethod
+    def _parse_listings(result, node_to_ask):
+        try:
+            verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
+            l = objects.Listings()
+            l.ParseFromString(result[1][0])
+            return l
+        except Exception:
+            return None
+
+    def get_store(self, node_to_ask):
+        """
+        Downloads the profile and listings needed to render a store page. If the
+        remote node supports it both requests are sent in a single BATCH message,
+        otherwise they are fetched separately. The deferred fires with a
+        (`Profile`, `Listings`) tuple, either of which may be None.
+        """
+
+        def get_results(results):
+            return (self._parse_profile(results[0], node_to_ask),
+                    self._parse_listings(results[1], node_to_ask))
+
+        def fetch(version):
+            if version > 2:
+                self.log.info("fetching store from %s" % node_to_ask)
+                d = self.protocol.callBatch(node_to_ask, [(GET_PROFILE, ()), (GET_LISTINGS, ())])
+                return d.addCallback(get_results)
+            else:
+                d = defer.gatherResults([self.get_profile(node_to_ask), self.get_listings(node_to_ask)])
+                return d.addCallback(tuple)
+
+        if node_to_ask.ip is None:
+            return defer.succeed((None, None))
+        return self._get_remote_node_version(node_to_ask).addCallback(fetch)
 
     def get_contract_metadata(self, node_to_ask, contract_hash):
         """
@@ -266,8 +447,7 @@ class Server(object):
 
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 l = objects.Listings().ListingMetadata()
                 l.ParseFromString(result[1][0])
                 if l.thumbnail_hash != "":
@@ -329,8 +509,7 @@ class Server(object):
                     m.ParseFromString(result[1][1])
                     u.metadata.MergeFrom(m)
                     u.signature = result[1][2]
-                    verify_key = nacl.signing.VerifyKey(node_to_follow.pubkey)
-                    verify_key.verify(result[1][1], result[1][2])
+                    verify_signature(node_to_follow.pubkey, result[1][1], result[1][2])
                     self.db.follow.follow(u)
                     return True
                 except Exception:
@@ -380,36 +559,39 @@ class Server(object):
         Query the given node for a list if its followers. The response will be a
         `Followers` protobuf object. We will verify the signature for each follower
         to make sure that node really did follower this user.
+
+        Returns a `tuple` of the followers, the total number of followers and the
+        cursor to pass as `start` for the next page, which is None if the node is
+        older and doesn't return one or this was the last page.
         """
 
         def get_response(response):
             # Verify the signature on the response
             f = objects.Followers()
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(response[1][0], response[1][1])
+                verify_signature(node_to_ask.pubkey, response[1][0], response[1][1])
                 f.ParseFromString(response[1][0])
             except Exception:
-                return (None, None)
+                return (None, None, None)
             # Verify the signature and guid of each follower.
             count = None
             if len(response[1]) > 2:
                 count = response[1][2]
+            next_page = None
+            if len(response[1]) > 3 and response[1][3]:
+                next_page = response[1][3]
             for follower in f.followers:
                 try:
-                    v_key = nacl.signing.VerifyKey(follower.pubkey)
                     signature = follower.signature
                     follower.ClearField("signature")
-                    v_key.verify(follower.SerializeToString(), signature)
-                    h = nacl.hash.sha512(follower.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or follower.guid.encode("hex") != h[:40]:
+                    verify_signature(follower.pubkey, follower.SerializeToString(), signature)
+                    if not valid_guid(follower.guid, follower.pubkey):
                         raise Exception('Invalid GUID')
                     if follower.following != node_to_ask.id:
                         raise Exception('Invalid follower')
                 except Exception:
                     f.followers.remove(follower)
-            return (f, count)
+            return (f, count, next_page)
 
         peer = (node_to_ask.ip, node_to_ask.port)
         if peer in self.protocol.multiplexer and \
@@ -433,19 +615,14 @@ class Server(object):
             # Verify the signature on the response
             f = objects.Following()
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(response[1][0], response[1][1])
+                verify_signature(node_to_ask.pubkey, response[1][0], response[1][1])
                 f.ParseFromString(response[1][0])
             except Exception:
                 return None
             for user in f.users:
                 try:
-                    v_key = nacl.signing.VerifyKey(user.pubkey)
-                    signature = user.signature
-                    v_key.verify(user.metadata.SerializeToString(), signature)
-                    h = nacl.hash.sha512(user.pubkey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or user.guid.encode("hex") != h[:40]:
+                    verify_signature(user.pubkey, user.metadata.SerializeToString(), user.signature)
+                    if not valid_guid(user.guid, user.pubkey):
                         raise Exception('Invalid GUID')
                 except Exception:
                     f.users.remove(user)
@@ -481,7 +658,11 @@ class Server(object):
             return defer.DeferredList(ds).addCallback(how_many_reached)
         dl = []
         f = objects.Followers()
-        f.ParseFromString(self.db.follow.get_followers())
+        ser, count, next_page = self.db.follow.get_followers()
+        f.ParseFromString(ser)
+        while next_page is not None:
+            ser, count, next_page = self.db.follow.get_followers(next_page)
+            f.MergeFromString(ser)
         for follower in f.followers:
             dl.append(self.kserver.resolve(follower.guid))
         self.log.info("broadcasting %s to followers" % message)
@@ -545,11 +726,8 @@ class Server(object):
                             p.ParseFromString(plaintext)
                             signature = p.signature
                             p.ClearField("signature")
-                            verify_key = nacl.signing.VerifyKey(p.pubkey)
-                            verify_key.verify(p.SerializeToString(), signature)
-                            h = nacl.hash.sha512(p.pubkey)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or p.sender_guid.encode("hex") != h[:40]:
+                            verify_signature(p.pubkey, p.SerializeToString(), signature)
+                            if not valid_guid(p.sender_guid, p.pubkey):
                                 raise Exception('Invalid guid')
                             if p.type == objects.PlaintextMessage.Type.Value("ORDER_CONFIRMATION"):
                                 c = Contract(self.db, hash_value=unhexlify(p.subject),
@@ -604,9 +782,8 @@ class Server(object):
                 buyer_key = derive_childkey(masterkey_b, chaincode)
                 amount = contract.contract["buyer_order"]["order"]["payment"]["amount"]
                 listing_hash = contract.contract["vendor_offer"]["listing"]["contract_id"]
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(
-                    str(address) + str(amount) + str(listing_hash) + str(buyer_key), response[1][0])
+                verify_signature(node_to_ask.pubkey,
+                                 str(address) + str(amount) + str(listing_hash) + str(buyer_key), response[1][0])
                 return response[1][0]
             except Exception:
                 return False
@@ -1033,40 +1210,9 @@ class Server(object):
         """
         def get_result(result):
             try:
-                verify_key = nacl.signing.VerifyKey(node_to_ask.pubkey)
-                verify_key.verify(result[1][0], result[1][1])
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
                 ratings = json.loads(result[1][0].decode("zlib"), object_pairs_hook=OrderedDict)
-                ret = []
-                for rating in ratings:
-                    address = rating["tx_summary"]["address"]
-                    buyer_key = rating["tx_summary"]["buyer_key"]
-                    amount = rating["tx_summary"]["amount"]
-                    listing_hash = rating["tx_summary"]["listing"]
-                    proof_sig = rating["tx_summary"]["proof_of_tx"]
-                    try:
-                        verify_key.verify(str(address) + str(amount) + str(listing_hash) + str(buyer_key),
-                                          base64.b64decode(proof_sig))
-
-                        valid = bitcointools.ecdsa_raw_verify(json.dumps(rating["tx_summary"], indent=4),
-                                                              bitcointools.decode_sig(rating["signature"]),
-                                                              buyer_key)
-                        if not valid:
-                            raise Exception("Bitcoin signature not valid")
-
-                        if "buyer_guid" in rating["tx_summary"] or "buyer_guid_key" in rating["tx_summary"]:
-                            buyer_key_bin = unhexlify(rating["tx_summary"]["buyer_guid_key"])
-                            buyer_key = nacl.signing.VerifyKey(buyer_key_bin)
-                            buyer_key.verify(json.dumps(rating["tx_summary"], indent=4),
-                                             base64.b64decode(rating["guid_signature"]))
-                            h = nacl.hash.sha512(buyer_key_bin)
-                            pow_hash = h[40:]
-                            if int(pow_hash[:6], 16) >= 50 or rating["tx_summary"]["buyer_guid"] != h[:40]:
-                                raise Exception('Invalid GUID')
-
-                        ret.append(rating)
-                    except Exception:
-                        pass
-                return ret
+                return self._verify_ratings(node_to_ask, ratings)
             except Exception:
                 return None
 
@@ -1077,6 +1223,108 @@ class Server(object):
         d = self.protocol.callGetRatings(node_to_ask, listing_hash)
         return d.addCallback(get_result)
 
+    def get_ratings_page(self, node_to_ask, listing_hash=None, start=""):
+        """
+        Query the given node for a page of ratings for the given listing, or for all
+        its listings if `listing_hash` is None. Returns a `tuple` of the ratings and the
+        value to pass as `start` for the next page, which is None on the last page.
+        Older nodes return all the ratings in one go.
+        """
+        def get_result(result):
+            try:
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
+                ratings = json.loads(result[1][0].decode("zlib"), object_pairs_hook=OrderedDict)
+                next_page = result[1][2] if len(result[1]) > 2 and result[1][2] else None
+                return (self._verify_ratings(node_to_ask, ratings), next_page)
+            except Exception:
+                return (None, None)
+
+        def fetch(version):
+            if version < RATING_PAGES_VERSION:
+                if start:
+                    return ([], None)
+                return self.get_ratings(node_to_ask, listing_hash).addCallback(lambda ratings: (ratings, None))
+            a = "ALL" if listing_hash is None else listing_hash.encode("hex")
+            self.log.info("fetching page of ratings for contract %s from %s" % (a, node_to_ask))
+            d = self.protocol.callGetRatings(node_to_ask, listing_hash, start)
+            return d.addCallback(get_result)
+
+        if node_to_ask.ip is None:
+            return defer.succeed((None, None))
+        return self._get_remote_node_version(node_to_ask).addCallback(fetch)
+
+    def get_rating_aggregate(self, node_to_ask, listing_hash=None):
+        """
+        Query the given node for the number of ratings for the given listing, or for
+        all its listings, with the sum of the scores in each category and how many
+        ratings gave one to five stars. The node could lie about these, unlike the
+        ratings themselves, which are signed by the buyers. For older nodes all the
+        ratings are downloaded and verified to work them out.
+        """
+        def get_result(result):
+            try:
+                verify_signature(node_to_ask.pubkey, result[1][0], result[1][1])
+                return json.loads(result[1][0].decode("zlib"))
+            except Exception:
+                return None
+
+        def aggregate(ratings):
+            if ratings is None:
+                return None
+            ret = {"count": len(ratings), "sums": dict((c, 0) for c in RATING_CATEGORIES), "stars": [0] * 5}
+            for rating in ratings:
+                scores = rating_scores(rating)
+                for category, score in zip(RATING_CATEGORIES, scores):
+                    ret["sums"][category] += score
+                if scores[0] > 0:
+                    ret["stars"][scores[0] - 1] += 1
+            return ret
+
+        def fetch(version):
+            if version < RATING_PAGES_VERSION:
+                return self.get_ratings(node_to_ask, listing_hash).addCallback(aggregate)
+            a = "ALL" if listing_hash is None else listing_hash.encode("hex")
+            self.log.info("fetching rating aggregate for contract %s from %s" % (a, node_to_ask))
+            d = self.protocol.callGetRatings(node_to_ask, listing_hash, RATINGS_AGGREGATE)
+            return d.addCallback(get_result)
+
+        if node_to_ask.ip is None:
+            return defer.succeed(None)
+        return self._get_remote_node_version(node_to_ask).addCallback(fetch)
+
+    @staticmethod
+    def _verify_ratings(node_to_ask, ratings):
+        """
+        Returns the ratings whose proof of transaction and buyer signatures are valid.
+        """
+        ret = []
+        for rating in ratings:
+            try:
+                address = rating["tx_summary"]["address"]
+                buyer_key = rating["tx_summary"]["buyer_key"]
+                amount = rating["tx_summary"]["amount"]
+                listing_hash = rating["tx_summary"]["listing"]
+                proof_sig = rating["tx_summary"]["proof_of_tx"]
+                verify_signature(node_to_ask.pubkey,
+                                 str(address) + str(amount) + str(listing_hash) + str(buyer_key),
+                                 base64.b64decode(proof_sig))
+
+                if not verify_ecdsa(json.dumps(rating["tx_summary"], indent=4),
+                                    rating["signature"], buyer_key):
+                    raise Exception("Bitcoin signature not valid")
+
+                if "buyer_guid" in rating["tx_summary"] or "buyer_guid_key" in rating["tx_summary"]:
+                    buyer_key_bin = unhexlify(rating["tx_summary"]["buyer_guid_key"])
+                    verify_signature(buyer_key_bin, json.dumps(rating["tx_summary"], indent=4),
+                                     base64.b64decode(rating["guid_signature"]))
+                    if not valid_guid(unhexlify(rating["tx_summary"]["buyer_guid"]), buyer_key_bin):
+                        raise Exception('Invalid GUID')
+
+                ret.append(rating)
+            except Exception:
+                pass
+        return ret
+
     def refund(self, order_id):
         """
         Refund the given order_id. If this is a direct payment he transaction will be
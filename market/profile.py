@@ -1,6 +1,5 @@
 __author__ = 'chris'
 import gnupg
-from protos import objects
 
 
 class Profile(object):
@@ -12,10 +11,8 @@ class Profile(object):
     """
 
     def __init__(self, db):
-        self.profile = objects.Profile()
         self.db = db
-        if self.db.profile.get_proto() is not None:
-            self.profile.ParseFromString(self.db.profile.get_proto())
+        self.profile = self.db.profile.get_profile()
 
     def get(self, serialized=False):
         if serialized:
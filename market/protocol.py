@@ -7,7 +7,9 @@ import nacl.encoding
 import nacl.hash
 from binascii import unhexlify
 from collections import OrderedDict
+from db.asyncdb import AsyncDatabase
 from interfaces import MessageProcessor, BroadcastListener, MessageListener, NotificationListener
+from dht.utils import digest, LRUCache
 from keys.bip32utils import derive_childkey
 from log import Logger
 from market.audit import Audit
@@ -19,16 +21,29 @@ from nacl.public import PublicKey, Box
 from net.rpcudp import RPCProtocol
 from protos.message import GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,\
     GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING, BROADCAST, MESSAGE, ORDER, \
-    ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND
+    ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, GET_RATINGS, REFUND, BATCH, \
+    GET_IMAGE_CHUNK
 from protos.objects import Metadata, Listings, Followers, PlaintextMessage
 from zope.interface import implements
 from zope.interface.exceptions import DoesNotImplement
 from zope.interface.verify import verifyObject
 
+IMAGE_CHUNK_SIZE = 32768
+
+# Nodes from this version on accept a `start` argument with GET_RATINGS. It's either
+# RATINGS_AGGREGATE, to get the rating counts and scores for the listing, or the id of
+# the last rating on the previous page ("" for the first page) to get a page of ratings.
+RATING_PAGES_VERSION = 7
+RATINGS_AGGREGATE = "aggregate"
+
 
 class MarketProtocol(RPCProtocol):
     implements(MessageProcessor)
 
+    batchable_commands = (GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,
+                          GET_CONTRACT_METADATA, GET_FOLLOWING, GET_RATINGS)
+    sheddable_commands = (GET_IMAGE, GET_IMAGE_CHUNK, GET_FOLLOWERS)
+
     def __init__(self, node, router, signing_key, database, audit=True):
         self.router = router
         self.node = node
@@ -37,12 +52,17 @@ class MarketProtocol(RPCProtocol):
         self.audit = Audit(db=database, enabled=audit)
         self.multiplexer = None
         self.db = database
+        self.adb = AsyncDatabase(database)
         self.signing_key = signing_key
         self.listeners = []
         self.handled_commands = [GET_CONTRACT, GET_IMAGE, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA,
                                  GET_CONTRACT_METADATA, FOLLOW, UNFOLLOW, GET_FOLLOWERS, GET_FOLLOWING,
                                  BROADCAST, MESSAGE, ORDER, ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN,
-                                 DISPUTE_CLOSE, GET_RATINGS, REFUND]
+                                 DISPUTE_CLOSE, GET_RATINGS, REFUND, BATCH, GET_IMAGE_CHUNK]
+        self.image_manifests = LRUCache(100)
+        # signed GET_FOLLOWERS responses by start cursor, dropped whenever our followers change
+        self.follower_pages = LRUCache(100)
+        self.followers_changed = 0
 
     def connect_multiplexer(self, multiplexer):
         self.multiplexer = multiplexer
@@ -54,44 +74,97 @@ class MarketProtocol(RPCProtocol):
         self.log.info("serving contract %s to %s" % (contract_hash.encode('hex'), sender))
         self.audit.record(sender.id.encode("hex"), "GET_CONTRACT", contract_hash.encode('hex'))
         self.router.addContact(sender)
-        try:
-            with open(self.db.filemap.get_file(contract_hash.encode("hex")), "r") as filename:
-                contract = filename.read()
-            return [contract]
-        except Exception:
+
+        def read_contract(db):
+            with open(db.filemap.get_file(contract_hash.encode("hex")), "r") as filename:
+                return [filename.read()]
+
+        def not_found(failure):
             self.log.warning("could not find contract %s" % contract_hash.encode('hex'))
             return None
+        return self.adb.runInteraction(read_contract).addErrback(not_found)
 
     def rpc_get_image(self, sender, image_hash):
         self.router.addContact(sender)
-        try:
-            if len(image_hash) != 20:
-                self.log.warning("Image hash is not 20 characters %s" % image_hash)
-                raise Exception("Invalid image hash")
-            self.log.info("serving image %s to %s" % (image_hash.encode('hex'), sender))
-            with open(self.db.filemap.get_file(image_hash.encode("hex")), "rb") as filename:
-                image = filename.read()
-            return [image]
-        except Exception:
-            self.log.warning("could not find image %s" % image_hash[:20].encode('hex'))
-            return None
+        if len(image_hash) != 20:
+            self.log.warning("Image hash is not 20 characters %s" % image_hash)
+            return self._image_not_found(None, image_hash)
+        self.log.info("serving image %s to %s" % (image_hash.encode('hex'), sender))
+
+        def read_image(db):
+            with open(db.filemap.get_file(image_hash.encode("hex")), "rb") as filename:
+                return [filename.read()]
+        return self.adb.runInteraction(read_image).addErrback(self._image_not_found, image_hash)
+
+    def _image_not_found(self, failure, image_hash):
+        self.log.warning("could not find image %s" % image_hash[:20].encode('hex'))
+        return None
+
+    def rpc_get_image_chunk(self, sender, image_hash, index=None):
+        """
+        Serves an image in fixed size chunks. Without an index the response is the image
+        manifest: its size, the chunk size and the concatenated digests of each chunk.
+        With an index the response is that chunk, read from disk without loading the
+        rest of the image.
+        """
+        self.router.addContact(sender)
+        if len(image_hash) != 20:
+            self.log.warning("Image hash is not 20 characters %s" % image_hash)
+            return self._image_not_found(None, image_hash)
+
+        if index is None:
+            manifest = self.image_manifests.get(image_hash)
+            if manifest is not None:
+                self.log.info("serving manifest for image %s to %s" % (image_hash.encode('hex'), sender))
+                return manifest
+
+        def read_manifest(db):
+            size = 0
+            chunk_hashes = []
+            with open(db.filemap.get_file(image_hash.encode("hex")), "rb") as image_file:
+                for chunk in iter(lambda: image_file.read(IMAGE_CHUNK_SIZE), ""):
+                    size += len(chunk)
+                    chunk_hashes.append(digest(chunk))
+            return [str(size), str(IMAGE_CHUNK_SIZE), "".join(chunk_hashes)]
+
+        def cache_manifest(manifest):
+            self.image_manifests[image_hash] = manifest
+            self.log.info("serving manifest for image %s to %s" % (image_hash.encode('hex'), sender))
+            return manifest
+
+        def read_chunk(db):
+            with open(db.filemap.get_file(image_hash.encode("hex")), "rb") as image_file:
+                image_file.seek(int(index) * IMAGE_CHUNK_SIZE)
+                chunk = image_file.read(IMAGE_CHUNK_SIZE)
+            if chunk == "":
+                raise Exception("Chunk index out of range")
+            return [chunk]
+
+        if index is None:
+            d = self.adb.runInteraction(read_manifest).addCallback(cache_manifest)
+        else:
+            d = self.adb.runInteraction(read_chunk)
+        return d.addErrback(self._image_not_found, image_hash)
 
     def rpc_get_profile(self, sender):
         self.log.info("serving profile to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_PROFILE")
         self.router.addContact(sender)
-        try:
-            proto = Profile(self.db).get(True)
+
+        def sign_profile(proto):
             return [proto, self.signing_key.sign(proto)[:64]]
-        except Exception:
+
+        def failed(failure):
             self.log.error("unable to load the profile")
             return None
+        d = self.adb.runInteraction(lambda db: Profile(db).get(True))
+        return d.addCallback(sign_profile).addErrback(failed)
 
     def rpc_get_user_metadata(self, sender):
         self.log.info("serving user metadata to %s" % sender)
         self.router.addContact(sender)
-        try:
-            proto = Profile(self.db).get(False)
+
+        def sign_metadata(proto):
             m = Metadata()
             m.name = proto.name
             m.handle = proto.handle
@@ -99,45 +172,57 @@ class MarketProtocol(RPCProtocol):
             m.avatar_hash = proto.avatar_hash
             m.nsfw = proto.nsfw
             return [m.SerializeToString(), self.signing_key.sign(m.SerializeToString())[:64]]
-        except Exception:
+
+        def failed(failure):
             self.log.error("unable to load profile metadata")
             return None
+        d = self.adb.runInteraction(lambda db: Profile(db).get(False))
+        return d.addCallback(sign_metadata).addErrback(failed)
 
     def rpc_get_listings(self, sender):
         self.log.info("serving store listings to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_LISTINGS")
         self.router.addContact(sender)
-        try:
-            p = Profile(self.db).get()
+
+        def load_listings(db):
+            ser = db.listings.get_proto(include_hidden=False)
+            p = Profile(db).get()
             l = Listings()
-            l.ParseFromString(self.db.listings.get_proto())
             l.handle = p.handle
             l.avatar_hash = p.avatar_hash
-            for listing in l.listing:
-                if listing.hidden:
-                    l.listing.remove(listing)
-            return [l.SerializeToString(), self.signing_key.sign(l.SerializeToString())[:64]]
-        except Exception:
+            # serialized protobufs can be concatenated, so there's no need to parse the cached listings
+            return ser + l.SerializeToString()
+
+        def sign_listings(ser):
+            return [ser, self.signing_key.sign(ser)[:64]]
+
+        def not_found(failure):
             self.log.warning("could not find any listings in the database")
             return None
+        return self.adb.runInteraction(load_listings).addCallback(sign_listings).addErrback(not_found)
 
     def rpc_get_contract_metadata(self, sender, contract_hash):
         self.log.info("serving metadata for contract %s to %s" % (contract_hash.encode("hex"), sender))
         self.router.addContact(sender)
-        try:
-            proto = self.db.listings.get_proto()
-            p = Profile(self.db).get()
-            l = Listings()
-            l.ParseFromString(proto)
-            for listing in l.listing:
-                if listing.contract_hash == contract_hash:
-                    listing.avatar_hash = p.avatar_hash
-                    listing.handle = p.handle
-                    ser = listing.SerializeToString()
+
+        def load_metadata(db):
+            ser = db.listings.get_listing(contract_hash)
+            if ser is None:
+                raise Exception("Contract not found")
+            p = Profile(db).get()
+            listing = Listings.ListingMetadata()
+            listing.ParseFromString(ser)
+            listing.avatar_hash = p.avatar_hash
+            listing.handle = p.handle
+            return listing.SerializeToString()
+
+        def sign_metadata(ser):
             return [ser, self.signing_key.sign(ser)[:64]]
-        except Exception:
+
+        def not_found(failure):
             self.log.warning("could not find metadata for contract %s" % contract_hash.encode("hex"))
             return None
+        return self.adb.runInteraction(load_metadata).addCallback(sign_metadata).addErrback(not_found)
 
     def rpc_follow(self, sender, proto, signature):
         self.log.info("received follow request from %s" % sender)
@@ -153,6 +238,7 @@ class MarketProtocol(RPCProtocol):
                 raise Exception('Following wrong node')
             f.signature = signature
             self.db.follow.set_follower(f.SerializeToString())
+            self._clear_follower_pages()
             proto = Profile(self.db).get(False)
             m = Metadata()
             m.name = proto.name
@@ -187,6 +273,7 @@ class MarketProtocol(RPCProtocol):
             verify_key.verify("unfollow:" + self.node.id, signature)
             f = self.db.follow
             f.delete_follower(sender.id)
+            self._clear_follower_pages()
             return ["True"]
         except Exception:
             self.log.warning("failed to validate signature on unfollow request")
@@ -196,21 +283,36 @@ class MarketProtocol(RPCProtocol):
         self.log.info("serving followers list to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_FOLLOWERS")
         self.router.addContact(sender)
-        if start is not None:
-            ser = self.db.follow.get_followers(int(start))
-        else:
-            ser = self.db.follow.get_followers()
-        return [ser[0], self.signing_key.sign(ser[0])[:64], ser[1]]
+
+        start = "0" if start is None else str(start)
+        response = self.follower_pages.get(start)
+        if response is not None:
+            return response
+        changed = self.followers_changed
+
+        def sign_followers(ser):
+            response = [ser[0], self.signing_key.sign(ser[0])[:64], ser[1], ser[2] or ""]
+            # don't cache a page which was read before a follow or unfollow landed
+            if changed == self.followers_changed:
+                self.follower_pages[start] = response
+            return response
+        return self.adb.follow.get_followers(start).addCallback(sign_followers)
+
+    def _clear_follower_pages(self):
+        self.follower_pages.clear()
+        self.followers_changed += 1
 
     def rpc_get_following(self, sender):
         self.log.info("serving following list to %s" % sender)
         self.audit.record(sender.id.encode("hex"), "GET_FOLLOWING")
         self.router.addContact(sender)
-        ser = self.db.follow.get_following()
-        if ser is None:
-            return None
-        else:
-            return [ser, self.signing_key.sign(ser)[:64]]
+
+        def sign_following(ser):
+            if ser is None:
+                return None
+            else:
+                return [ser, self.signing_key.sign(ser)[:64]]
+        return self.adb.follow.get_following().addCallback(sign_following)
 
     def rpc_broadcast(self, sender, message, signature):
         if len(message) <= 140 and self.db.follow.is_following(sender.id):
@@ -353,24 +455,36 @@ class MarketProtocol(RPCProtocol):
             self.log.error("unable to parse disputed close message from %s" % sender)
             return ["False"]
 
-    def rpc_get_ratings(self, sender, listing_hash=None):
-        a = "ALL" if listing_hash is None else listing_hash.encode("hex")
+    def rpc_get_ratings(self, sender, listing_hash=None, start=None):
+        a = "ALL" if not listing_hash else listing_hash.encode("hex")
         self.log.info("serving ratings for contract %s to %s" % (a, sender))
         self.audit.record(sender.id.encode("hex"), "GET_RATINGS", a)
         self.router.addContact(sender)
-        try:
+        listing = listing_hash.encode("hex") if listing_hash else None
+
+        def load_ratings(db):
+            if start == RATINGS_AGGREGATE:
+                return [json.dumps(db.ratings.get_aggregate(listing)).encode("zlib")]
+            if start is not None:
+                page, next_page = db.ratings.get_ratings_page(listing, start)
+                ratings = [json.loads(rating, object_pairs_hook=OrderedDict) for rating in page]
+                return [json.dumps(ratings).encode("zlib"), next_page or ""]
             ratings = []
             if listing_hash:
-                for rating in self.db.ratings.get_listing_ratings(listing_hash.encode("hex")):
+                for rating in db.ratings.get_listing_ratings(listing):
                     ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
             else:
-                for rating in self.db.ratings.get_all_ratings():
+                for rating in db.ratings.get_all_ratings():
                     ratings.append(json.loads(rating[0], object_pairs_hook=OrderedDict))
-            ret = json.dumps(ratings).encode("zlib")
-            return [str(ret), self.signing_key.sign(ret)[:64]]
-        except Exception:
+            return [json.dumps(ratings).encode("zlib")]
+
+        def sign_ratings(ret):
+            return [str(ret[0]), self.signing_key.sign(ret[0])[:64]] + ret[1:]
+
+        def failed(failure):
             self.log.warning("could not load ratings for contract %s" % a)
             return None
+        return self.adb.runInteraction(load_ratings).addCallback(sign_ratings).addErrback(failed)
 
     def rpc_refund(self, sender, pubkey, encrypted):
         try:
@@ -395,6 +509,13 @@ class MarketProtocol(RPCProtocol):
         d = self.get_image(nodeToAsk, image_hash)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callGetImageChunk(self, nodeToAsk, image_hash, index=None):
+        if index is None:
+            d = self.get_image_chunk(nodeToAsk, image_hash)
+        else:
+            d = self.get_image_chunk(nodeToAsk, image_hash, index)
+        return d.addCallback(self.handleCallResponse, nodeToAsk)
+
     def callGetProfile(self, nodeToAsk):
         d = self.get_profile(nodeToAsk)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
@@ -458,8 +579,10 @@ class MarketProtocol(RPCProtocol):
         d = self.dispute_close(nodeToAsk, ephem_pubkey, encrypted_contract)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
-    def callGetRatings(self, nodeToAsk, listing_hash=None):
-        if listing_hash is None:
+    def callGetRatings(self, nodeToAsk, listing_hash=None, start=None):
+        if start is not None:
+            d = self.get_ratings(nodeToAsk, listing_hash or "", start)
+        elif listing_hash is None:
             d = self.get_ratings(nodeToAsk)
         else:
             d = self.get_ratings(nodeToAsk, listing_hash)
@@ -469,6 +592,17 @@ class MarketProtocol(RPCProtocol):
         d = self.refund(nodeToAsk, order_id, refund)
         return d.addCallback(self.handleCallResponse, nodeToAsk)
 
+    def callBatch(self, nodeToAsk, requests):
+        """
+        Sends several requests to the node in a single BATCH message. `requests` is
+        a list of (command, args) tuples and the deferred fires with a list holding
+        one result per request, in the same form as the matching callXxx method.
+        """
+        serialized = [self.serialize_batch_request(command, *args) for command, args in requests]
+        d = self.batch(nodeToAsk, *serialized)
+        d.addCallback(self.handleCallResponse, nodeToAsk)
+        return d.addCallback(self.parse_batch_response, len(requests), nodeToAsk)
+
     def handleCallResponse(self, result, node):
         """
         If we get a response, add the node to the routing table.  If
@@ -476,6 +610,8 @@ class MarketProtocol(RPCProtocol):
         """
         if result[0]:
             self.router.addContact(node)
+        elif self.is_backing_off(node):
+            self.log.debug("%s asked us to calm down, keeping it in the router" % node)
         else:
             self.log.debug("no response from %s, removing from router" % node)
             self.router.removeContact(node)
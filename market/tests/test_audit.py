@@ -0,0 +1,37 @@
+import os
+from twisted.trial import unittest
+
+from db.datastore import Database
+from market.audit import Audit
+
+
+class AuditTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database(filepath="test_audit.db")
+        self.audit = Audit(self.db, batch_size=3)
+
+    def tearDown(self):
+        self.audit.stop()
+        self.db.close()
+        os.remove("test_audit.db")
+
+    def test_record_buffers_events(self):
+        self.audit.record("guid", "GET_CONTRACT", "contract")
+        self.audit.record("guid", "GET_PROFILE")
+        self.assertEqual(len(self.audit.events), 2)
+        self.assertEqual(self.db.audit_shopping.get(), [])
+
+        self.audit.record("guid", "GET_LISTINGS")
+        self.assertEqual(self.audit.events, [])
+        self.assertEqual(len(self.db.audit_shopping.get()), 3)
+
+    def test_stop_flushes_events(self):
+        self.audit.record("guid", "GET_RATINGS", "contract")
+        self.audit.stop()
+        self.assertFalse(self.audit.flush_loop.running)
+        self.assertEqual([e[2] for e in self.db.audit_shopping.get()], ["contract"])
+
+    def test_disabled(self):
+        audit = Audit(self.db, enabled=False)
+        audit.record("guid", "GET_PROFILE")
+        self.assertEqual(audit.events, [])
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+from mock import MagicMock, patch
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from dht.node import Node
+from dht.utils import digest
+from log import Logger
+from market.network import Server, MAX_CHUNKS_IN_FLIGHT
+from market.protocol import RATING_PAGES_VERSION, RATINGS_AGGREGATE
+
+CHUNK_SIZE = 100
+
+
+class FakeProtocol(object):
+    """
+    Answers GET_IMAGE_CHUNK calls for one image. Chunk requests are held until
+    `answer` is called so the tests control the order and count what is in flight.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.corrupt = {}
+        self.requested = []
+        self.outstanding = []
+
+    def chunk(self, index):
+        return self.image[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+
+    def callGetImageChunk(self, node, image_hash, index=None):
+        if index is None:
+            count = (len(self.image) + CHUNK_SIZE - 1) // CHUNK_SIZE
+            hashes = "".join(digest(self.chunk(i)) for i in range(count))
+            return defer.succeed((True, (str(len(self.image)), str(CHUNK_SIZE), hashes)))
+        self.requested.append(index)
+        d = defer.Deferred()
+        self.outstanding.append((index, d))
+        return d
+
+    def answer(self):
+        while len(self.outstanding) > 0:
+            index, d = self.outstanding.pop(0)
+            if self.corrupt.get(index, 0) > 0:
+                self.corrupt[index] -= 1
+                d.callback((True, ("x" * CHUNK_SIZE,)))
+            else:
+                d.callback((True, (self.chunk(index),)))
+
+
+class ImageDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.data_folder, "cache"))
+        self.addCleanup(shutil.rmtree, self.data_folder)
+        patcher = patch("market.network.DATA_FOLDER", self.data_folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.image = os.urandom(CHUNK_SIZE * 9 + 50)
+        self.image_hash = digest(self.image)
+        self.part_path = os.path.join(self.data_folder, "cache", self.image_hash.encode("hex") + ".part")
+        self.protocol = FakeProtocol(self.image)
+        self.server = Server.__new__(Server)
+        self.server.protocol = self.protocol
+        self.server.image_downloads = {}
+        self.server.log = Logger(system=self.server)
+        self.node = Node(digest("node"), "127.0.0.1", 18467)
+
+    def download(self):
+        results = []
+        self.server._get_image_chunked(self.node, self.image_hash).addCallback(results.append)
+        return results
+
+    def test_chunks_in_flight_are_bounded(self):
+        results = self.download()
+        self.assertEqual(len(self.protocol.outstanding), MAX_CHUNKS_IN_FLIGHT)
+        while len(self.protocol.outstanding) > 0:
+            index, d = self.protocol.outstanding.pop(0)
+            d.callback((True, (self.protocol.chunk(index),)))
+            self.assertLessEqual(len(self.protocol.outstanding), MAX_CHUNKS_IN_FLIGHT)
+        self.assertEqual(results, [self.image])
+        self.assertEqual(sorted(self.protocol.requested), range(10))
+        self.assertFalse(os.path.isfile(self.part_path))
+        self.assertEqual(self.server.image_downloads, {})
+
+    def test_corrupt_chunk_is_requested_again(self):
+        self.protocol.corrupt[3] = 2
+        results = self.download()
+        self.protocol.answer()
+        self.assertEqual(results, [self.image])
+        self.assertEqual(self.protocol.requested.count(3), 3)
+        self.assertEqual(self.protocol.requested.count(4), 1)
+
+    def test_resume_from_part_file(self):
+        with open(self.part_path, "wb") as part_file:
+            part_file.write(self.image[:CHUNK_SIZE * 6])
+            part_file.write("\x00" * (len(self.image) - CHUNK_SIZE * 6))
+        results = self.download()
+        self.protocol.answer()
+        self.assertEqual(results, [self.image])
+        self.assertEqual(sorted(self.protocol.requested), [6, 7, 8, 9])
+
+    def test_retry_limit_fails_download(self):
+        self.protocol.corrupt[5] = 4
+        results = self.download()
+        waiter = []
+        self.server._get_image_chunked(self.node, self.image_hash).addCallback(waiter.append)
+        self.protocol.answer()
+        self.assertEqual(results, [None])
+        self.assertEqual(waiter, [None])
+        self.assertEqual(self.protocol.requested.count(5), 4)
+        self.assertFalse(os.path.isfile(self.part_path))
+        self.assertEqual(self.server.image_downloads, {})
+
+    def test_lost_connection_keeps_part_file(self):
+        results = self.download()
+        index, d = self.protocol.outstanding.pop(0)
+        d.callback((True, (self.protocol.chunk(index),)))
+        index, d = self.protocol.outstanding.pop(0)
+        d.errback(Exception("timeout"))
+        self.protocol.answer()
+        self.assertEqual(results, [None])
+        self.assertTrue(os.path.isfile(self.part_path))
+        self.assertEqual(self.server.image_downloads, {})
+
+
+class RemoteVersionTest(unittest.TestCase):
+    def setUp(self):
+        self.node = Node(digest("node"), "127.0.0.1", 18467)
+        self.server = Server.__new__(Server)
+        self.server.log = Logger(system=self.server)
+        self.server.protocol = MagicMock()
+        self.server.protocol.multiplexer = {}
+        self.server.protocol.callGetRatings.return_value = defer.succeed((False, None))
+        self.server.kserver = MagicMock()
+
+        def ping(node):
+            handler = MagicMock()
+            handler.node = node
+            handler.remote_node_version = RATING_PAGES_VERSION
+            self.server.protocol.multiplexer[(node.ip, node.port)] = MagicMock(handler=handler)
+            return defer.succeed((True, None))
+        self.server.kserver.protocol.callPing.side_effect = ping
+
+    def test_first_request_learns_version(self):
+        self.server.get_rating_aggregate(self.node)
+        self.assertTrue(self.server.kserver.protocol.callPing.called)
+        self.server.protocol.callGetRatings.assert_called_once_with(self.node, None, RATINGS_AGGREGATE)
+
+        # once we have heard from the peer it isn't pinged again
+        self.server.get_ratings_page(self.node)
+        self.assertEqual(self.server.kserver.protocol.callPing.call_count, 1)
+
+    def test_unreachable_peer_uses_legacy_path(self):
+        self.server.kserver.protocol.callPing.side_effect = lambda node: defer.succeed((False, None))
+        self.server.get_rating_aggregate(self.node)
+        self.server.protocol.callGetRatings.assert_called_once_with(self.node, None)
@@ -1,11 +1,16 @@
+import json
+import os
+from mock import MagicMock
+from twisted.internet import defer
 from twisted.trial import unittest
 from twisted.python import log
 
 from dht.node import Node
 from dht.utils import digest
 from dht.routing import RoutingTable
-from market.protocol import MarketProtocol
+from market.protocol import MarketProtocol, IMAGE_CHUNK_SIZE, RATINGS_AGGREGATE
 from dht.tests.utils import mknode
+from protos.message import Message, GET_IMAGE, GET_PROFILE, FOLLOW, CALM_DOWN
 
 class MarketProtocolTest(unittest.TestCase):
     def setUp(self):
@@ -36,3 +41,121 @@ class MarketProtocolTest(unittest.TestCase):
         exception_message = catcher.pop()
         self.assertEquals(catch_exception["message"][0], "[WARNING] could not find image 696e76616c69645f68617368")
         self.assertEquals(exception_message["message"][0], "[WARNING] Image hash is not 20 characters invalid_hash")
+
+    def test_MarketProtocol_rpc_batch(self):
+        mp = MarketProtocol(self.node, self.router, 0, 0)
+        mp.connect_multiplexer(MagicMock())
+        mp.multiplexer.overload.is_overloaded.return_value = False
+        requests = [mp.serialize_batch_request(GET_IMAGE, "invalid_hash"),
+                    mp.serialize_batch_request(FOLLOW, "proto", "signature"),
+                    "not a message"]
+
+        def check_response(response):
+            results = mp.parse_batch_response((True, tuple(response)), 4)
+            self.assertEqual(results, [(True, None), (False, None), (False, None), (False, None)])
+
+        return mp.rpc_batch(mknode(), *requests).addCallback(check_response)
+
+    def test_MarketProtocol_rpc_batch_sheds_when_overloaded(self):
+        mp = MarketProtocol(self.node, self.router, 0, 0)
+        mp.connect_multiplexer(MagicMock())
+        mp.multiplexer.overload.is_overloaded.return_value = True
+        mp.multiplexer.overload.backoff_interval.return_value = 30
+        mp.multiplexer.overload.shed = 0
+        mp.rpc_get_profile = MagicMock(return_value=["profile", "signature"])
+        requests = [mp.serialize_batch_request(GET_IMAGE, "a" * 20),
+                    mp.serialize_batch_request(GET_PROFILE)]
+
+        def check_response(response):
+            m = Message()
+            m.ParseFromString(response[0])
+            self.assertEqual(m.command, CALM_DOWN)
+            self.assertEqual(list(m.arguments), ["30"])
+            self.assertEqual(mp.multiplexer.overload.shed, 1)
+            results = mp.parse_batch_response((True, tuple(response)), 2)
+            self.assertEqual(results, [(False, None), (True, ("profile", "signature"))])
+
+        return mp.rpc_batch(mknode(), *requests).addCallback(check_response)
+
+    def test_MarketProtocol_parse_batch_response_failure(self):
+        mp = MarketProtocol(self.node, self.router, 0, 0)
+        self.assertEqual(mp.parse_batch_response((False, None), 2), [(False, None), (False, None)])
+
+    def test_MarketProtocol_parse_batch_response_backs_off(self):
+        mp = MarketProtocol(self.node, self.router, 0, 0)
+        node = mknode(ip="10.0.0.1", port=18467)
+        calm_down = Message()
+        calm_down.command = CALM_DOWN
+        calm_down.arguments.append("30")
+        self.assertFalse(mp.is_backing_off(node))
+        results = mp.parse_batch_response((True, (calm_down.SerializeToString(),)), 1, node)
+        self.assertEqual(results, [(False, None)])
+        self.assertTrue(mp.is_backing_off(node))
+
+    def test_MarketProtocol_rpc_get_followers_cache(self):
+        db = MagicMock()
+        db.follow.get_followers.return_value = ("followers", 1, None)
+        signing_key = MagicMock()
+        signing_key.sign.return_value = "s" * 64
+        mp = MarketProtocol(self.node, self.router, signing_key, db, audit=False)
+        self.addCleanup(mp.adb.stop)
+
+        def check_cached(response):
+            self.assertEqual(response, ["followers", "s" * 64, 1, ""])
+            self.assertIs(mp.rpc_get_followers(mknode()), response)
+            mp.rpc_unfollow(mknode(), "invalid signature")
+            self.assertIs(mp.rpc_get_followers(mknode()), response)
+            mp._clear_follower_pages()
+            return mp.rpc_get_followers(mknode()).addCallback(check_reloaded)
+
+        def check_reloaded(response):
+            self.assertEqual(db.follow.get_followers.call_count, 2)
+        return mp.rpc_get_followers(mknode()).addCallback(check_cached)
+
+    def test_MarketProtocol_rpc_get_ratings_aggregate_and_page(self):
+        db = MagicMock()
+        db.ratings.get_aggregate.return_value = {"count": 1}
+        db.ratings.get_ratings_page.return_value = (['{"rating": 1}'], "next")
+        signing_key = MagicMock()
+        signing_key.sign.return_value = "s" * 64
+        mp = MarketProtocol(self.node, self.router, signing_key, db, audit=False)
+        self.addCleanup(mp.adb.stop)
+
+        def check_aggregate(response):
+            self.assertEqual(json.loads(response[0].decode("zlib")), {"count": 1})
+            db.ratings.get_aggregate.assert_called_once_with("6c697374696e67")
+            return mp.rpc_get_ratings(mknode(), "", "").addCallback(check_page)
+
+        def check_page(response):
+            self.assertEqual(json.loads(response[0].decode("zlib")), [{"rating": 1}])
+            self.assertEqual(response[2], "next")
+            db.ratings.get_ratings_page.assert_called_once_with(None, "")
+        return mp.rpc_get_ratings(mknode(), "listing", RATINGS_AGGREGATE).addCallback(check_aggregate)
+
+    def test_MarketProtocol_rpc_get_image_chunk(self):
+        image = os.urandom(IMAGE_CHUNK_SIZE * 2 + 10)
+        image_hash = digest(image)
+        with open("test_image", "wb") as image_file:
+            image_file.write(image)
+        self.addCleanup(os.remove, "test_image")
+        db = MagicMock()
+        db.filemap.get_file.return_value = "test_image"
+        mp = MarketProtocol(self.node, self.router, 0, db)
+        self.addCleanup(mp.adb.stop)
+
+        def check_chunks(results, manifest):
+            chunks = [result[0] for result in results]
+            self.assertEqual("".join(chunks), image)
+            for i in range(3):
+                self.assertEqual(digest(chunks[i]), manifest[2][i * 20:(i + 1) * 20])
+            self.assertEqual(mp.rpc_get_image_chunk(mknode(), image_hash), manifest)
+            return mp.rpc_get_image_chunk(mknode(), image_hash, "3").addCallback(self.assertEqual, None)
+
+        def check_manifest(manifest):
+            self.assertEqual(manifest[0], str(len(image)))
+            self.assertEqual(manifest[1], str(IMAGE_CHUNK_SIZE))
+            self.assertEqual(len(manifest[2]), 60)
+            ds = [mp.rpc_get_image_chunk(mknode(), image_hash, str(i)) for i in range(3)]
+            return defer.gatherResults(ds).addCallback(check_chunks, manifest)
+
+        return mp.rpc_get_image_chunk(mknode(), image_hash).addCallback(check_manifest)
@@ -0,0 +1,63 @@
+__author__ = 'chris'
+
+import time
+import zlib
+
+# Peers running at least this version of the protocol accept zlib compressed
+# arguments, which are flagged by their index in `Message.compressedArguments`.
+COMPRESSION_VERSION = 6
+
+# Arguments shorter than this, in bytes, are never worth compressing.
+COMPRESSION_THRESHOLD = 1024
+
+# Most bytes we are willing to inflate the compressed arguments of one message to,
+# so a small malicious payload can't make us allocate an unbounded amount of memory.
+MAX_DECOMPRESSED_SIZE = 10 * 1024 * 1024
+
+
+def add_arguments(message, args, compress=False, threshold=COMPRESSION_THRESHOLD):
+    """
+    Appends the arguments to the message, compressing the ones at least `threshold`
+    bytes long if `compress` is True. An argument is only sent compressed if that
+    makes it smaller.
+
+    Returns a `tuple` of the bytes saved and the seconds spent compressing.
+    """
+    saved = 0
+    elapsed = 0.0
+    for arg in args:
+        arg = str(arg)
+        if compress and len(arg) >= threshold:
+            start = time.time()
+            compressed = zlib.compress(arg)
+            elapsed += time.time() - start
+            if len(compressed) < len(arg):
+                saved += len(arg) - len(compressed)
+                message.compressedArguments.append(len(message.arguments))
+                arg = compressed
+        message.arguments.append(arg)
+    return saved, elapsed
+
+
+def get_arguments(message):
+    """
+    Returns the message arguments as a `tuple`, inflating the compressed ones, along
+    with the seconds spent doing it. Raises an exception if an argument can't be
+    inflated or the compressed arguments together would inflate to more than
+    MAX_DECOMPRESSED_SIZE.
+    """
+    if len(message.compressedArguments) == 0:
+        return tuple(message.arguments), 0.0
+    start = time.time()
+    args = list(message.arguments)
+    remaining = MAX_DECOMPRESSED_SIZE
+    for index in set(message.compressedArguments):
+        if remaining <= 0:
+            # a max_length of zero would mean no limit at all
+            raise Exception("compressed arguments are too large")
+        d = zlib.decompressobj()
+        args[index] = d.decompress(args[index], remaining)
+        if d.unconsumed_tail:
+            raise Exception("compressed arguments are too large")
+        remaining -= len(args[index])
+    return tuple(args), time.time() - start
@@ -1,44 +1,162 @@
 __author__ = 'chris'
 
+import time
+from collections import defaultdict
+from dht.utils import LRUCache
 from log import Logger
-from protos.message import Command, FOLLOW, UNFOLLOW
-from twisted.internet import reactor, task
+from protos.message import Message, Command, FOLLOW, UNFOLLOW, STORE, DELETE, FIND_NODE, FIND_VALUE, INV, VALUES, \
+    GET_IMAGE, GET_IMAGE_CHUNK, GET_CONTRACT, GET_PROFILE, GET_LISTINGS, GET_USER_METADATA, \
+    GET_CONTRACT_METADATA, GET_FOLLOWING, GET_FOLLOWERS, GET_RATINGS, BATCH, MESSAGE, BROADCAST, ORDER, \
+    ORDER_CONFIRMATION, COMPLETE_ORDER, DISPUTE_OPEN, DISPUTE_CLOSE, REFUND
+from twisted.internet import reactor
 
 RECONNECTIONS = 100
 MALFORMATED = 110
 
-SCORES = {
-    FOLLOW: 0,
-    UNFOLLOW: 0
+# Every peer IP gets a bucket of BUCKET_SIZE tokens for each command which
+# refills at REFILL_RATE tokens per second. A request takes its cost from the
+# bucket and is dropped if there aren't enough tokens left, so a command with
+# cost c allows bursts of BUCKET_SIZE / c requests and REFILL_RATE / c requests
+# per second after that. Commands not listed here are free. A BATCH is charged its
+# own cost plus the cost of each sub-request, taken from the sub-command's bucket,
+# so bundling requests doesn't get a peer more of them.
+BUCKET_SIZE = 600
+REFILL_RATE = 10
+
+COSTS = {
+    FOLLOW: 200,
+    UNFOLLOW: 200,
+    STORE: 10,
+    DELETE: 10,
+    FIND_NODE: 2,
+    FIND_VALUE: 2,
+    INV: 10,
+    VALUES: 10,
+    GET_IMAGE: 20,
+    GET_IMAGE_CHUNK: 2,
+    GET_CONTRACT: 10,
+    GET_PROFILE: 5,
+    GET_LISTINGS: 5,
+    GET_USER_METADATA: 5,
+    GET_CONTRACT_METADATA: 5,
+    GET_FOLLOWING: 10,
+    GET_FOLLOWERS: 10,
+    GET_RATINGS: 10,
+    BATCH: 2,
+    MESSAGE: 20,
+    BROADCAST: 60,
+    ORDER: 60,
+    ORDER_CONFIRMATION: 60,
+    COMPLETE_ORDER: 60,
+    DISPUTE_OPEN: 60,
+    DISPUTE_CLOSE: 60,
+    REFUND: 60
 }
 
+# Running out of tokens for one of these gets the peer banned rather than
+# just having the request dropped.
+BAN_COMMANDS = (FOLLOW, UNFOLLOW)
+
+# Maximum number of (ip, command) buckets kept in memory. When full, the least
+# recently used bucket is forgotten, which at worst hands that peer a full bucket.
+MAX_BUCKETS = 50000
+
 
 class BanScore(object):
+    """
+    Per IP, per command token bucket rate limiter. Buckets are refilled lazily
+    when a message arrives, so there is no periodic sweep over all the peers.
+    """
 
-    def __init__(self, multiplexer, ban_time=86400):
+    def __init__(self, multiplexer, ban_time=86400, costs=None, bucket_size=BUCKET_SIZE,
+                 refill_rate=REFILL_RATE, max_buckets=MAX_BUCKETS):
         self.multiplexer = multiplexer
         self.ban_time = ban_time
-        self.peers = {}
-        self.scoring_loop = task.LoopingCall(self.adjust_scores)
-        self.scoring_loop.start(30, now=False)
+        self.costs = COSTS if costs is None else costs
+        self.bucket_size = bucket_size
+        self.refill_rate = refill_rate
+        self.buckets = LRUCache(max_buckets)
+        self.throttled = defaultdict(int)
         self.log = Logger(system=self)
 
     def process_message(self, peer, message):
-        if peer[0] not in self.peers:
-            self.peers[peer[0]] = SCORES.copy()
-
-        try:
-            if message.command == FOLLOW:
-                self.peers[peer[0]][FOLLOW] += 1
-                if self.peers[peer[0]][FOLLOW] > 3:
-                    self.ban(peer, FOLLOW)
-            elif message.command == UNFOLLOW:
-                self.peers[peer[0]][UNFOLLOW] += 1
-                if self.peers[peer[0]][UNFOLLOW] > 3:
-                    self.ban(peer, UNFOLLOW)
-
-        except Exception:
-            self.log.warning("Exception processing banscore")
+        """
+        Charges the cost of the message to the peer's buckets before its arguments
+        are inflated. Returns False if the peer is over its limit and the message
+        should be dropped. The sub-requests of a BATCH are priced here unless they
+        were sent compressed, in which case `charge_batch` prices them once inflated.
+        """
+        charges = defaultdict(int)
+        if self.costs.get(message.command):
+            charges[message.command] += self.costs[message.command]
+        if message.command == BATCH:
+            compressed = set(message.compressedArguments)
+            self._add_batch_charges(charges, [arg for index, arg in enumerate(message.arguments)
+                                              if index not in compressed])
+        return self._charge(peer, charges)
+
+    def charge_batch(self, peer, requests):
+        """
+        Charges the sub-requests of a BATCH which arrived compressed. Returns False
+        if the peer is over its limit and the BATCH should be dropped.
+        """
+        charges = defaultdict(int)
+        self._add_batch_charges(charges, requests)
+        return self._charge(peer, charges)
+
+    def _add_batch_charges(self, charges, requests):
+        for command in self._batch_commands(requests):
+            if self.costs.get(command):
+                charges[command] += self.costs[command]
+
+    def _charge(self, peer, charges):
+        """
+        Takes each command's charge from its bucket if all of them can cover it.
+        """
+        if not charges:
+            return True
+        now = time.time()
+        buckets = {}
+        for command, cost in charges.items():
+            key = (peer[0], command)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [self.bucket_size, now]
+                self.buckets[key] = bucket
+            else:
+                bucket[0] = min(self.bucket_size, bucket[0] + (now - bucket[1]) * self.refill_rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return self._throttle(peer, command)
+            buckets[command] = bucket
+        for command, bucket in buckets.items():
+            bucket[0] -= charges[command]
+        return True
+
+    @staticmethod
+    def _batch_commands(requests):
+        """
+        Returns the commands of the sub-requests in a BATCH. Ones which can't be
+        parsed are skipped since they are answered without doing any work.
+        """
+        commands = []
+        for request in requests:
+            try:
+                m = Message()
+                m.ParseFromString(request)
+                commands.append(m.command)
+            except Exception:
+                pass
+        return commands
+
+    def _throttle(self, peer, command):
+        self.throttled[command] += 1
+        if command in BAN_COMMANDS:
+            self.ban(peer, command)
+        else:
+            self.log.debug("Dropping %s message from %s, rate limit exceeded." %
+                           (Command.Name(command), peer[0]))
+        return False
 
     def ban(self, peer, message_type):
         reason = Command.Name(message_type)
@@ -49,12 +167,8 @@ class BanScore(object):
             self.multiplexer[peer].shutdown()
         reactor.callLater(self.ban_time, self.multiplexer.remove_ip_ban, peer[0])
 
-    def adjust_scores(self):
-        for peer in self.peers.keys():
-            remove = True
-            for k, v in self.peers[peer].items():
-                if v > 0:
-                    remove = False
-                    self.peers[peer][k] = v - 1
-            if remove:
-                del self.peers[peer]
+    def get_stats(self):
+        return {
+            "buckets": len(self.buckets),
+            "throttled": dict((Command.Name(k), v) for k, v in self.throttled.items())
+        }
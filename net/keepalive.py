@@ -0,0 +1,93 @@
+__author__ = 'chris'
+
+# Sent in place of a PING to peers running at least KEEP_ALIVE_VERSION of the
+# protocol. It carries nothing but is delivered (and acked) by the rudp layer,
+# which is enough to refresh the NAT mapping and to notice if the peer is gone.
+# It can't be mistaken for a `Message`, which is always much larger.
+KEEP_ALIVE_FRAME = "\x00"
+KEEP_ALIVE_VERSION = 5
+
+# Keep alive interval, in seconds, used until the NAT timeout has been measured
+# and for nodes which aren't behind a NAT at all.
+DEFAULT_INTERVAL = 30
+FULL_CONE_INTERVAL = 300
+
+MIN_INTERVAL = 15
+MAX_INTERVAL = 300
+
+# Fraction of the measured NAT timeout we wait between keep alives.
+SAFETY_FACTOR = 0.8
+
+# Stop probing once the bounds on the NAT timeout are this close together.
+PRECISION = 0.1
+
+
+class NatTimeoutEstimator(object):
+    """
+    Measures how long our NAT keeps a mapping open without outbound traffic so
+    the keep alive interval can be set just under it.
+
+    Every packet that arrives after a period of silence on our side shows the
+    mapping survived that long. To find out if it would survive longer we pick one
+    connection at a time as a probe and stop sending keep alives on it. If the peer
+    gets a packet through after the probe's target silence the lower bound is raised,
+    if nothing arrives the target becomes an upper bound. Each probe halves the
+    distance between the two, as in a binary search.
+    """
+
+    def __init__(self, default_interval=DEFAULT_INTERVAL):
+        self.default_interval = default_interval
+        self.lower = 0.0
+        self.upper = None
+        self.probe = None
+        self.probe_target = None
+        self.probes = 0
+
+    def interval(self):
+        interval = max(self.default_interval, self.lower * SAFETY_FACTOR)
+        if self.upper is not None:
+            interval = min(interval, self.upper * SAFETY_FACTOR)
+        return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+    def observe(self, address, silence):
+        """
+        Called when a packet arrives from `address` after we sent nothing for
+        `silence` seconds.
+        """
+        if silence > self.lower and (self.upper is None or silence < self.upper):
+            self.lower = silence
+        if address == self.probe and silence >= self.probe_target:
+            self.probe = None
+
+    def needs_probe(self):
+        if self.probe is not None or self.lower >= MAX_INTERVAL:
+            return False
+        return self.upper is None or self.upper - self.lower > self.upper * PRECISION
+
+    def start_probe(self, address):
+        lower = max(self.lower, self.default_interval)
+        if self.upper is None:
+            self.probe_target = min(MAX_INTERVAL, lower * 2)
+        else:
+            self.probe_target = (lower + self.upper) / 2.0
+        self.probe = address
+        self.probes += 1
+
+    def probe_failed(self):
+        """Nothing arrived on the probe connection within the target silence."""
+        self.upper = self.probe_target
+        if self.lower >= self.upper:
+            self.lower = 0.0
+        self.probe = None
+
+    def cancel_probe(self, address):
+        if address == self.probe:
+            self.probe = None
+
+    def get_stats(self):
+        return {
+            "interval": self.interval(),
+            "nat_timeout_lower_bound": self.lower,
+            "nat_timeout_upper_bound": self.upper,
+            "probes": self.probes
+        }
@@ -0,0 +1,122 @@
+__author__ = 'chris'
+
+from bisect import bisect_left
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. The
+# last bucket counts everything slower than the final bound.
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+INCOMING = "incoming"
+OUTGOING = "outgoing"
+
+
+class CommandStats(object):
+    """
+    Counters for a single command in a single direction. Outgoing stats
+    describe calls we made to other nodes, incoming stats describe requests
+    other nodes made to us and how we answered them.
+    """
+
+    __slots__ = ['requests', 'responses', 'not_found', 'bad_request', 'calm_down', 'timeouts',
+                 'request_bytes', 'response_bytes', 'latency_total', 'latency_histogram',
+                 'compression_bytes_saved', 'compression_time']
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.not_found = 0
+        self.bad_request = 0
+        self.calm_down = 0
+        self.timeouts = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency_total = 0.0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.compression_bytes_saved = 0
+        self.compression_time = 0.0
+
+    def add_latency(self, seconds):
+        milliseconds = seconds * 1000
+        self.latency_total += milliseconds
+        self.latency_histogram[bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+
+    def to_dict(self):
+        completed = sum(self.latency_histogram)
+        return {
+            "requests": self.requests,
+            "responses": self.responses,
+            "not_found": self.not_found,
+            "bad_request": self.bad_request,
+            "calm_down": self.calm_down,
+            "timeouts": self.timeouts,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "compression_bytes_saved": self.compression_bytes_saved,
+            "compression_ms": round(self.compression_time * 1000, 2),
+            "average_latency_ms": round(self.latency_total / completed, 2) if completed > 0 else 0,
+            "latency_histogram": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], self.latency_histogram))
+        }
+
+
+class RPCMetrics(object):
+    """
+    Per command, per direction counters for the rpc layer. Recording is a
+    couple of dict lookups and integer increments so it is always enabled.
+    """
+
+    def __init__(self):
+        self.stats = {INCOMING: {}, OUTGOING: {}}
+
+    def _get(self, direction, command):
+        try:
+            return self.stats[direction][command]
+        except KeyError:
+            s = self.stats[direction][command] = CommandStats()
+            return s
+
+    def request(self, direction, command, size):
+        s = self._get(direction, command)
+        s.requests += 1
+        s.request_bytes += size
+
+    def response(self, direction, command, size, latency):
+        s = self._get(direction, command)
+        s.responses += 1
+        s.response_bytes += size
+        s.add_latency(latency)
+
+    def not_found(self, direction, command, latency):
+        s = self._get(direction, command)
+        s.not_found += 1
+        s.add_latency(latency)
+
+    def bad_request(self, direction, command, latency):
+        s = self._get(direction, command)
+        s.bad_request += 1
+        s.add_latency(latency)
+
+    def calm_down(self, direction, command):
+        self._get(direction, command).calm_down += 1
+
+    def compression(self, direction, command, saved, seconds):
+        """Records bytes saved by compressing arguments and time spent (de)compressing them."""
+        s = self._get(direction, command)
+        s.compression_bytes_saved += saved
+        s.compression_time += seconds
+
+    def timeout(self, command):
+        self._get(OUTGOING, command).timeouts += 1
+
+    def to_dict(self):
+        ret = {}
+        for direction, commands in self.stats.items():
+            ret[direction] = {}
+            for command, s in commands.items():
+                ret[direction][command] = s.to_dict()
+        return ret
+
+    def reset(self):
+        self.stats = {INCOMING: {}, OUTGOING: {}}
+
+
+rpc_metrics = RPCMetrics()
@@ -0,0 +1,75 @@
+__author__ = 'chris'
+
+import time
+from twisted.internet.task import LoopingCall
+
+# How often, in seconds, we check how late the reactor is running.
+SAMPLE_INTERVAL = 0.5
+
+# Smoothed reactor lag, in seconds, above which we are considered overloaded.
+MAX_REACTOR_LAG = 0.25
+
+# Number of requests being handled at once above which we are considered overloaded.
+MAX_OUTSTANDING = 100
+
+# Bounds, in seconds, on how long we ask a peer to back off for.
+MIN_BACKOFF = 5
+MAX_BACKOFF = 120
+
+
+class OverloadDetector(object):
+    """
+    Keeps track of how far behind the reactor is running and how many incoming
+    requests are currently being handled. When either goes over its threshold
+    the rpc layer starts answering low priority requests with CALM_DOWN rather
+    than queueing more work.
+    """
+
+    def __init__(self, max_lag=MAX_REACTOR_LAG, max_outstanding=MAX_OUTSTANDING):
+        self.max_lag = max_lag
+        self.max_outstanding = max_outstanding
+        self.lag = 0.0
+        self.outstanding = 0
+        self.shed = 0
+        self.last_sample = None
+        self.sample_loop = LoopingCall(self.sample)
+
+    def start(self):
+        self.last_sample = time.time()
+        self.sample_loop.start(SAMPLE_INTERVAL, now=False)
+
+    def stop(self):
+        if self.sample_loop.running:
+            self.sample_loop.stop()
+
+    def sample(self):
+        now = time.time()
+        lag = max(0.0, now - self.last_sample - SAMPLE_INTERVAL)
+        self.last_sample = now
+        self.lag = 0.7 * self.lag + 0.3 * lag
+
+    def request_started(self):
+        self.outstanding += 1
+
+    def request_finished(self, result):
+        self.outstanding -= 1
+        return result
+
+    def is_overloaded(self):
+        return self.lag > self.max_lag or self.outstanding > self.max_outstanding
+
+    def backoff_interval(self):
+        """
+        Returns how many seconds a peer should wait before sending us more low
+        priority requests. The interval grows with how far over the thresholds we are.
+        """
+        load = max(self.lag / self.max_lag, float(self.outstanding) / self.max_outstanding)
+        return int(min(MAX_BACKOFF, max(MIN_BACKOFF, MIN_BACKOFF * load)))
+
+    def get_stats(self):
+        return {
+            "reactor_lag_ms": round(self.lag * 1000, 2),
+            "outstanding_requests": self.outstanding,
+            "overloaded": self.is_overloaded(),
+            "requests_shed": self.shed
+        }
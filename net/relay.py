@@ -0,0 +1,105 @@
+__author__ = 'chris'
+
+import heapq
+from collections import OrderedDict
+from math import log10
+
+# Number of relays a node behind a restrictive NAT keeps. The first is
+# advertised as our relay address, the rest as backups we can fail over to.
+MAX_RELAYS = 3
+
+# Maximum number of FULL_CONE peers tracked as relay candidates. The least
+# recently seen candidate is dropped when the index is full.
+MAX_CANDIDATES = 200
+
+# Round trip time, in seconds, assumed for candidates we haven't measured yet.
+DEFAULT_RTT = 1.0
+
+
+class RelayCandidate(object):
+    """
+    A FULL_CONE peer which could relay traffic for us, along with what we know
+    about how well it would do it.
+    """
+
+    __slots__ = ['address', 'rtt', 'relayed_bytes']
+
+    def __init__(self, address):
+        self.address = address
+        self.rtt = None
+        self.relayed_bytes = 0
+
+    def score(self):
+        """
+        Lower is better. Fast peers win and peers which have already relayed
+        traffic for us are preferred.
+        """
+        rtt = self.rtt if self.rtt is not None else DEFAULT_RTT
+        return rtt / (1.0 + log10(1.0 + self.relayed_bytes / 1024.0))
+
+    def to_dict(self):
+        return {
+            "address": "%s:%s" % self.address,
+            "rtt_ms": round(self.rtt * 1000, 2) if self.rtt is not None else None,
+            "relayed_bytes": self.relayed_bytes
+        }
+
+
+class RelayIndex(object):
+    """
+    Keeps the FULL_CONE peers we have measured as relay candidates and the list
+    of relays currently in use, primary first. Candidates are fed in as ping
+    responses arrive, so picking new relays never requires walking the routing
+    table, and when the primary goes away the next relay is promoted immediately.
+    """
+
+    def __init__(self, max_relays=MAX_RELAYS, max_candidates=MAX_CANDIDATES):
+        self.max_relays = max_relays
+        self.max_candidates = max_candidates
+        self.candidates = OrderedDict()
+        self.relays = []
+
+    def record_rtt(self, address, rtt):
+        candidate = self.candidates.pop(address, None)
+        if candidate is None:
+            candidate = RelayCandidate(address)
+        candidate.rtt = rtt if candidate.rtt is None else 0.7 * candidate.rtt + 0.3 * rtt
+        self.candidates[address] = candidate
+        if len(self.candidates) > self.max_candidates:
+            for old in self.candidates.keys():
+                if old not in self.relays:
+                    del self.candidates[old]
+                    break
+
+    def record_relayed(self, address, size):
+        if address in self.relays:
+            self.candidates[address].relayed_bytes += size
+
+    def select(self):
+        """
+        Tops the relay list up to `max_relays` with the best scoring candidates,
+        keeping the relays already in use so connections aren't churned.
+        """
+        self.relays = [r for r in self.relays if r in self.candidates]
+        if len(self.relays) < self.max_relays:
+            others = [c for a, c in self.candidates.iteritems() if a not in self.relays]
+            for candidate in heapq.nsmallest(self.max_relays - len(self.relays), others,
+                                             key=RelayCandidate.score):
+                self.relays.append(candidate.address)
+        return self.relays
+
+    def fail_over(self, address):
+        """
+        Drops a relay which stopped working and returns the new relay list. The
+        peer is only considered again once it answers one of our pings.
+        """
+        self.candidates.pop(address, None)
+        if address in self.relays:
+            self.relays.remove(address)
+        return self.select()
+
+    def get_stats(self):
+        return {
+            "candidates": len(self.candidates),
+            "relays": [self.candidates[r].to_dict() for r in self.relays]
+        }
@@ -5,17 +5,26 @@ Copyright (c) 2015 OpenBazaar
 
 import abc
 import random
+import time
 from base64 import b64encode
 from config import PROTOCOL_VERSION
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, LRUCache
 from hashlib import sha1
 from log import Logger
-from protos.message import Message, Command, NOT_FOUND, HOLE_PUNCH, ORDER
+from net.compression import COMPRESSION_VERSION, add_arguments, get_arguments
+from net.metrics import rpc_metrics, INCOMING, OUTGOING
+from net.overload import MAX_BACKOFF
+from net.scheduler import priority_for
+from protos.message import Message, Command, NOT_FOUND, HOLE_PUNCH, ORDER, BAD_REQUEST, CALM_DOWN, BATCH
 from protos.objects import FULL_CONE, RESTRICTED, SYMMETRIC
 from twisted.internet import defer, reactor
 from txrudp.connection import State
 
+# Seconds we avoid a relay after a call through it timed out, if the node
+# advertised another one we can use instead.
+RELAY_RETRY_TIME = 600
+
 
 class RPCProtocol:
     """
@@ -25,6 +34,15 @@ class RPCProtocol:
     """
     __metaclass__ = abc.ABCMeta
 
+    # Commands which may be bundled into a single BATCH request. Processors
+    # should only list commands which are cheap and free of side effects.
+    batchable_commands = ()
+    max_batch_size = 20
+
+    # Low priority commands which are answered with CALM_DOWN rather than
+    # handled while we are overloaded.
+    sheddable_commands = ()
+
     def __init__(self, sourceNode, router, waitTimeout=60):
         """
         Args:
@@ -41,6 +59,9 @@ class RPCProtocol:
         self.router = router
         self._waitTimeout = waitTimeout
         self._outstanding = {}
+        self._call_info = {}
+        self._backoff = {}
+        self._failed_relays = LRUCache(1000)
         self.log = Logger(system=self)
 
     def receive_message(self, message, sender, connection, ban_score):
@@ -51,17 +72,35 @@ class RPCProtocol:
             return False
 
         if sender.vendor:
-            self.multiplexer.vendors[sender.id] = sender
+            self.multiplexer.vendors.seen(sender)
 
         msgID = message.messageID
+        is_request = msgID not in self._outstanding and message.command not in (NOT_FOUND, CALM_DOWN)
+        # requests are charged before their arguments are inflated
+        if is_request and not ban_score.process_message(connection.dest_addr, message):
+            return False
         if message.command == NOT_FOUND:
             data = None
         else:
-            data = tuple(message.arguments)
+            try:
+                data, elapsed = get_arguments(message)
+            except Exception:
+                self.log.warning("received message from %s with invalid compressed arguments" % sender)
+                return False
+            if elapsed > 0:
+                rpc_metrics.compression(OUTGOING if msgID in self._outstanding else INCOMING,
+                                        Command.Name(message.command), 0, elapsed)
         if msgID in self._outstanding:
-            self._acceptResponse(msgID, data, sender)
-        elif message.command != NOT_FOUND:
-            ban_score.process_message(connection.dest_addr, message)
+            if message.command == CALM_DOWN:
+                self._acceptCalmDown(msgID, data, sender)
+            else:
+                self._acceptResponse(msgID, data, sender)
+        elif is_request:
+            if message.command == BATCH and len(message.compressedArguments) > 0:
+                compressed = [data[index] for index in set(message.compressedArguments)]
+                if not ban_score.charge_batch(connection.dest_addr, compressed):
+                    return False
+            rpc_metrics.request(INCOMING, Command.Name(message.command), sum(len(arg) for arg in data))
             self._acceptRequest(msgID, str(Command.Name(message.command)).lower(), data, sender, connection)
 
     def _acceptResponse(self, msgID, data, sender):
@@ -70,12 +109,73 @@ class RPCProtocol:
             self.log.debug("received response for message id %s from %s" % msgargs)
         else:
             self.log.warning("received 404 error response from %s" % sender)
+        call_info = self._call_info.pop(msgID, None)
+        if call_info is not None:
+            command, sent = call_info
+            if data is None:
+                rpc_metrics.not_found(OUTGOING, command, time.time() - sent)
+            else:
+                rpc_metrics.response(OUTGOING, command, sum(len(arg) for arg in data), time.time() - sent)
+                if command == "PING" and sender.nat_type == FULL_CONE:
+                    self.multiplexer.relays.record_rtt((sender.ip, sender.port), time.time() - sent)
         d = self._outstanding[msgID][0]
         if self._outstanding[msgID][2].active():
             self._outstanding[msgID][2].cancel()
         d.callback((True, data))
         del self._outstanding[msgID]
 
+    def _acceptCalmDown(self, msgID, data, sender):
+        """
+        The remote node is overloaded and refused our request. Fail the call and
+        don't send it any more low priority requests for the interval it asked for.
+        """
+        self._back_off(sender, data)
+        call_info = self._call_info.pop(msgID, None)
+        if call_info is not None:
+            rpc_metrics.calm_down(OUTGOING, call_info[0])
+        d = self._outstanding[msgID][0]
+        if self._outstanding[msgID][2].active():
+            self._outstanding[msgID][2].cancel()
+        d.callback((False, None))
+        del self._outstanding[msgID]
+
+    def _back_off(self, node, data):
+        """
+        Stops sending low priority requests to the node for the interval given in
+        the arguments of its CALM_DOWN.
+        """
+        try:
+            interval = min(max(int(data[0]), 1), MAX_BACKOFF)
+        except Exception:
+            interval = MAX_BACKOFF
+        self.log.info("%s is overloaded, backing off for %s seconds" % (node, interval))
+        self._backoff[(node.ip, node.port)] = time.time() + interval
+
+    def is_backing_off(self, node):
+        """
+        Returns True if the node told us to calm down and the interval it asked for
+        hasn't passed yet.
+        """
+        address = (node.ip, node.port)
+        until = self._backoff.get(address)
+        if until is None:
+            return False
+        if until <= time.time():
+            del self._backoff[address]
+            return False
+        return True
+
+    @staticmethod
+    def _supports_compression(connection):
+        """
+        Returns True if the peer on the other end of the connection told us it
+        accepts compressed arguments.
+        """
+        try:
+            return connection.handler.remote_node_version >= COMPRESSION_VERSION
+        except Exception:
+            return False
+
     def _acceptRequest(self, msgID, funcname, args, sender, connection):
         self.log.debug("received request from %s, command %s" % (sender, funcname.upper()))
         f = getattr(self, "rpc_%s" % funcname, None)
@@ -83,14 +183,23 @@ class RPCProtocol:
             msgargs = (self.__class__.__name__, funcname)
             self.log.error("%s has no callable method rpc_%s; ignoring request" % msgargs)
             return False
-        if funcname == "hole_punch":
+        overload = self.multiplexer.overload
+        if Command.Value(funcname.upper()) in self.sheddable_commands and overload.is_overloaded():
+            self.log.debug("overloaded, asking %s to calm down" % sender)
+            overload.shed += 1
+            self._sendResponse([str(overload.backoff_interval())], "calm_down", msgID, sender, connection,
+                               time.time(), funcname)
+        elif funcname == "hole_punch":
             f(sender, *args)
         else:
+            start = time.time()
+            overload.request_started()
             d = defer.maybeDeferred(f, sender, *args)
-            d.addCallback(self._sendResponse, funcname, msgID, sender, connection)
-            d.addErrback(self._sendResponse, "bad_request", msgID, sender, connection)
+            d.addBoth(overload.request_finished)
+            d.addCallback(self._sendResponse, funcname, msgID, sender, connection, start)
+            d.addErrback(self._sendResponse, "bad_request", msgID, sender, connection, start, funcname)
 
-    def _sendResponse(self, response, funcname, msgID, sender, connection):
+    def _sendResponse(self, response, funcname, msgID, sender, connection, start=None, request_name=None):
         self.log.debug("sending response for msg id %s to %s" % (b64encode(msgID), sender))
         m = Message()
         m.messageID = msgID
@@ -103,10 +212,21 @@ class RPCProtocol:
             m.command = Command.Value(funcname.upper())
             if not isinstance(response, list):
                 response = [response]
-            for arg in response:
-                m.arguments.append(str(arg))
+            saved, elapsed = add_arguments(m, response, self._supports_compression(connection))
+            if elapsed > 0:
+                rpc_metrics.compression(INCOMING, (request_name or funcname).upper(), saved, elapsed)
+        if start is not None:
+            command = (request_name or funcname).upper()
+            if response is None:
+                rpc_metrics.not_found(INCOMING, command, time.time() - start)
+            elif funcname == "bad_request":
+                rpc_metrics.bad_request(INCOMING, command, time.time() - start)
+            elif funcname == "calm_down":
+                rpc_metrics.calm_down(INCOMING, command)
+            else:
+                rpc_metrics.response(INCOMING, command, sum(len(arg) for arg in m.arguments), time.time() - start)
         m.signature = self.signing_key.sign(m.SerializeToString())[:64]
-        connection.send_message(m.SerializeToString())
+        self.multiplexer.scheduler.send(connection, m.SerializeToString(), priority_for(m.command))
 
     def timeout(self, node):
         """
@@ -116,6 +236,9 @@ class RPCProtocol:
         address = (node.ip, node.port)
         for msgID, val in self._outstanding.items():
             if address == val[1]:
+                call_info = self._call_info.pop(msgID, None)
+                if call_info is not None:
+                    rpc_metrics.timeout(call_info[0])
                 val[0].callback((False, None))
                 if self._outstanding[msgID][2].active():
                     self._outstanding[msgID][2].cancel()
@@ -123,10 +246,24 @@ class RPCProtocol:
 
         self.router.removeContact(node)
         try:
-            self.multiplexer[address].shutdown()
+            connection = self.multiplexer[address]
+            if node.backup_relay_nodes and tuple(connection.relay_addr) != tuple(connection.dest_addr):
+                self._failed_relays[tuple(connection.relay_addr)] = time.time()
+            connection.shutdown()
         except Exception:
             pass
 
+    def _relay_for(self, node):
+        """
+        Returns the first relay advertised by the node which hasn't recently failed
+        us, falling back to its primary relay.
+        """
+        for relay in [node.relay_node] + node.backup_relay_nodes:
+            failed = self._failed_relays.get(relay)
+            if failed is None or time.time() - failed > RELAY_RETRY_TIME:
+                return relay
+        return node.relay_node
+
     def rpc_hole_punch(self, sender, ip, port, relay="False"):
         """
         A method for handling an incoming HOLE_PUNCH message. Relay the message
@@ -143,6 +280,98 @@ class RPCProtocol:
             for i in range(20):
                 self.multiplexer.send_datagram("", (ip, int(port)))
 
+    def rpc_batch(self, sender, *requests):
+        """
+        A method for handling an incoming BATCH message. Each argument is a serialized
+        `Message` containing only a command and its arguments. The sub-requests are run
+        through the matching rpc_ methods and the responses are returned, in order, as
+        serialized `Message` objects. A sub-request which isn't batchable or fails gets
+        a BAD_REQUEST response, one which returns None gets NOT_FOUND and a sheddable
+        one gets CALM_DOWN while we are overloaded.
+        """
+        def build_response(results):
+            ret = []
+            for (success, response), command in zip(results, commands):
+                m = Message()
+                if command == CALM_DOWN:
+                    m.command = CALM_DOWN
+                    m.arguments.append(str(overload.backoff_interval()))
+                elif not success or command is None:
+                    m.command = BAD_REQUEST
+                elif response is None:
+                    m.command = NOT_FOUND
+                else:
+                    m.command = command
+                    if not isinstance(response, list):
+                        response = [response]
+                    for arg in response:
+                        m.arguments.append(str(arg))
+                ret.append(m.SerializeToString())
+            return ret
+
+        overload = self.multiplexer.overload
+        overloaded = overload.is_overloaded()
+        commands = []
+        ds = []
+        for request in requests[:self.max_batch_size]:
+            try:
+                m = Message()
+                m.ParseFromString(request)
+                if m.command not in self.batchable_commands:
+                    raise Exception("command %s can not be batched" % m.command)
+                if overloaded and m.command in self.sheddable_commands:
+                    overload.shed += 1
+                    commands.append(CALM_DOWN)
+                    ds.append(defer.succeed(None))
+                    continue
+                f = getattr(self, "rpc_%s" % str(Command.Name(m.command)).lower())
+                commands.append(m.command)
+                ds.append(defer.maybeDeferred(f, sender, *m.arguments))
+            except Exception:
+                commands.append(None)
+                ds.append(defer.succeed(None))
+        self.log.debug("received batch of %s requests from %s" % (len(ds), sender))
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(build_response)
+
+    @staticmethod
+    def serialize_batch_request(command, *args):
+        """
+        Builds a sub-request for use as an argument to a BATCH call.
+        """
+        m = Message()
+        m.command = command
+        for arg in args:
+            m.arguments.append(str(arg))
+        return m.SerializeToString()
+
+    def parse_batch_response(self, result, count, node=None):
+        """
+        Splits the response to a BATCH call into a list of `count` results, each in
+        the same form a regular call would have returned. A CALM_DOWN sub-response
+        makes us back off from `node` just like one sent for a single request.
+        """
+        if not result[0] or result[1] is None:
+            return [(False, None)] * count
+        ret = []
+        for response in result[1][:count]:
+            try:
+                m = Message()
+                m.ParseFromString(response)
+                if m.command == NOT_FOUND:
+                    ret.append((True, None))
+                elif m.command == CALM_DOWN:
+                    if node is not None:
+                        self._back_off(node, m.arguments)
+                    ret.append((False, None))
+                elif m.command == BAD_REQUEST:
+                    ret.append((False, None))
+                else:
+                    ret.append((True, tuple(m.arguments)))
+            except Exception:
+                ret.append((False, None))
+        ret.extend([(False, None)] * (count - len(ret)))
+        return ret
+
     def __getattr__(self, name):
         if name.startswith("_") or name.startswith("rpc_"):
             return object.__getattr__(self, name)
@@ -154,37 +383,44 @@ class RPCProtocol:
 
         def func(node, *args):
             address = (node.ip, node.port)
+            command = Command.Value(name.upper())
+            if command in self.sheddable_commands and self.is_backing_off(node):
+                return defer.succeed((False, None))
 
             msgID = sha1(str(random.getrandbits(255))).digest()
             m = Message()
             m.messageID = msgID
             m.sender.MergeFrom(self.sourceNode.getProto())
-            m.command = Command.Value(name.upper())
+            m.command = command
             m.protoVer = PROTOCOL_VERSION
-            for arg in args:
-                m.arguments.append(str(arg))
+            saved, elapsed = add_arguments(m, args, self._supports_compression(self.multiplexer.get(address)))
+            if elapsed > 0:
+                rpc_metrics.compression(OUTGOING, name.upper(), saved, elapsed)
             m.testnet = self.multiplexer.testnet
             m.signature = self.signing_key.sign(m.SerializeToString())[:64]
             data = m.SerializeToString()
+            rpc_metrics.request(OUTGOING, name.upper(), sum(len(arg) for arg in m.arguments))
 
+            relay = self._relay_for(node) if node.relay_node is not None else None
             relay_addr = None
             if node.nat_type == SYMMETRIC or \
                     (node.nat_type == RESTRICTED and self.sourceNode.nat_type == SYMMETRIC):
-                relay_addr = node.relay_node
+                relay_addr = relay
 
             d = defer.Deferred()
             if m.command != HOLE_PUNCH:
                 timeout = reactor.callLater(self._waitTimeout, self.timeout, node)
                 self._outstanding[msgID] = [d, address, timeout]
+                self._call_info[msgID] = (name.upper(), time.time())
                 self.log.debug("calling remote function %s on %s (msgid %s)" % (name, address, b64encode(msgID)))
 
-            self.multiplexer.send_message(data, address, relay_addr)
+            self.multiplexer.send_message(data, address, relay_addr, priority_for(m.command))
 
             if self.multiplexer[address].state != State.CONNECTED and \
                             node.nat_type == RESTRICTED and \
                             self.sourceNode.nat_type != SYMMETRIC and \
-                            node.relay_node is not None:
-                self.hole_punch(Node(digest("null"), node.relay_node[0], node.relay_node[1], nat_type=FULL_CONE),
+                            relay is not None:
+                self.hole_punch(Node(digest("null"), relay[0], relay[1], nat_type=FULL_CONE),
                                 address[0], address[1], "True")
                 self.log.debug("sending hole punch message to %s" % address[0] + ":" + str(address[1]))
 
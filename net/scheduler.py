@@ -0,0 +1,205 @@
+__author__ = 'chris'
+
+import time
+from collections import deque
+from protos.message import PING, STUN, HOLE_PUNCH, STORE, DELETE, INV, VALUES, BROADCAST, MESSAGE, FOLLOW, \
+    UNFOLLOW, ORDER, ORDER_CONFIRMATION, COMPLETE_ORDER, FIND_NODE, FIND_VALUE, GET_CONTRACT, GET_IMAGE, \
+    GET_PROFILE, GET_LISTINGS, GET_USER_METADATA, GET_CONTRACT_METADATA, GET_FOLLOWING, GET_FOLLOWERS, \
+    GET_RATINGS, DISPUTE_OPEN, DISPUTE_CLOSE, REFUND, BATCH, GET_IMAGE_CHUNK
+from twisted.internet.task import LoopingCall
+from txrudp.connection import State
+
+# Priority classes, highest first.
+CONTROL = 0
+COMMERCE = 1
+CHAT = 2
+BULK = 3
+
+CLASS_NAMES = ["control", "commerce", "chat", "bulk"]
+
+# Relative share of the link each class gets when all of them have data queued.
+WEIGHTS = [8, 4, 2, 1]
+
+# Bytes a class may send per weight unit in each round of the deficit round robin.
+QUANTUM = 1500
+
+# Segments the rudp connection may have queued before we start holding messages
+# back in our own queues. Once a message is handed to the connection it can no
+# longer be reordered, so this is kept small.
+MAX_BACKLOG = 16
+
+COMMAND_PRIORITY = {
+    PING: CONTROL,
+    STUN: CONTROL,
+    HOLE_PUNCH: CONTROL,
+    STORE: CONTROL,
+    DELETE: CONTROL,
+    FIND_NODE: CONTROL,
+    FIND_VALUE: CONTROL,
+    ORDER: COMMERCE,
+    ORDER_CONFIRMATION: COMMERCE,
+    COMPLETE_ORDER: COMMERCE,
+    DISPUTE_OPEN: COMMERCE,
+    DISPUTE_CLOSE: COMMERCE,
+    REFUND: COMMERCE,
+    MESSAGE: CHAT,
+    BROADCAST: CHAT,
+    FOLLOW: CHAT,
+    UNFOLLOW: CHAT,
+    GET_PROFILE: CHAT,
+    GET_USER_METADATA: CHAT,
+    GET_LISTINGS: CHAT,
+    GET_CONTRACT_METADATA: CHAT,
+    GET_FOLLOWING: CHAT,
+    GET_FOLLOWERS: CHAT,
+    GET_RATINGS: CHAT,
+    BATCH: CHAT,
+    GET_CONTRACT: BULK,
+    GET_IMAGE: BULK,
+    GET_IMAGE_CHUNK: BULK,
+    INV: BULK,
+    VALUES: BULK
+}
+
+
+def priority_for(command):
+    return COMMAND_PRIORITY.get(command, CONTROL)
+
+
+def _backlog(connection):
+    return len(connection._segment_queue)
+
+
+class ConnectionQueue(object):
+    """
+    The per connection queues, one for each priority class, drained using
+    deficit round robin so each class gets its weighted share of the link.
+    """
+
+    def __init__(self):
+        self.queues = [deque() for _ in WEIGHTS]
+        self.deficits = [0] * len(WEIGHTS)
+        self.queued_bytes = [0] * len(WEIGHTS)
+        self.current = 0
+        self.new_round = True
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues)
+
+    def push(self, datagram, priority):
+        self.queues[priority].append(datagram)
+        self.queued_bytes[priority] += len(datagram)
+
+    def pop(self, allow_bulk=True):
+        """
+        Returns the next (datagram, priority) to send or None if nothing
+        is eligible. If `allow_bulk` is False the bulk queue is skipped.
+        """
+        eligible = [len(q) > 0 for q in self.queues]
+        eligible[BULK] = eligible[BULK] and allow_bulk
+        if not any(eligible):
+            return None
+        while True:
+            priority = self.current
+            queue = self.queues[priority]
+            if eligible[priority]:
+                if self.new_round:
+                    self.deficits[priority] += WEIGHTS[priority] * QUANTUM
+                    self.new_round = False
+                if len(queue[0]) <= self.deficits[priority]:
+                    datagram = queue.popleft()
+                    self.deficits[priority] -= len(datagram)
+                    self.queued_bytes[priority] -= len(datagram)
+                    return datagram, priority
+            elif len(queue) == 0:
+                self.deficits[priority] = 0
+            self.current = (priority + 1) % len(WEIGHTS)
+            self.new_round = True
+
+
+class SendScheduler(object):
+    """
+    Sits between the rpc layer and the rudp connections so that a burst of bulk
+    traffic (images, contracts, dht value transfers) can't delay orders and chat
+    messages sent over the same link. Messages go straight to the connection
+    while its backlog is short, otherwise they wait in per class queues which
+    are drained by weighted fair queueing. Bulk traffic is additionally limited
+    to `bulk_rate` bytes per second across all connections (0 disables the cap).
+    """
+
+    def __init__(self, bulk_rate=0):
+        self.bulk_rate = bulk_rate
+        self.bulk_tokens = bulk_rate
+        self.last_refill = time.time()
+        self.queues = {}
+        self.sent = [0] * len(WEIGHTS)
+        self.delayed = [0] * len(WEIGHTS)
+        self.max_depth = [0] * len(WEIGHTS)
+        self.pump_loop = LoopingCall(self.pump)
+
+    def _refill(self):
+        if self.bulk_rate > 0:
+            now = time.time()
+            self.bulk_tokens = min(self.bulk_rate, self.bulk_tokens + (now - self.last_refill) * self.bulk_rate)
+            self.last_refill = now
+
+    def _bulk_allowed(self):
+        return self.bulk_rate <= 0 or self.bulk_tokens > 0
+
+    def _dispatch(self, connection, datagram, priority):
+        if priority == BULK and self.bulk_rate > 0:
+            self.bulk_tokens -= len(datagram)
+        self.sent[priority] += 1
+        connection.send_message(datagram)
+
+    def send(self, connection, datagram, priority=CONTROL):
+        self._refill()
+        queue = self.queues.get(connection)
+        if (queue is None or not any(queue.queues[:priority + 1])) and _backlog(connection) < MAX_BACKLOG and \
+                (priority != BULK or self._bulk_allowed()):
+            self._dispatch(connection, datagram, priority)
+            return
+        if queue is None:
+            queue = self.queues[connection] = ConnectionQueue()
+        queue.push(datagram, priority)
+        self.delayed[priority] += 1
+        self.max_depth[priority] = max(self.max_depth[priority], len(queue.queues[priority]))
+        if not self.pump_loop.running:
+            self.pump_loop.start(0.05, now=False)
+
+    def pump(self):
+        self._refill()
+        for connection, queue in self.queues.items():
+            if connection.state == State.SHUTDOWN:
+                del self.queues[connection]
+                continue
+            while len(queue) > 0 and _backlog(connection) < MAX_BACKLOG:
+                item = queue.pop(self._bulk_allowed())
+                if item is None:
+                    break
+                self._dispatch(connection, item[0], item[1])
+            if len(queue) == 0:
+                del self.queues[connection]
+        if len(self.queues) == 0 and self.pump_loop.running:
+            self.pump_loop.stop()
+
+    def stop(self):
+        if self.pump_loop.running:
+            self.pump_loop.stop()
+        self.queues = {}
+
+    def get_stats(self):
+        stats = {}
+        for priority, name in enumerate(CLASS_NAMES):
+            stats[name] = {
+                "queued_messages": sum(len(q.queues[priority]) for q in self.queues.values()),
+                "queued_bytes": sum(q.queued_bytes[priority] for q in self.queues.values()),
+                "max_depth": self.max_depth[priority],
+                "sent": self.sent[priority],
+                "delayed": self.delayed[priority]
+            }
+        return {
+            "connections_with_backlog": len(self.queues),
+            "bulk_rate_limit": self.bulk_rate,
+            "classes": stats
+        }
@@ -0,0 +1,139 @@
+__author__ = 'chris'
+
+import heapq
+import random
+import time
+from collections import OrderedDict
+from log import Logger
+from twisted.internet.task import LoopingCall
+
+# Maximum number of vendors kept. When full, the least recently seen vendor is forgotten.
+MAX_VENDORS = 5000
+
+# How often, in seconds, changes are written back to the `VendorStore`.
+FLUSH_INTERVAL = 60
+
+# Liveness score given to a vendor we haven't heard from before. The score moves
+# towards 1 every time we hear from the vendor and towards 0 every time it fails
+# to answer, and the vendor is forgotten once it drops below MIN_SCORE.
+INITIAL_SCORE = 0.5
+MIN_SCORE = 0.2
+
+
+class VendorRegistry(object):
+    """
+    Keeps the vendors we have heard about, ordered from least to most recently
+    seen, along with a liveness score for each. Changes are batched up and written
+    to the `VendorStore` every FLUSH_INTERVAL seconds rather than only at shutdown,
+    and the registry never grows past `max_vendors`.
+    """
+
+    def __init__(self, store, max_vendors=MAX_VENDORS):
+        self.store = store
+        self.max_vendors = max_vendors
+        # guid -> [node, last_seen, score]
+        self.vendors = OrderedDict()
+        self.dirty = set()
+        self.removed = set()
+        self.evicted = 0
+        self.log = Logger(system=self)
+        for node, last_seen, score in store.get_vendor_records(max_vendors):
+            self.vendors[node.id] = [node, last_seen, score]
+        self.flush_loop = LoopingCall(self.flush)
+
+    def start(self):
+        self.flush_loop.start(FLUSH_INTERVAL, now=False)
+
+    def stop(self):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush()
+
+    def __contains__(self, guid):
+        return guid in self.vendors
+
+    def __len__(self):
+        return len(self.vendors)
+
+    def get(self, guid):
+        entry = self.vendors.get(guid)
+        return entry[0] if entry is not None else None
+
+    def seen(self, node):
+        """Called whenever a message arrives from a vendor."""
+        entry = self.vendors.pop(node.id, None)
+        if entry is None:
+            entry = [node, time.time(), INITIAL_SCORE]
+        else:
+            entry[0] = node
+            entry[1] = time.time()
+            entry[2] = 0.7 * entry[2] + 0.3
+        self.vendors[node.id] = entry
+        self.dirty.add(node.id)
+        self.removed.discard(node.id)
+        while len(self.vendors) > self.max_vendors:
+            guid = next(iter(self.vendors))
+            self.remove(guid)
+            self.evicted += 1
+
+    def failed(self, guid):
+        """Called when a vendor didn't answer a request."""
+        entry = self.vendors.get(guid)
+        if entry is None:
+            return
+        entry[2] *= 0.7
+        if entry[2] < MIN_SCORE:
+            self.remove(guid)
+        else:
+            self.dirty.add(guid)
+
+    def remove(self, guid):
+        if self.vendors.pop(guid, None) is not None:
+            self.dirty.discard(guid)
+            self.removed.add(guid)
+
+    def sample(self, count, include=None, exclude=None):
+        """
+        Returns up to `count` vendors picked at random, with the more reliable
+        vendors more likely to be picked.
+
+        Args:
+            count: the number of vendors to return.
+            include: if given, only vendors with these guids are considered.
+            exclude: guids of vendors which shouldn't be returned.
+        """
+        if include is not None:
+            entries = [self.vendors[guid] for guid in include if guid in self.vendors]
+        else:
+            entries = self.vendors.values()
+        if exclude:
+            entries = [e for e in entries if e[0].id not in exclude]
+        picked = heapq.nlargest(count, entries, key=lambda e: random.random() ** (1.0 / e[2]))
+        return [e[0] for e in picked]
+
+    def flush(self):
+        """Writes everything which changed since the last flush to the database in one batch."""
+        if not self.dirty and not self.removed:
+            return
+        try:
+            rows = []
+            for guid in self.dirty:
+                node, last_seen, score = self.vendors[guid]
+                rows.append((guid.encode("hex"), node.getProto().SerializeToString(), int(last_seen), score))
+            removed = [guid.encode("hex") for guid in self.removed]
+            if rows:
+                self.store.save_vendors(rows)
+            if removed:
+                self.store.delete_vendors(removed)
+            self.dirty.clear()
+            self.removed.clear()
+        except Exception, e:
+            self.log.error("failed to save vendors: %s" % str(e))
+
+    def get_stats(self):
+        return {
+            "vendors": len(self.vendors),
+            "max_vendors": self.max_vendors,
+            "pending_writes": len(self.dirty) + len(self.removed),
+            "evicted": self.evicted
+        }
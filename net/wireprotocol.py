@@ -1,26 +1,42 @@
 __author__ = 'chris'
 
+import heapq
 import socket
-import nacl.signing
-import nacl.hash
 import time
-from config import SEEDS
+from collections import OrderedDict
+from config import SEEDS, BULK_BANDWIDTH, MAX_CONNECTIONS
 from dht.node import Node
-from dht.utils import digest
+from dht.utils import digest, valid_guid
 from interfaces import MessageProcessor, Multiplexer, ConnectionHandler
 from log import Logger
 from net.dos import BanScore
-from protos.message import Message, PING, NOT_FOUND
+from net.keepalive import KEEP_ALIVE_FRAME, KEEP_ALIVE_VERSION, DEFAULT_INTERVAL, FULL_CONE_INTERVAL, \
+    MIN_INTERVAL, NatTimeoutEstimator
+from net.overload import OverloadDetector
+from net.relay import RelayIndex
+from net.scheduler import SendScheduler, CONTROL
+from net.vendors import VendorRegistry
+from protos.message import Message, PING, NOT_FOUND, CALM_DOWN
 from protos.objects import FULL_CONE
 from random import shuffle
-from twisted.internet import task, reactor
 from twisted.internet.task import LoopingCall
 from txrudp.connection import HandlerFactory, Handler, State
-from txrudp.crypto_connection import CryptoConnectionFactory
+from txrudp.crypto_connection import CryptoConnection, CryptoConnectionFactory
 from txrudp.rudp import ConnectionMultiplexer
 from zope.interface.verify import verifyObject
 from zope.interface import implements
 
+# Connections that have seen no traffic for this long are dropped on the next
+# keep alive pass unless the peer is in our routing table or is our relay.
+IDLE_TIMEOUT = 300
+
+# When the connection cap is reached, a connection must have been idle at least
+# this long before it is evicted to make room for a new peer.
+EVICTION_MIN_IDLE = 30
+
+# How often, in seconds, the keep alive queue is checked for connections which are due.
+KEEP_ALIVE_TICK = MIN_INTERVAL / 3.0
+
 
 class OpenBazaarProtocol(ConnectionMultiplexer):
     """
@@ -31,12 +47,14 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
     """
     implements(Multiplexer)
 
-    def __init__(self, db, ip_address, nat_type, testnet=False, relaying=False):
+    def __init__(self, db, ip_address, nat_type, testnet=False, relaying=False, max_connections=MAX_CONNECTIONS):
         """
         Initialize the new protocol with the connection handler factory.
 
         Args:
                 ip_address: a `tuple` of the (ip address, port) of ths node.
+                max_connections: the number of connections we will keep open before
+                    evicting idle ones or turning new peers away.
         """
         self.ip_address = ip_address
         self.testnet = testnet
@@ -44,19 +62,76 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
         self.blockchain = None
         self.processors = []
         self.relay_node = None
+        self.relays = RelayIndex()
         self.nat_type = nat_type
-        self.vendors = db.vendors.get_vendors()
+        self.nat_timeout = NatTimeoutEstimator(DEFAULT_INTERVAL if nat_type != FULL_CONE else FULL_CONE_INTERVAL)
+        self.vendors = VendorRegistry(db.vendors)
+        self.vendors.start()
         self.ban_score = BanScore(self)
-        self.factory = self.ConnHandlerFactory(self.processors, nat_type, self.relay_node, self.ban_score)
+        self.scheduler = SendScheduler(BULK_BANDWIDTH)
+        self.overload = OverloadDetector()
+        self.overload.start()
+        self.max_connections = max_connections
+        # Addresses of connections which may be evicted, ordered from least to most
+        # recently active. Ones found to be needed for routing or relaying are dropped
+        # by the eviction scan and added back the next time they are active.
+        self.evictable = OrderedDict()
+        # Heap of (due time, address) telling when each connection next needs a keep
+        # alive pass, and the current due time of each address. Heap entries which
+        # don't match keep_alive_due are stale and skipped.
+        self.keep_alive_queue = []
+        self.keep_alive_due = {}
+        self.keep_alive_interval = self.nat_timeout.interval()
+        self.connection_stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "evicted": 0,
+            "closed_idle": 0,
+            "outgoing_over_cap": 0
+        }
+        self.factory = self.ConnHandlerFactory(self.processors, nat_type, self.relay_node, self.ban_score, self)
         self.log = Logger(system=self)
         self.keep_alive_loop = LoopingCall(self.keep_alive)
-        self.keep_alive_loop.start(30, now=False)
-        ConnectionMultiplexer.__init__(self, CryptoConnectionFactory(self.factory), self.ip_address[0], relaying)
+        self.keep_alive_loop.start(KEEP_ALIVE_TICK, now=False)
+        ConnectionMultiplexer.__init__(self, self.ConnectionFactory(self.factory), self.ip_address[0], relaying)
+
+    class Connection(CryptoConnection):
+        """
+        A `CryptoConnection` which tells its handler whenever its state changes, so the
+        handler learns the handshake finished (or failed) without polling, and records
+        when it last sent something for the keep alive logic. Only outbound packets
+        refresh our NAT mapping, so what the peer sends doesn't count.
+        """
+
+        def send_message(self, message):
+            self.handler.last_sent = time.time()
+            CryptoConnection.send_message(self, message)
+
+        @property
+        def _state(self):
+            return self._current_state
+
+        @_state.setter
+        def _state(self, state):
+            previous = getattr(self, "_current_state", None)
+            self._current_state = state
+            if state != previous:
+                self.handler.on_state_change(previous, state)
+
+    class ConnectionFactory(CryptoConnectionFactory):
+
+        def make_new_connection(self, proto_handle, own_addr, source_addr, relay_addr, private_key=None):
+            handler = self.handler_factory.make_new_handler(own_addr, source_addr, relay_addr)
+            connection = OpenBazaarProtocol.Connection(proto_handle, handler, own_addr, source_addr,
+                                                       relay_addr, private_key)
+            handler.connection = connection
+            return connection
 
     class ConnHandler(Handler):
         implements(ConnectionHandler)
 
         def __init__(self, processors, nat_type, relay_node, ban_score, *args, **kwargs):
+            self.multiplexer = kwargs.pop("multiplexer", None)
             super(OpenBazaarProtocol.ConnHandler, self).__init__(*args, **kwargs)
             self.log = Logger(system=self)
             self.processors = processors
@@ -66,19 +141,28 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             self.ban_score = ban_score
             self.addr = None
             self.is_new_node = True
-            self.on_connection_made()
             self.time_last_message = 0
+            self.last_active = self.last_sent = time.time()
             self.remote_node_version = 1
-            self.ping_interval = 30 if nat_type != FULL_CONE else 300
+
+        def on_state_change(self, previous, state):
+            """Called by the connection whenever its state changes."""
+            if state == State.CONNECTED:
+                self.on_connection_made()
+            elif state == State.SHUTDOWN and previous == State.CONNECTING:
+                self.log.debug("failed to connect to %s:%s" % tuple(self.connection.dest_addr))
 
         def on_connection_made(self):
-            if self.connection is None or self.connection.state == State.CONNECTING:
-                return task.deferLater(reactor, .1, self.on_connection_made)
-            if self.connection.state == State.CONNECTED:
+            if self.connection is not None and self.connection.state == State.CONNECTED:
                 self.addr = str(self.connection.dest_addr[0]) + ":" + str(self.connection.dest_addr[1])
                 self.log.info("connected to %s" % self.addr)
 
         def receive_message(self, datagram):
+            t = time.time()
+            if self.multiplexer is not None:
+                self.multiplexer.nat_timeout.observe(tuple(self.connection.dest_addr), t - self.last_sent)
+            if datagram == KEEP_ALIVE_FRAME:
+                return True
             if len(datagram) < 166:
                 self.log.warning("received datagram too small from %s, ignoring" % self.addr)
                 return False
@@ -92,18 +176,19 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
                                  None if not m.sender.HasField("relayAddress") else
                                  (m.sender.relayAddress.ip, m.sender.relayAddress.port),
                                  m.sender.natType,
-                                 m.sender.vendor)
+                                 m.sender.vendor,
+                                 [(r.ip, r.port) for r in m.sender.backupRelayAddresses])
                 self.remote_node_version = m.protoVer
                 if self.time_last_message == 0:
-                    h = nacl.hash.sha512(m.sender.publicKey)
-                    pow_hash = h[40:]
-                    if int(pow_hash[:6], 16) >= 50 or m.sender.guid.encode("hex") != h[:40]:
+                    if not valid_guid(m.sender.guid, m.sender.publicKey):
                         raise Exception('Invalid GUID')
                 for processor in self.processors:
-                    if m.command in processor or m.command == NOT_FOUND:
+                    if m.command in processor or m.command in (NOT_FOUND, CALM_DOWN):
                         processor.receive_message(m, self.node, self.connection, self.ban_score)
                 if m.command != PING:
-                    self.time_last_message = time.time()
+                    self.time_last_message = self.last_active = time.time()
+                    if self.multiplexer is not None:
+                        self.multiplexer.touch(self.connection.dest_addr)
             except Exception:
                 # If message isn't formatted property then ignore
                 self.log.warning("received an invalid message from %s, ignoring" % self.addr)
@@ -124,7 +209,10 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             if self.addr:
                 self.log.info("connection with %s terminated" % self.addr)
 
-            if self.relay_node == (self.connection.dest_addr[0], self.connection.dest_addr[1]):
+            if self.multiplexer is not None:
+                self.multiplexer.nat_timeout.cancel_probe(tuple(self.connection.dest_addr))
+
+            if self.is_relay():
                 self.log.info("Disconnected from relay node. Picking new one...")
                 self.change_relay_node()
 
@@ -132,45 +220,102 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             """
             Let's check that this node has been active in the last 5 minutes. If not
             and if it's not in our routing table, we don't need to keep the connection
-            open. Otherwise PING it to make sure the NAT doesn't drop the mapping.
+            open. Otherwise, if we haven't sent anything for the keep alive interval,
+            send a keep alive frame so the NAT doesn't drop the mapping. Peers
+            too old to understand keep alive frames are sent a PING instead.
             """
             t = time.time()
-            router = self.processors[0].router
-            if (
-                    self.node is not None and
-                    t - self.time_last_message >= 300 and
-                    router.isNewNode(self.node) and
-                    self.relay_node != (self.connection.dest_addr[0], self.connection.dest_addr[1])
-            ):
+            if self.node is not None and t - self.last_active >= IDLE_TIMEOUT and self.is_disposable():
+                self.multiplexer.connection_stats["closed_idle"] += 1
                 self.connection.shutdown()
                 return
 
-            if t - self.time_last_message >= self.ping_interval:
+            address = tuple(self.connection.dest_addr)
+            nat_timeout = self.multiplexer.nat_timeout
+            if nat_timeout.probe == address:
+                # The peer keeps sending its own keep alives, so if the mapping outlived the
+                # target one of them arrives within a default interval past it and `observe`
+                # ends the probe. Still being here after that means none got through.
+                if t - self.last_sent < nat_timeout.probe_target + DEFAULT_INTERVAL:
+                    return
+                self.log.debug("nat timeout probe on %s failed at %ss" % (self.addr, nat_timeout.probe_target))
+                nat_timeout.probe_failed()
+            elif t - self.last_sent < nat_timeout.interval():
+                return
+            elif self.can_probe() and nat_timeout.needs_probe():
+                nat_timeout.start_probe(address)
+                self.log.debug("probing nat timeout on %s at %ss" % (self.addr, nat_timeout.probe_target))
+                return
+
+            if self.remote_node_version >= KEEP_ALIVE_VERSION:
+                self.multiplexer.scheduler.send(self.connection, KEEP_ALIVE_FRAME, CONTROL)
+            else:
                 for processor in self.processors:
                     if PING in processor and self.node is not None:
                         processor.callPing(self.node)
 
+        def keep_alive_deadline(self):
+            """
+            Returns the time at which `keep_alive` next has something to do for this
+            connection: send a keep alive, decide a nat timeout probe or close it as idle.
+            """
+            nat_timeout = self.multiplexer.nat_timeout
+            if nat_timeout.probe == tuple(self.connection.dest_addr):
+                deadline = self.last_sent + nat_timeout.probe_target + DEFAULT_INTERVAL
+            else:
+                deadline = self.last_sent + nat_timeout.interval()
+            if self.node is not None and self.is_disposable():
+                deadline = min(deadline, self.last_active + IDLE_TIMEOUT)
+            return deadline
+
+        def can_probe(self):
+            """
+            The nat timeout can only be probed on connections to peers which send keep
+            alives of their own, that is peers behind a NAT running a recent version.
+            """
+            return (self.multiplexer.nat_type != FULL_CONE and
+                    self.remote_node_version >= KEEP_ALIVE_VERSION and
+                    self.node is not None and
+                    self.node.nat_type != FULL_CONE and
+                    not self.is_relay())
+
+        def is_disposable(self):
+            """
+            Returns True if closing this connection costs us nothing, that is the
+            peer isn't in our routing table and isn't being used as our relay.
+            """
+            if self.is_relay():
+                return False
+            if self.node is not None and len(self.processors) > 0 and \
+                    not self.processors[0].router.isNewNode(self.node):
+                return False
+            return True
+
+        def is_relay(self):
+            address = (self.connection.dest_addr[0], self.connection.dest_addr[1])
+            if self.multiplexer is not None:
+                return address in self.multiplexer.relays.relays or address == self.multiplexer.relay_node
+            return self.relay_node == address
+
         def change_relay_node(self):
-            potential_relay_nodes = []
-            for bucket in self.processors[0].router.buckets:
-                for node in bucket.nodes.values():
-                    if node.nat_type == FULL_CONE:
-                        potential_relay_nodes.append((node.ip, node.port))
-            if len(potential_relay_nodes) == 0:
+            """
+            Fails over to the next relay in the relay index. If we don't know of any
+            other FULL_CONE peers fall back to one of the seeds.
+            """
+            address = (self.connection.dest_addr[0], self.connection.dest_addr[1])
+            relays = self.multiplexer.relays.fail_over(address)
+            if len(relays) == 0:
+                potential_relay_nodes = []
                 for seed in SEEDS:
                     try:
                         potential_relay_nodes.append((socket.gethostbyname(seed[0].split(":")[0]),
                                                       28469 if self.processors[0].TESTNET else 18469))
                     except socket.gaierror:
                         pass
-            shuffle(potential_relay_nodes)
-            self.relay_node = potential_relay_nodes[0]
-            for processor in self.processors:
-                if PING in processor:
-                    if (self.relay_node[0], self.relay_node[1]) in processor.multiplexer:
-                        processor.multiplexer[(self.relay_node[0], self.relay_node[1])].shutdown()
-                    processor.callPing(Node(digest("null"), self.relay_node[0], self.relay_node[1],
-                                            relay_node=None, nat_type=FULL_CONE))
+                shuffle(potential_relay_nodes)
+                relays = potential_relay_nodes[:1]
+            self.relay_node = relays[0] if len(relays) > 0 else None
+            self.multiplexer.set_relays(relays)
 
         def check_new_connection(self):
             if self.is_new_node:
@@ -181,15 +326,17 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
 
     class ConnHandlerFactory(HandlerFactory):
 
-        def __init__(self, processors, nat_type, relay_node, ban_score):
+        def __init__(self, processors, nat_type, relay_node, ban_score, multiplexer=None):
             super(OpenBazaarProtocol.ConnHandlerFactory, self).__init__()
             self.processors = processors
             self.nat_type = nat_type
             self.relay_node = relay_node
             self.ban_score = ban_score
+            self.multiplexer = multiplexer
 
         def make_new_handler(self, *args, **kwargs):
-            return OpenBazaarProtocol.ConnHandler(self.processors, self.nat_type, self.relay_node, self.ban_score)
+            return OpenBazaarProtocol.ConnHandler(self.processors, self.nat_type, self.relay_node, self.ban_score,
+                                                  multiplexer=self.multiplexer)
 
     def register_processor(self, processor):
         """Add a new class which implements the `MessageProcessor` interface."""
@@ -201,16 +348,145 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
         if processor in self.processors:
             self.processors.remove(processor)
 
+    def set_relays(self, relays):
+        """
+        Makes the first of `relays` our primary relay and the rest backups, updates the
+        addresses our node advertises and pings any relay we aren't connected to so the
+        NAT lets packets relayed by it through.
+        """
+        if len(relays) == 0:
+            return
+        self.relay_node = relays[0]
+        for processor in self.processors:
+            processor.sourceNode.relay_node = relays[0]
+            processor.sourceNode.backup_relay_nodes = list(relays[1:])
+            if PING in processor:
+                for relay in relays:
+                    if relay not in self:
+                        processor.callPing(Node(digest("null"), relay[0], relay[1], nat_type=FULL_CONE))
+
+    def update_relays(self):
+        """Picks our relays from the relay index if we are behind a restrictive NAT."""
+        if self.nat_type != FULL_CONE:
+            self.set_relays(self.relays.select())
+
     def set_servers(self, ws, blockchain):
         self.ws = ws
         self.blockchain = blockchain
 
+    def datagramReceived(self, datagram, addr):
+        self.relays.record_relayed(addr, len(datagram))
+        ConnectionMultiplexer.datagramReceived(self, datagram, addr)
+
+    def touch(self, address):
+        """Move a connection to the most recently active end of the eviction index."""
+        self.evictable.pop(address, None)
+        self.evictable[address] = time.time()
+
+    def __setitem__(self, address, con):
+        ConnectionMultiplexer.__setitem__(self, address, con)
+        self.touch(address)
+        self.schedule_keep_alive(address, time.time() + self.nat_timeout.interval())
+
+    def __delitem__(self, address):
+        ConnectionMultiplexer.__delitem__(self, address)
+        self.evictable.pop(address, None)
+        self.keep_alive_due.pop(address, None)
+
+    def schedule_keep_alive(self, address, due):
+        """Sets the time the connection to `address` is next visited by `keep_alive`."""
+        self.keep_alive_due[address] = due
+        heapq.heappush(self.keep_alive_queue, (due, address))
+
+    def make_new_connection(self, own_addr, source_addr, relay_addr=None, outgoing=False):
+        """
+        Creates a new connection unless we are at the connection cap. In that case the
+        least recently active connection which is safe to close is evicted to make room.
+        If nothing can be evicted incoming connections are refused (the SYN is dropped
+        and `None` returned), while connections we initiate ourselves are let through.
+        """
+        if len(self) >= self.max_connections and not self.evict_idle_connection():
+            if not outgoing:
+                self.connection_stats["rejected"] += 1
+                self.log.debug("connection limit reached, refusing connection from %s:%s" % source_addr)
+                return None
+            self.connection_stats["outgoing_over_cap"] += 1
+        con = ConnectionMultiplexer.make_new_connection(self, own_addr, source_addr, relay_addr)
+        self.touch(source_addr)
+        self.schedule_keep_alive(source_addr, time.time() + self.nat_timeout.interval())
+        self.connection_stats["accepted"] += 1
+        return con
+
+    def evict_idle_connection(self):
+        """
+        Shuts down the least recently active connection that isn't needed for routing or
+        relaying and has been idle for at least `EVICTION_MIN_IDLE` seconds. Connections
+        passed over are taken out of the eviction index until they are next active, so
+        each one is inspected at most once per period of activity. Returns True if one
+        was evicted.
+        """
+        t = time.time()
+        while len(self.evictable) > 0:
+            address, last_active = next(self.evictable.iteritems())
+            if t - last_active < EVICTION_MIN_IDLE:
+                break
+            connection = self._active_connections.get(address)
+            if connection is None or not connection.handler.is_disposable():
+                del self.evictable[address]
+                continue
+            self.log.debug("connection limit reached, evicting idle connection to %s:%s" % address)
+            self.connection_stats["evicted"] += 1
+            connection.shutdown()
+            return True
+        return False
+
+    def get_connection_stats(self):
+        stats = dict(self.connection_stats)
+        stats["open"] = len(self)
+        stats["max_connections"] = self.max_connections
+        return stats
+
     def keep_alive(self):
-        for connection in self.values():
-            if connection.state == State.CONNECTED:
-                connection.handler.keep_alive()
+        """
+        Visits only the connections whose keep alive deadline has passed, popping them
+        off the keep alive queue. A connection which saw traffic since it was queued is
+        just put back at its new deadline, so busy connections cost one heap operation
+        per keep alive interval and idle ones one per keep alive sent.
+        """
+        t = time.time()
+        interval = self.nat_timeout.interval()
+        if interval < self.keep_alive_interval:
+            # The NAT timeout turned out shorter than we thought, bring every deadline in.
+            self.keep_alive_due = dict((address, min(due, t + interval))
+                                       for address, due in self.keep_alive_due.iteritems())
+            self.keep_alive_queue = [(due, address) for address, due in self.keep_alive_due.iteritems()]
+            heapq.heapify(self.keep_alive_queue)
+        self.keep_alive_interval = interval
+
+        queue = self.keep_alive_queue
+        while len(queue) > 0 and queue[0][0] <= t:
+            due, address = heapq.heappop(queue)
+            if self.keep_alive_due.get(address) != due:
+                continue
+            connection = self._active_connections.get(address)
+            if connection is None:
+                del self.keep_alive_due[address]
+                continue
+            handler = connection.handler
+            if connection.state == State.CONNECTED and handler.keep_alive_deadline() <= t:
+                handler.keep_alive()
+            if self._active_connections.get(address) is connection and connection.state != State.SHUTDOWN:
+                self.schedule_keep_alive(address, max(handler.keep_alive_deadline(), t + KEEP_ALIVE_TICK))
+            else:
+                self.keep_alive_due.pop(address, None)
+
+    def shutdown(self):
+        self.scheduler.stop()
+        self.overload.stop()
+        self.vendors.stop()
+        ConnectionMultiplexer.shutdown(self)
 
-    def send_message(self, datagram, address, relay_addr):
+    def send_message(self, datagram, address, relay_addr, priority=CONTROL):
         """
         Sends a datagram over the wire to the given address. It will create a new rudp connection if one
         does not already exist for this peer.
@@ -220,12 +496,13 @@ class OpenBazaarProtocol(ConnectionMultiplexer):
             address: a `tuple` of (ip address, port) of the recipient.
             relay_addr: a `tuple` of (ip address, port) of the relay address
                 or `None` if no relaying is required.
+            priority: the `net.scheduler` priority class of the message.
         """
         if address not in self:
-            con = self.make_new_connection(self.ip_address, address, relay_addr)
+            con = self.make_new_connection(self.ip_address, address, relay_addr, outgoing=True)
         else:
             con = self[address]
         if relay_addr is not None and relay_addr != con.relay_addr and relay_addr != con.own_addr:
             con.set_relay_address(relay_addr)
 
-        con.send_message(datagram)
+        self.scheduler.send(con, datagram, priority)
@@ -8,12 +8,13 @@ import socket
 import stun
 import sys
 import time
+from random import shuffle
 from api.ws import WSFactory, AuthenticatedWebSocketProtocol, AuthenticatedWebSocketFactory
 from api.restapi import RestAPI
 from config import DATA_FOLDER, KSIZE, ALPHA, LIBBITCOIN_SERVERS,\
     LIBBITCOIN_SERVERS_TESTNET, SSL_KEY, SSL_CERT, SEEDS, SEEDS_TESTNET, SSL, SERVER_VERSION
 from daemon import Daemon
-from db.datastore import Database
+from db.datastore import Database, WRITE_FLUSH_INTERVAL
 from dht.network import Server
 from dht.node import Node
 from dht.storage import ForgetfulStorage
@@ -90,27 +91,33 @@ def run(*args):
 
         # kademlia
         SEED_URLS = SEEDS_TESTNET if TESTNET else SEEDS
-        relay_node = None
+        # Until bootstrapping has measured some FULL_CONE peers to pick relays from,
+        # relay through the seeds. Shuffle them so they share the load.
+        relay_nodes = []
         if nat_type != FULL_CONE:
             for seed in SEED_URLS:
                 try:
-                    relay_node = (socket.gethostbyname(seed[0].split(":")[0]),
-                                  28469 if TESTNET else 18469)
-                    break
+                    relay_nodes.append((socket.gethostbyname(seed[0].split(":")[0]),
+                                        28469 if TESTNET else 18469))
                 except socket.gaierror:
                     pass
+            shuffle(relay_nodes)
+        relay_node = relay_nodes[0] if len(relay_nodes) > 0 else None
 
         try:
             kserver = Server.loadState(os.path.join(DATA_FOLDER, 'cache.pickle'), ip_address, port, protocol, db,
                                        nat_type, relay_node, on_bootstrap_complete, storage)
         except Exception:
             node = Node(keys.guid, ip_address, port, keys.verify_key.encode(),
-                        relay_node, nat_type, Profile(db).get().vendor)
-            protocol.relay_node = node.relay_node
+                        relay_node, nat_type, Profile(db).get().vendor, relay_nodes[1:])
             kserver = Server(node, db, keys.signing_key, KSIZE, ALPHA, storage=storage)
             kserver.protocol.connect_multiplexer(protocol)
             kserver.bootstrap(kserver.querySeed(SEED_URLS)).addCallback(on_bootstrap_complete)
+        protocol.relay_node = relay_node
         kserver.saveStateRegularly(os.path.join(DATA_FOLDER, 'cache.pickle'), 10)
+
+        # commit the notifications, messages and other queued writes in batches
+        task.LoopingCall(db.flush).start(WRITE_FLUSH_INTERVAL, now=False)
         protocol.register_processor(kserver.protocol)
 
         # market
@@ -175,10 +182,10 @@ def run(*args):
 
         def shutdown():
             print "OpenBazaar Server v0.2.6 shutting down..."
-            for vendor in protocol.vendors.values():
-                db.vendors.save_vendor(vendor.id.encode("hex"), vendor.getProto().SerializeToString())
             PortMapper().clean_my_mappings(PORT)
             protocol.shutdown()
+            mserver.protocol.audit.stop()
+            db.close()
 
         reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
 
@@ -21,7 +21,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='message.proto',
   package='',
   syntax='proto3',
-  serialized_pb=_b('\n\rmessage.proto\x1a\robjects.proto\"\x97\x01\n\x07Message\x12\x11\n\tmessageID\x18\x01 \x01(\x0c\x12\x15\n\x06sender\x18\x02 \x01(\x0b\x32\x05.Node\x12\x19\n\x07\x63ommand\x18\x03 \x01(\x0e\x32\x08.Command\x12\x10\n\x08protoVer\x18\x04 \x01(\r\x12\x11\n\targuments\x18\x05 \x03(\x0c\x12\x0f\n\x07testnet\x18\x06 \x01(\x08\x12\x11\n\tsignature\x18\x07 \x01(\x0c*\x89\x04\n\x07\x43ommand\x12\x08\n\x04PING\x10\x00\x12\x08\n\x04STUN\x10\x01\x12\x0e\n\nHOLE_PUNCH\x10\x02\x12\t\n\x05STORE\x10\x03\x12\n\n\x06\x44\x45LETE\x10\x04\x12\x07\n\x03INV\x10\x05\x12\n\n\x06VALUES\x10\x06\x12\r\n\tBROADCAST\x10\x07\x12\x0b\n\x07MESSAGE\x10\x08\x12\n\n\x06\x46OLLOW\x10\t\x12\x0c\n\x08UNFOLLOW\x10\n\x12\t\n\x05ORDER\x10\x0b\x12\x16\n\x12ORDER_CONFIRMATION\x10\x0c\x12\x12\n\x0e\x43OMPLETE_ORDER\x10\r\x12\r\n\tFIND_NODE\x10\x0e\x12\x0e\n\nFIND_VALUE\x10\x0f\x12\x10\n\x0cGET_CONTRACT\x10\x10\x12\r\n\tGET_IMAGE\x10\x11\x12\x0f\n\x0bGET_PROFILE\x10\x12\x12\x10\n\x0cGET_LISTINGS\x10\x13\x12\x15\n\x11GET_USER_METADATA\x10\x14\x12\x19\n\x15GET_CONTRACT_METADATA\x10\x15\x12\x11\n\rGET_FOLLOWING\x10\x16\x12\x11\n\rGET_FOLLOWERS\x10\x17\x12\x0f\n\x0bGET_RATINGS\x10\x18\x12\x10\n\x0c\x44ISPUTE_OPEN\x10\x19\x12\x11\n\rDISPUTE_CLOSE\x10\x1a\x12\n\n\x06REFUND\x10\x1b\x12\x10\n\x0b\x42\x41\x44_REQUEST\x10\x90\x03\x12\x0e\n\tNOT_FOUND\x10\x94\x03\x12\x0e\n\tCALM_DOWN\x10\xa4\x03\x12\x12\n\rUNKNOWN_ERROR\x10\x88\x04\x62\x06proto3')
+  serialized_pb=_b('\n\rmessage.proto\x1a\robjects.proto\"\xb4\x01\n\x07Message\x12\x11\n\tmessageID\x18\x01 \x01(\x0c\x12\x15\n\x06sender\x18\x02 \x01(\x0b\x32\x05.Node\x12\x19\n\x07\x63ommand\x18\x03 \x01(\x0e\x32\x08.Command\x12\x10\n\x08protoVer\x18\x04 \x01(\r\x12\x11\n\targuments\x18\x05 \x03(\x0c\x12\x0f\n\x07testnet\x18\x06 \x01(\x08\x12\x11\n\tsignature\x18\x07 \x01(\x0c\x12\x1b\n\x13\x63ompressedArguments\x18\x08 \x03(\r*\xa9\x04\n\x07\x43ommand\x12\x08\n\x04PING\x10\x00\x12\x08\n\x04STUN\x10\x01\x12\x0e\n\nHOLE_PUNCH\x10\x02\x12\t\n\x05STORE\x10\x03\x12\n\n\x06\x44\x45LETE\x10\x04\x12\x07\n\x03INV\x10\x05\x12\n\n\x06VALUES\x10\x06\x12\r\n\tBROADCAST\x10\x07\x12\x0b\n\x07MESSAGE\x10\x08\x12\n\n\x06\x46OLLOW\x10\t\x12\x0c\n\x08UNFOLLOW\x10\n\x12\t\n\x05ORDER\x10\x0b\x12\x16\n\x12ORDER_CONFIRMATION\x10\x0c\x12\x12\n\x0e\x43OMPLETE_ORDER\x10\r\x12\r\n\tFIND_NODE\x10\x0e\x12\x0e\n\nFIND_VALUE\x10\x0f\x12\x10\n\x0cGET_CONTRACT\x10\x10\x12\r\n\tGET_IMAGE\x10\x11\x12\x0f\n\x0bGET_PROFILE\x10\x12\x12\x10\n\x0cGET_LISTINGS\x10\x13\x12\x15\n\x11GET_USER_METADATA\x10\x14\x12\x19\n\x15GET_CONTRACT_METADATA\x10\x15\x12\x11\n\rGET_FOLLOWING\x10\x16\x12\x11\n\rGET_FOLLOWERS\x10\x17\x12\x0f\n\x0bGET_RATINGS\x10\x18\x12\x10\n\x0c\x44ISPUTE_OPEN\x10\x19\x12\x11\n\rDISPUTE_CLOSE\x10\x1a\x12\n\n\x06REFUND\x10\x1b\x12\t\n\x05\x42\x41TCH\x10\x1c\x12\x13\n\x0fGET_IMAGE_CHUNK\x10\x1d\x12\x10\n\x0b\x42\x41\x44_REQUEST\x10\x90\x03\x12\x0e\n\tNOT_FOUND\x10\x94\x03\x12\x0e\n\tCALM_DOWN\x10\xa4\x03\x12\x12\n\rUNKNOWN_ERROR\x10\x88\x04\x62\x06proto3')
   ,
   dependencies=[objects__pb2.DESCRIPTOR,])
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
@@ -145,26 +145,34 @@ _COMMAND = _descriptor.EnumDescriptor(
       options=None,
       type=None),
     _descriptor.EnumValueDescriptor(
-      name='BAD_REQUEST', index=28, number=400,
+      name='BATCH', index=28, number=28,
       options=None,
       type=None),
     _descriptor.EnumValueDescriptor(
-      name='NOT_FOUND', index=29, number=404,
+      name='GET_IMAGE_CHUNK', index=29, number=29,
       options=None,
       type=None),
     _descriptor.EnumValueDescriptor(
-      name='CALM_DOWN', index=30, number=420,
+      name='BAD_REQUEST', index=30, number=400,
       options=None,
       type=None),
     _descriptor.EnumValueDescriptor(
-      name='UNKNOWN_ERROR', index=31, number=520,
+      name='NOT_FOUND', index=31, number=404,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='CALM_DOWN', index=32, number=420,
+      options=None,
+      type=None),
+    _descriptor.EnumValueDescriptor(
+      name='UNKNOWN_ERROR', index=33, number=520,
       options=None,
       type=None),
   ],
   containing_type=None,
   options=None,
-  serialized_start=187,
-  serialized_end=708,
+  serialized_start=216,
+  serialized_end=769,
 )
 _sym_db.RegisterEnumDescriptor(_COMMAND)
 
@@ -197,6 +205,8 @@ GET_RATINGS = 24
 DISPUTE_OPEN = 25
 DISPUTE_CLOSE = 26
 REFUND = 27
+BATCH = 28
+GET_IMAGE_CHUNK = 29
 BAD_REQUEST = 400
 NOT_FOUND = 404
 CALM_DOWN = 420
@@ -260,6 +270,13 @@ _MESSAGE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='compressedArguments', full_name='Message.compressedArguments', index=7,
+      number=8, type=13, cpp_type=3, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -273,7 +290,7 @@ _MESSAGE = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=33,
-  serialized_end=184,
+  serialized_end=213,
 )
 
 _MESSAGE.fields_by_name['sender'].message_type = objects__pb2._NODE
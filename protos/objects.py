@@ -21,7 +21,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='objects.proto',
   package='',
   syntax='proto3',
-  serialized_pb=_b('\n\robjects.proto\x1a\x0f\x63ountries.proto\"\xc6\x01\n\x04Node\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x11\n\tpublicKey\x18\x02 \x01(\x0c\x12\x19\n\x07natType\x18\x03 \x01(\x0e\x32\x08.NATType\x12$\n\x0bnodeAddress\x18\x04 \x01(\x0b\x32\x0f.Node.IPAddress\x12%\n\x0crelayAddress\x18\x05 \x01(\x0b\x32\x0f.Node.IPAddress\x12\x0e\n\x06vendor\x18\x06 \x01(\x08\x1a%\n\tIPAddress\x12\n\n\x02ip\x18\x01 \x01(\t\x12\x0c\n\x04port\x18\x02 \x01(\r\"O\n\x05Value\x12\x0f\n\x07keyword\x18\x01 \x01(\x0c\x12\x10\n\x08valueKey\x18\x02 \x01(\x0c\x12\x16\n\x0eserializedData\x18\x03 \x01(\x0c\x12\x0b\n\x03ttl\x18\x04 \x01(\r\"(\n\x03Inv\x12\x0f\n\x07keyword\x18\x01 \x01(\x0c\x12\x10\n\x08valueKey\x18\x02 \x01(\x0c\"\xa8\x06\n\x07Profile\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x1e\n\x08location\x18\x02 \x01(\x0e\x32\x0c.CountryCode\x12$\n\x08guid_key\x18\x03 \x01(\x0b\x32\x12.Profile.PublicKey\x12\'\n\x0b\x62itcoin_key\x18\x04 \x01(\x0b\x32\x12.Profile.PublicKey\x12\x0c\n\x04nsfw\x18\x05 \x01(\x08\x12\x0e\n\x06vendor\x18\x06 \x01(\x08\x12\x11\n\tmoderator\x18\x07 \x01(\x08\x12\x16\n\x0emoderation_fee\x18\x08 \x01(\x02\x12\x0e\n\x06handle\x18\t \x01(\t\x12\r\n\x05\x61\x62out\x18\n \x01(\t\x12\x19\n\x11short_description\x18\x0b \x01(\t\x12\x0f\n\x07website\x18\x0c \x01(\t\x12\r\n\x05\x65mail\x18\r \x01(\t\x12&\n\x06social\x18\x0e \x03(\x0b\x32\x16.Profile.SocialAccount\x12\x15\n\rprimary_color\x18\x0f \x01(\r\x12\x17\n\x0fsecondary_color\x18\x10 \x01(\r\x12\x18\n\x10\x62\x61\x63kground_color\x18\x11 \x01(\r\x12\x12\n\ntext_color\x18\x12 \x01(\r\x12\x16\n\x0e\x66ollower_count\x18\x13 \x01(\r\x12\x17\n\x0f\x66ollowing_count\x18\x14 \x01(\r\x12#\n\x07pgp_key\x18\x15 \x01(\x0b\x32\x12.Profile.PublicKey\x12\x13\n\x0b\x61vatar_hash\x18\x16 \x01(\x0c\x12\x13\n\x0bheader_hash\x18\x17 \x01(\x0c\x12\x15\n\rlast_modified\x18\x18 \x01(\x04\x1a\xab\x01\n\rSocialAccount\x12/\n\x04type\x18\x01 \x01(\x0e\x32!.Profile.SocialAccount.SocialType\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x11\n\tproof_url\x18\x03 \x01(\t\"D\n\nSocialType\x12\x0c\n\x08\x46\x41\x43\x45\x42OOK\x10\x00\x12\x0b\n\x07TWITTER\x10\x01\x12\r\n\tINSTAGRAM\x10\x02\x12\x0c\n\x08SNAPCHAT\x10\x03\x1a\x32\n\tPublicKey\x12\x12\n\npublic_key\x18\x01 \x01(\x0c\x12\x11\n\tsignature\x18\x02 \x01(\x0c\"f\n\x08Metadata\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x19\n\x11short_description\x18\x03 \x01(\t\x12\x13\n\x0b\x61vatar_hash\x18\x04 \x01(\x0c\x12\x0c\n\x04nsfw\x18\x05 \x01(\x08\"\x8b\x04\n\x08Listings\x12*\n\x07listing\x18\x01 \x03(\x0b\x32\x19.Listings.ListingMetadata\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x13\n\x0b\x61vatar_hash\x18\x03 \x01(\x0c\x1a\xde\x02\n\x0fListingMetadata\x12\x15\n\rcontract_hash\x18\x01 \x01(\x0c\x12\r\n\x05title\x18\x02 \x01(\t\x12\x16\n\x0ethumbnail_hash\x18\x03 \x01(\x0c\x12\x10\n\x08\x63\x61tegory\x18\x04 \x01(\t\x12\r\n\x05price\x18\x05 \x01(\x02\x12\x15\n\rcurrency_code\x18\x06 \x01(\t\x12\x0c\n\x04nsfw\x18\x07 \x01(\x08\x12\x1c\n\x06origin\x18\x08 \x01(\x0e\x32\x0c.CountryCode\x12\x1e\n\x08ships_to\x18\t \x03(\x0e\x32\x0c.CountryCode\x12\x13\n\x0b\x61vatar_hash\x18\n \x01(\x0c\x12\x0e\n\x06handle\x18\x0b \x01(\t\x12-\n\rcontract_type\x18\x0c \x01(\x0e\x32\x16.Listings.ContractType\x12\x15\n\rlast_modified\x18\r \x01(\x04\x12\x0e\n\x06pinned\x18\x0e \x01(\x08\x12\x0e\n\x06hidden\x18\x0f \x01(\x08\"M\n\x0c\x43ontractType\x12\x0b\n\x07NOT_SET\x10\x00\x12\x11\n\rPHYSICAL_GOOD\x10\x01\x12\x10\n\x0c\x44IGITAL_GOOD\x10\x02\x12\x0b\n\x07SERVICE\x10\x03\"\xa0\x01\n\tFollowers\x12&\n\tfollowers\x18\x01 \x03(\x0b\x32\x13.Followers.Follower\x1ak\n\x08\x46ollower\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x11\n\tfollowing\x18\x02 \x01(\x0c\x12\x0e\n\x06pubkey\x18\x03 \x01(\x0c\x12\x1b\n\x08metadata\x18\x04 \x01(\x0b\x32\t.Metadata\x12\x11\n\tsignature\x18\x05 \x01(\x0c\"\x81\x01\n\tFollowing\x12\x1e\n\x05users\x18\x01 \x03(\x0b\x32\x0f.Following.User\x1aT\n\x04User\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x0e\n\x06pubkey\x18\x02 \x01(\x0c\x12\x1b\n\x08metadata\x18\x03 \x01(\x0b\x32\t.Metadata\x12\x11\n\tsignature\x18\x04 \x01(\x0c\"\xbd\x02\n\x10PlaintextMessage\x12\x13\n\x0bsender_guid\x18\x01 \x01(\x0c\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x0e\n\x06pubkey\x18\x03 \x01(\x0c\x12\x0f\n\x07subject\x18\x04 \x01(\t\x12$\n\x04type\x18\x05 \x01(\x0e\x32\x16.PlaintextMessage.Type\x12\x0f\n\x07message\x18\x06 \x01(\t\x12\x11\n\ttimestamp\x18\x07 \x01(\x04\x12\x13\n\x0b\x61vatar_hash\x18\x08 \x01(\x0c\x12\x11\n\tsignature\x18\t \x01(\x0c\"q\n\x04Type\x12\x08\n\x04\x43HAT\x10\x00\x12\t\n\x05ORDER\x10\x01\x12\x10\n\x0c\x44ISPUTE_OPEN\x10\x02\x12\x11\n\rDISPUTE_CLOSE\x10\x03\x12\x16\n\x12ORDER_CONFIRMATION\x10\x04\x12\x0b\n\x07RECEIPT\x10\x05\x12\n\n\x06REFUND\x10\x06*7\n\x07NATType\x12\r\n\tFULL_CONE\x10\x00\x12\x0e\n\nRESTRICTED\x10\x01\x12\r\n\tSYMMETRIC\x10\x02\x62\x06proto3')
+  serialized_pb=_b('\n\robjects.proto\x1a\x0f\x63ountries.proto\"\xf5\x01\n\x04Node\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x11\n\tpublicKey\x18\x02 \x01(\x0c\x12\x19\n\x07natType\x18\x03 \x01(\x0e\x32\x08.NATType\x12$\n\x0bnodeAddress\x18\x04 \x01(\x0b\x32\x0f.Node.IPAddress\x12%\n\x0crelayAddress\x18\x05 \x01(\x0b\x32\x0f.Node.IPAddress\x12\x0e\n\x06vendor\x18\x06 \x01(\x08\x12-\n\x14\x62\x61\x63kupRelayAddresses\x18\x07 \x03(\x0b\x32\x0f.Node.IPAddress\x1a%\n\tIPAddress\x12\n\n\x02ip\x18\x01 \x01(\t\x12\x0c\n\x04port\x18\x02 \x01(\r\"O\n\x05Value\x12\x0f\n\x07keyword\x18\x01 \x01(\x0c\x12\x10\n\x08valueKey\x18\x02 \x01(\x0c\x12\x16\n\x0eserializedData\x18\x03 \x01(\x0c\x12\x0b\n\x03ttl\x18\x04 \x01(\r\"(\n\x03Inv\x12\x0f\n\x07keyword\x18\x01 \x01(\x0c\x12\x10\n\x08valueKey\x18\x02 \x01(\x0c\"\xa8\x06\n\x07Profile\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x1e\n\x08location\x18\x02 \x01(\x0e\x32\x0c.CountryCode\x12$\n\x08guid_key\x18\x03 \x01(\x0b\x32\x12.Profile.PublicKey\x12\'\n\x0b\x62itcoin_key\x18\x04 \x01(\x0b\x32\x12.Profile.PublicKey\x12\x0c\n\x04nsfw\x18\x05 \x01(\x08\x12\x0e\n\x06vendor\x18\x06 \x01(\x08\x12\x11\n\tmoderator\x18\x07 \x01(\x08\x12\x16\n\x0emoderation_fee\x18\x08 \x01(\x02\x12\x0e\n\x06handle\x18\t \x01(\t\x12\r\n\x05\x61\x62out\x18\n \x01(\t\x12\x19\n\x11short_description\x18\x0b \x01(\t\x12\x0f\n\x07website\x18\x0c \x01(\t\x12\r\n\x05\x65mail\x18\r \x01(\t\x12&\n\x06social\x18\x0e \x03(\x0b\x32\x16.Profile.SocialAccount\x12\x15\n\rprimary_color\x18\x0f \x01(\r\x12\x17\n\x0fsecondary_color\x18\x10 \x01(\r\x12\x18\n\x10\x62\x61\x63kground_color\x18\x11 \x01(\r\x12\x12\n\ntext_color\x18\x12 \x01(\r\x12\x16\n\x0e\x66ollower_count\x18\x13 \x01(\r\x12\x17\n\x0f\x66ollowing_count\x18\x14 \x01(\r\x12#\n\x07pgp_key\x18\x15 \x01(\x0b\x32\x12.Profile.PublicKey\x12\x13\n\x0b\x61vatar_hash\x18\x16 \x01(\x0c\x12\x13\n\x0bheader_hash\x18\x17 \x01(\x0c\x12\x15\n\rlast_modified\x18\x18 \x01(\x04\x1a\xab\x01\n\rSocialAccount\x12/\n\x04type\x18\x01 \x01(\x0e\x32!.Profile.SocialAccount.SocialType\x12\x10\n\x08username\x18\x02 \x01(\t\x12\x11\n\tproof_url\x18\x03 \x01(\t\"D\n\nSocialType\x12\x0c\n\x08\x46\x41\x43\x45\x42OOK\x10\x00\x12\x0b\n\x07TWITTER\x10\x01\x12\r\n\tINSTAGRAM\x10\x02\x12\x0c\n\x08SNAPCHAT\x10\x03\x1a\x32\n\tPublicKey\x12\x12\n\npublic_key\x18\x01 \x01(\x0c\x12\x11\n\tsignature\x18\x02 \x01(\x0c\"f\n\x08Metadata\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x19\n\x11short_description\x18\x03 \x01(\t\x12\x13\n\x0b\x61vatar_hash\x18\x04 \x01(\x0c\x12\x0c\n\x04nsfw\x18\x05 \x01(\x08\"\x8b\x04\n\x08Listings\x12*\n\x07listing\x18\x01 \x03(\x0b\x32\x19.Listings.ListingMetadata\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x13\n\x0b\x61vatar_hash\x18\x03 \x01(\x0c\x1a\xde\x02\n\x0fListingMetadata\x12\x15\n\rcontract_hash\x18\x01 \x01(\x0c\x12\r\n\x05title\x18\x02 \x01(\t\x12\x16\n\x0ethumbnail_hash\x18\x03 \x01(\x0c\x12\x10\n\x08\x63\x61tegory\x18\x04 \x01(\t\x12\r\n\x05price\x18\x05 \x01(\x02\x12\x15\n\rcurrency_code\x18\x06 \x01(\t\x12\x0c\n\x04nsfw\x18\x07 \x01(\x08\x12\x1c\n\x06origin\x18\x08 \x01(\x0e\x32\x0c.CountryCode\x12\x1e\n\x08ships_to\x18\t \x03(\x0e\x32\x0c.CountryCode\x12\x13\n\x0b\x61vatar_hash\x18\n \x01(\x0c\x12\x0e\n\x06handle\x18\x0b \x01(\t\x12-\n\rcontract_type\x18\x0c \x01(\x0e\x32\x16.Listings.ContractType\x12\x15\n\rlast_modified\x18\r \x01(\x04\x12\x0e\n\x06pinned\x18\x0e \x01(\x08\x12\x0e\n\x06hidden\x18\x0f \x01(\x08\"M\n\x0c\x43ontractType\x12\x0b\n\x07NOT_SET\x10\x00\x12\x11\n\rPHYSICAL_GOOD\x10\x01\x12\x10\n\x0c\x44IGITAL_GOOD\x10\x02\x12\x0b\n\x07SERVICE\x10\x03\"\xa0\x01\n\tFollowers\x12&\n\tfollowers\x18\x01 \x03(\x0b\x32\x13.Followers.Follower\x1ak\n\x08\x46ollower\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x11\n\tfollowing\x18\x02 \x01(\x0c\x12\x0e\n\x06pubkey\x18\x03 \x01(\x0c\x12\x1b\n\x08metadata\x18\x04 \x01(\x0b\x32\t.Metadata\x12\x11\n\tsignature\x18\x05 \x01(\x0c\"\x81\x01\n\tFollowing\x12\x1e\n\x05users\x18\x01 \x03(\x0b\x32\x0f.Following.User\x1aT\n\x04User\x12\x0c\n\x04guid\x18\x01 \x01(\x0c\x12\x0e\n\x06pubkey\x18\x02 \x01(\x0c\x12\x1b\n\x08metadata\x18\x03 \x01(\x0b\x32\t.Metadata\x12\x11\n\tsignature\x18\x04 \x01(\x0c\"\xbd\x02\n\x10PlaintextMessage\x12\x13\n\x0bsender_guid\x18\x01 \x01(\x0c\x12\x0e\n\x06handle\x18\x02 \x01(\t\x12\x0e\n\x06pubkey\x18\x03 \x01(\x0c\x12\x0f\n\x07subject\x18\x04 \x01(\t\x12$\n\x04type\x18\x05 \x01(\x0e\x32\x16.PlaintextMessage.Type\x12\x0f\n\x07message\x18\x06 \x01(\t\x12\x11\n\ttimestamp\x18\x07 \x01(\x04\x12\x13\n\x0b\x61vatar_hash\x18\x08 \x01(\x0c\x12\x11\n\tsignature\x18\t \x01(\x0c\"q\n\x04Type\x12\x08\n\x04\x43HAT\x10\x00\x12\t\n\x05ORDER\x10\x01\x12\x10\n\x0c\x44ISPUTE_OPEN\x10\x02\x12\x11\n\rDISPUTE_CLOSE\x10\x03\x12\x16\n\x12ORDER_CONFIRMATION\x10\x04\x12\x0b\n\x07RECEIPT\x10\x05\x12\n\n\x06REFUND\x10\x06*7\n\x07NATType\x12\r\n\tFULL_CONE\x10\x00\x12\x0e\n\nRESTRICTED\x10\x01\x12\r\n\tSYMMETRIC\x10\x02\x62\x06proto3')
   ,
   dependencies=[countries__pb2.DESCRIPTOR,])
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
@@ -47,8 +47,8 @@ _NATTYPE = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=2414,
-  serialized_end=2469,
+  serialized_start=2461,
+  serialized_end=2516,
 )
 _sym_db.RegisterEnumDescriptor(_NATTYPE)
 
@@ -83,8 +83,8 @@ _PROFILE_SOCIALACCOUNT_SOCIALTYPE = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=1047,
-  serialized_end=1115,
+  serialized_start=1094,
+  serialized_end=1162,
 )
 _sym_db.RegisterEnumDescriptor(_PROFILE_SOCIALACCOUNT_SOCIALTYPE)
 
@@ -113,8 +113,8 @@ _LISTINGS_CONTRACTTYPE = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=1720,
-  serialized_end=1797,
+  serialized_start=1767,
+  serialized_end=1844,
 )
 _sym_db.RegisterEnumDescriptor(_LISTINGS_CONTRACTTYPE)
 
@@ -155,8 +155,8 @@ _PLAINTEXTMESSAGE_TYPE = _descriptor.EnumDescriptor(
   ],
   containing_type=None,
   options=None,
-  serialized_start=2299,
-  serialized_end=2412,
+  serialized_start=2346,
+  serialized_end=2459,
 )
 _sym_db.RegisterEnumDescriptor(_PLAINTEXTMESSAGE_TYPE)
 
@@ -194,8 +194,8 @@ _NODE_IPADDRESS = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=196,
-  serialized_end=233,
+  serialized_start=243,
+  serialized_end=280,
 )
 
 _NODE = _descriptor.Descriptor(
@@ -247,6 +247,13 @@ _NODE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='backupRelayAddresses', full_name='Node.backupRelayAddresses', index=6,
+      number=7, type=11, cpp_type=10, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -260,7 +267,7 @@ _NODE = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=35,
-  serialized_end=233,
+  serialized_end=280,
 )
 
 
@@ -311,8 +318,8 @@ _VALUE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=235,
-  serialized_end=314,
+  serialized_start=282,
+  serialized_end=361,
 )
 
 
@@ -349,8 +356,8 @@ _INV = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=316,
-  serialized_end=356,
+  serialized_start=363,
+  serialized_end=403,
 )
 
 
@@ -395,8 +402,8 @@ _PROFILE_SOCIALACCOUNT = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=944,
-  serialized_end=1115,
+  serialized_start=991,
+  serialized_end=1162,
 )
 
 _PROFILE_PUBLICKEY = _descriptor.Descriptor(
@@ -432,8 +439,8 @@ _PROFILE_PUBLICKEY = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1117,
-  serialized_end=1167,
+  serialized_start=1164,
+  serialized_end=1214,
 )
 
 _PROFILE = _descriptor.Descriptor(
@@ -623,8 +630,8 @@ _PROFILE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=359,
-  serialized_end=1167,
+  serialized_start=406,
+  serialized_end=1214,
 )
 
 
@@ -682,8 +689,8 @@ _METADATA = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1169,
-  serialized_end=1271,
+  serialized_start=1216,
+  serialized_end=1318,
 )
 
 
@@ -811,8 +818,8 @@ _LISTINGS_LISTINGMETADATA = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1368,
-  serialized_end=1718,
+  serialized_start=1415,
+  serialized_end=1765,
 )
 
 _LISTINGS = _descriptor.Descriptor(
@@ -856,8 +863,8 @@ _LISTINGS = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1274,
-  serialized_end=1797,
+  serialized_start=1321,
+  serialized_end=1844,
 )
 
 
@@ -915,8 +922,8 @@ _FOLLOWERS_FOLLOWER = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1853,
-  serialized_end=1960,
+  serialized_start=1900,
+  serialized_end=2007,
 )
 
 _FOLLOWERS = _descriptor.Descriptor(
@@ -945,8 +952,8 @@ _FOLLOWERS = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1800,
-  serialized_end=1960,
+  serialized_start=1847,
+  serialized_end=2007,
 )
 
 
@@ -997,8 +1004,8 @@ _FOLLOWING_USER = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=2008,
-  serialized_end=2092,
+  serialized_start=2055,
+  serialized_end=2139,
 )
 
 _FOLLOWING = _descriptor.Descriptor(
@@ -1027,8 +1034,8 @@ _FOLLOWING = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=1963,
-  serialized_end=2092,
+  serialized_start=2010,
+  serialized_end=2139,
 )
 
 
@@ -1115,14 +1122,15 @@ _PLAINTEXTMESSAGE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=2095,
-  serialized_end=2412,
+  serialized_start=2142,
+  serialized_end=2459,
 )
 
 _NODE_IPADDRESS.containing_type = _NODE
 _NODE.fields_by_name['natType'].enum_type = _NATTYPE
 _NODE.fields_by_name['nodeAddress'].message_type = _NODE_IPADDRESS
 _NODE.fields_by_name['relayAddress'].message_type = _NODE_IPADDRESS
+_NODE.fields_by_name['backupRelayAddresses'].message_type = _NODE_IPADDRESS
 _PROFILE_SOCIALACCOUNT.fields_by_name['type'].enum_type = _PROFILE_SOCIALACCOUNT_SOCIALTYPE
 _PROFILE_SOCIALACCOUNT.containing_type = _PROFILE
 _PROFILE_SOCIALACCOUNT_SOCIALTYPE.containing_type = _PROFILE_SOCIALACCOUNT
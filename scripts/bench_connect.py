@@ -0,0 +1,75 @@
+"""
+Counts the reactor calls scheduled while a batch of peers complete their rudp
+handshakes, as happens when a node bootstraps. Run from the repository root:
+
+    python scripts/bench_connect.py [peers]
+
+Both the reactor txrudp uses and the global twisted reactor, which the node's
+own timers run on, are replaced with one simulated clock. Handshakes take
+between 50ms and 2s of simulated time and the clock is run for 3 seconds.
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mock
+from twisted.internet import task, udp, address, reactor
+from txrudp import connection
+from txrudp.connection import State
+
+from net import wireprotocol
+from protos.objects import FULL_CONE
+
+
+class CountingClock(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.scheduled = 0
+
+    def callLater(self, *args, **kwargs):
+        self.scheduled += 1
+        return task.Clock.callLater(self, *args, **kwargs)
+
+
+def run(peers):
+    random.seed(1)
+    clock = CountingClock()
+    connection.REACTOR = clock
+    with mock.patch.multiple(reactor, callLater=clock.callLater, seconds=clock.seconds):
+        return _run(peers, clock)
+
+
+def _run(peers, clock):
+    own_addr = ("123.45.67.89", 18469)
+    db = mock.MagicMock()
+    db.vendors.get_vendor_records.return_value = []
+    protocol = wireprotocol.OpenBazaarProtocol(db, own_addr, FULL_CONE, max_connections=peers)
+    transport = mock.Mock(spec_set=udp.Port)
+    transport.attach_mock(mock.Mock(return_value=address.IPv4Address('UDP', own_addr[0], own_addr[1])), 'getHost')
+    protocol.makeConnection(transport)
+
+    pending = []
+    for i in range(peers):
+        con = protocol.make_new_connection(own_addr, ("10.0.%d.%d" % (i / 256, i % 256), 18469), outgoing=True)
+        pending.append((random.uniform(0.05, 2.0), con))
+    pending.sort(key=lambda p: p[0])
+
+    baseline = clock.scheduled
+    for step in range(300):
+        while pending and pending[0][0] <= step * 0.01:
+            pending.pop(0)[1]._state = State.CONNECTED
+        clock.advance(0.01)
+    connected = len([c for c in protocol.values() if c.state == State.CONNECTED])
+    protocol.keep_alive_loop.stop()
+    protocol.shutdown()
+    return connected, clock.scheduled - baseline
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    connected, calls = run(count)
+    print "%d peers, %d connected" % (count, connected)
+    print "reactor calls scheduled in 3s of simulated time: %d" % calls
@@ -0,0 +1,103 @@
+"""
+Times the datastore methods hit while serving rpcs and the websocket api.
+Run from the repository root:
+
+    python scripts/bench_datastore.py [iterations]
+
+A throwaway database is created in a temporary directory and seeded with a
+profile, listings, followers, messages, notifications and ratings. Each method
+is then called `iterations` times and the average time per call is printed.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db.datastore import Database
+from dht.utils import digest
+from protos.objects import Profile, Listings, Followers, Following
+
+
+def seed(db):
+    p = Profile()
+    p.name = "Vendor"
+    db.profile.set_proto(p.SerializeToString())
+
+    for i in range(50):
+        l = Listings.ListingMetadata()
+        l.contract_hash = digest("contract %s" % i)
+        l.title = "Listing %s" % i
+        l.price = i
+        l.currency_code = "USD"
+        db.listings.add_listing(l)
+        db.ratings.add_rating(l.contract_hash.encode("hex"), '{"tx_summary": {"feedback": %s}}' % (i % 5 + 1))
+
+    for i in range(200):
+        f = Followers.Follower()
+        f.guid = digest("follower %s" % i)
+        f.following = digest("me")
+        f.pubkey = digest("pubkey %s" % i)
+        db.follow.set_follower(f.SerializeToString())
+
+    for i in range(20):
+        u = Following.User()
+        u.guid = digest("following %s" % i)
+        u.pubkey = digest("pubkey %s" % i)
+        db.follow.follow(u)
+
+    for i in range(200):
+        db.messages.save_message(digest("peer %s" % (i % 10)).encode("hex"), "handle", "pubkey", "", "CHAT",
+                                 "message %s" % i, time.time() + i, "", "", False, digest("msg %s" % i))
+        db.notifications.save_notification(digest("notif %s" % i).encode("hex"), "guid", "handle", "FOLLOW",
+                                           "", "title", time.time() + i, "")
+
+    db.keys.set_key("guid", "privkey", "pubkey")
+    db.settings.update("", "USD", "UNITED_STATES", "en", "UTC", 1, "[]", "[]", "", "", "[]", 0,
+                       "", "", "", "", "")
+
+
+def run(iterations):
+    folder = tempfile.mkdtemp()
+    try:
+        db = Database(filepath=os.path.join(folder, "bench.db"))
+        seed(db)
+        contract = digest("contract 1").encode("hex")
+        peer = digest("peer 1").encode("hex")
+        notif = digest("notif 150").encode("hex")
+        methods = [
+            ("profile.get_proto", db.profile.get_proto),
+            ("listings.get_proto", db.listings.get_proto),
+            ("listings.get_listing", lambda: db.listings.get_listing(digest("contract 1"))),
+            ("keys.get_key", lambda: db.keys.get_key("guid")),
+            ("settings.get", db.settings.get),
+            ("follow.get_following", db.follow.get_following),
+            ("follow.is_following", lambda: db.follow.is_following(digest("following 5"))),
+            ("follow.get_followers", db.follow.get_followers),
+            ("messages.get_messages", lambda: db.messages.get_messages(peer, "CHAT")),
+            ("messages.get_conversations", db.messages.get_conversations),
+            ("notifications.get_notifications", lambda: db.notifications.get_notifications(notif, 20)),
+            ("ratings.get_listing_ratings", lambda: db.ratings.get_listing_ratings(contract)),
+            ("ratings.get_aggregate", lambda: db.ratings.get_aggregate(contract)),
+            ("ratings.get_ratings_page", lambda: db.ratings.get_ratings_page(contract)),
+            ("filemap.get_file", lambda: db.filemap.get_file(contract)),
+            ("messages.mark_as_read", lambda: db.messages.mark_as_read(peer)),
+        ]
+        total = 0.0
+        for name, method in methods:
+            start = time.time()
+            for _ in range(iterations):
+                method()
+            elapsed = time.time() - start
+            total += elapsed
+            print "%-34s %8.1f us/call" % (name, elapsed / iterations * 1000000)
+        print "%-34s %8.1f ms" % ("total", total * 1000)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
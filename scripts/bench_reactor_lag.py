@@ -0,0 +1,84 @@
+"""
+Measures how late the reactor runs while the market protocol serves a steady
+stream of read-only rpcs backed by the database. Run from the repository root:
+
+    python scripts/bench_reactor_lag.py [requests per second] [seconds]
+
+The database is seeded as in bench_datastore.py. A timer which should fire every
+10ms records how late it actually fires, which is how long any other connection
+would have waited for the reactor.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mock
+import nacl.signing
+from twisted.internet import defer, reactor, task
+
+from bench_datastore import seed
+from db.datastore import Database
+from dht.node import Node
+from dht.utils import digest
+from market.protocol import MarketProtocol
+from protos.objects import FULL_CONE
+
+TICK = 0.01
+
+
+def run(rate, duration):
+    folder = tempfile.mkdtemp()
+    db = Database(filepath=os.path.join(folder, "bench.db"))
+    seed(db)
+    signing_key = nacl.signing.SigningKey.generate()
+    node = Node(digest("vendor"), "127.0.0.1", 18467, signing_key.verify_key.encode(), nat_type=FULL_CONE)
+    protocol = MarketProtocol(node, mock.Mock(), signing_key, db, audit=False)
+    sender = Node(digest("buyer"), "127.0.0.2", 18467, digest("pubkey"), nat_type=FULL_CONE)
+    calls = [
+        (protocol.rpc_get_listings, ()),
+        (protocol.rpc_get_followers, ()),
+        (protocol.rpc_get_following, ()),
+        (protocol.rpc_get_profile, ()),
+        (protocol.rpc_get_user_metadata, ()),
+        (protocol.rpc_get_ratings, ()),
+        (protocol.rpc_get_contract_metadata, (digest("contract 1"),)),
+    ]
+    lags = []
+    stats = {"sent": 0, "served": 0, "last": time.time()}
+
+    def sample():
+        now = time.time()
+        lags.append(max(0.0, now - stats["last"] - TICK))
+        stats["last"] = now
+
+    def served(result):
+        stats["served"] += 1
+
+    def send():
+        for _ in range(int(rate * TICK)):
+            f, args = calls[stats["sent"] % len(calls)]
+            stats["sent"] += 1
+            defer.maybeDeferred(f, sender, *args).addCallback(served)
+
+    task.LoopingCall(sample).start(TICK, now=False)
+    task.LoopingCall(send).start(TICK)
+    reactor.callLater(duration, reactor.stop)
+    reactor.run()
+    db.close()
+    shutil.rmtree(folder)
+
+    lags.sort()
+    print "%d requests sent, %d served in %ss" % (stats["sent"], stats["served"], duration)
+    print "reactor lag: mean %.2fms, p50 %.2fms, p99 %.2fms, max %.2fms" % (
+        sum(lags) / len(lags) * 1000, lags[len(lags) / 2] * 1000, lags[int(len(lags) * 0.99)] * 1000,
+        lags[-1] * 1000)
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, int(sys.argv[2]) if len(sys.argv) > 2 else 10)